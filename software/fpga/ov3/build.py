@@ -1,11 +1,15 @@
 from ovplatform.ov3 import Platform
 from ovhw.top import OV3
+from misoc.interconnect.csr import CSRStatus, CSRStorage
 import sys
 import argparse
 import os
 import json
 import zipfile
 import shutil
+import subprocess
+import time
+import zlib
 
 
 def parse_args():
@@ -14,9 +18,44 @@ def parse_args():
     p.add_argument('-n', '--build-name', default='ov3', help='Override build name.')
     p.add_argument('-p', '--generate-fwpkg', action='store_true', default=False, help='Generate firmware package after build finishes.')
     p.add_argument('-m', '--mibuild-params', default='{}', type=json.loads, help='Extra mibuild parameters (in JSON).')
+    p.add_argument('--build-id', type=lambda x: int(x, 0), default=None,
+                   help='Override the 32-bit build ID (default: derived from the time and git revision).')
     return p.parse_args()
 
 
+def default_build_id():
+    # Unique per build rather than per source; two builds of the same tree
+    # can still differ (toolchain, seeds), so don't try to be reproducible
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        rev = b""
+    stamp = ("%r %d" % (time.time(), os.getpid())).encode("ascii")
+    # 0 is reserved for "no ID"
+    return zlib.crc32(rev + stamp) or 1
+
+
+def csr_attrs(csr):
+    # Access type, reset value and width, appended to each map line. Older
+    # map parsers ignore anything after the address.
+    #   ro  - status, reflects live hardware state
+    #   rw  - storage, only changed by the host
+    #   rwh - storage the gateware can also write
+    #   cmd - raw register, accesses may have side effects
+    if isinstance(csr, CSRStorage):
+        access = "rwh" if hasattr(csr, "dat_w") else "rw"
+        reset = csr.storage.reset
+    elif isinstance(csr, CSRStatus):
+        access = "ro"
+        reset = csr.status.reset
+    else:
+        access = "cmd"
+        reset = 0
+
+    reset = getattr(reset, "value", reset)
+    return "%s reset=%#x bits=%d" % (access, reset, csr.size)
+
+
 def gen_mapfile(ov3_mod):
     # Generate mapfile for tool / sw usage
     r = ""
@@ -29,9 +68,10 @@ def gen_mapfile(ov3_mod):
         for n, csr in enumerate(csrs):
             nr = (csr.size + 7)//8
             if nr == 1:
-                r += "%s = %#x\n" % ((name + "_" + csr.name).upper(), reg_base)
+                r += "%s = %#x %s\n" % ((name + "_" + csr.name).upper(), reg_base, csr_attrs(csr))
             else:
-                r += "%s = %#x:%#x\n" % ((name + "_" + csr.name).upper(), reg_base, reg_base + nr - 1)
+                r += "%s = %#x:%#x %s\n" % ((name + "_" + csr.name).upper(), reg_base, reg_base + nr - 1,
+                                            csr_attrs(csr))
             reg_base += nr
 
     return r
@@ -51,7 +91,9 @@ if __name__ == "__main__":
     os.makedirs(args.build_dir, exist_ok=True)
 
     plat = Platform()
-    top = OV3(plat)
+    build_id = args.build_id if args.build_id is not None else default_build_id()
+    top = OV3(plat, build_id=build_id)
+    print("Build ID: %#010x" % build_id)
 
     # Paths
     bit_file_name = args.build_name + '.bit'
@@ -6,8 +6,18 @@ from migen.genlib.roundrobin import RoundRobin, SP_CE
     
 from ovhw.csr_master import CMD_REC
 
+# Command magics
+CMD_MAGIC = 0x55
+CMD_MAGIC_BURST = 0x56
+
 # Simple statemachine to turn incoming datastream
 # into CSR bus accesses
+#
+# Single access:  0x55, wr << 7 | a[13:8], a[7:0], data, cksum
+# Burst access:   0x56, wr << 7 | a[13:8], a[7:0], count - 1, [data * count], cksum
+#
+# A burst performs count accesses to consecutive addresses starting at a;
+# data bytes are only sent for writes.
 
 # transactions into 
 class BusDecode(Module):
@@ -27,12 +37,23 @@ class BusDecode(Module):
         self.sync += token.eq(token_next)
         self.comb += token_next.eq(token)
 
-
+        # Accesses left in the current burst after this one
+        remaining = Signal(8)
+        remaining_next = Signal(8)
+        self.sync += remaining.eq(remaining_next)
+        self.comb += remaining_next.eq(remaining)
 
         sm.act("IDLE",
                 self.sink.ack.eq(1),
                 If(self.sink.stb,
-                    If(self.sink.payload.d == 0x55,
+                    If(self.sink.payload.d == CMD_MAGIC,
+                        token_next.burst.eq(0),
+                        token_next.first.eq(1),
+                        token_next.last.eq(1),
+                        NextState("ADRH")
+                    ).Elif(self.sink.payload.d == CMD_MAGIC_BURST,
+                        token_next.burst.eq(1),
+                        token_next.first.eq(1),
                         NextState("ADRH")
                     )))
 
@@ -48,13 +69,30 @@ class BusDecode(Module):
                 token_next.wr.eq(self.sink.payload.d[7]), 
                 token_next.a[8:14].eq(self.sink.payload.d[:6]))
 
-        parse_state('ADRL', 'DATA',  token_next.a[0:8].eq(self.sink.payload.d)),
+        sm.act('ADRL',
+                self.sink.ack.eq(1),
+                If(self.sink.stb,
+                    token_next.a[0:8].eq(self.sink.payload.d),
+                    If(token.burst,
+                        NextState('COUNT')
+                    ).Else(
+                        NextState('DATA')
+                    )))
+
         parse_state('DATA', 'CKSUM', token_next.d.eq(self.sink.payload.d)),
 
         sm.act("CKSUM",
                 self.sink.ack.eq(1),
                 If(self.sink.stb,
+                    If(token.burst,
+                        If(token.wr,
+                            NextState('IDLE')
+                        ).Else(
+                            NextState('BURST_ISSUE')
+                        )
+                    ).Else(
                         NextState('ISSUE')
+                    )
                 )    
         )
 
@@ -62,8 +100,48 @@ class BusDecode(Module):
                 self.source.stb.eq(1),
                 If(self.source.ack,
                     NextState('IDLE')))
-                    
 
+        # Burst reads issue everything after the checksum, burst writes issue
+        # each access as its data byte arrives and take the checksum last
+        sm.act("COUNT",
+                self.sink.ack.eq(1),
+                If(self.sink.stb,
+                    token_next.count.eq(self.sink.payload.d),
+                    token_next.last.eq(self.sink.payload.d == 0),
+                    remaining_next.eq(self.sink.payload.d),
+                    If(token.wr,
+                        NextState('BURST_DATA')
+                    ).Else(
+                        NextState('CKSUM')
+                    )))
+
+        parse_state('BURST_DATA', 'BURST_ISSUE', token_next.d.eq(self.sink.payload.d))
+
+        sm.act("BURST_ISSUE",
+                self.source.stb.eq(1),
+                If(self.source.ack,
+                    token_next.a.eq(token.a + 1),
+                    token_next.first.eq(0),
+                    token_next.last.eq(remaining == 1),
+                    remaining_next.eq(remaining - 1),
+                    If(remaining == 0,
+                        If(token.wr,
+                            NextState('CKSUM')
+                        ).Else(
+                            NextState('IDLE')
+                        )
+                    ).Elif(token.wr,
+                        NextState('BURST_DATA')
+                    )))
+
+
+# Responses mirror the commands:
+#
+# Single access:  0x55, wr << 7 | a[13:8], a[7:0], data, cksum
+# Burst access:   0x56, wr << 7 | a[13:8], a[7:0], count - 1, [data * count], cksum
+#
+# A burst response is sent as one packet, the interleaver does not switch to
+# another source until the checksum.
 class BusEncode(Module):
     def __init__(self):
 
@@ -91,33 +169,38 @@ class BusEncode(Module):
                 If(self.sink.stb,
                     self.sink.ack.eq(1),
                     token_next.eq(self.sink.payload),
-                    NextState('c0')))
-
-        _outs = [
-            0x55,
-            Cat(token.a[8:14], 0, token.wr),
-            token.a[0:8],
-            token.d,
-            ssum
-            ]
-
-        s = _outs[0]
-        for i in _outs[1:-1]:
-            s = s + i
-        self.sync += ssum.eq(s)
+                    If(self.sink.payload.first,
+                        NextState('MAGIC')
+                    ).Else(
+                        NextState('DATA')
+                    )))
 
+        # Running checksum over every byte of the response
+        self.sync += If(self.source.stb & self.source.ack,
+                If(self.source.payload.last,
+                    ssum.eq(0)
+                ).Else(
+                    ssum.eq(ssum + self.source.payload.d)
+                ))
 
-        for c, v in enumerate(_outs):
-            _last = 1 if c == len(_outs) - 1 else 0
-            _next = "IDLE" if _last else "c%d" % (c + 1)
-            sm.act("c%d" % c,
+        def emit(st, v, to, last=0):
+            sm.act(st,
                     self.source.stb.eq(1),
                     self.source.payload.d.eq(v),
-                    self.source.payload.last.eq(_last),
+                    self.source.payload.last.eq(last),
                     If(self.source.ack,
-                        NextState(_next)
+                        to
                         ))
 
+        emit("MAGIC", Mux(token.burst, CMD_MAGIC_BURST, CMD_MAGIC), NextState("ADRH"))
+        emit("ADRH", Cat(token.a[8:14], 0, token.wr), NextState("ADRL"))
+        emit("ADRL", token.a[0:8],
+                If(token.burst, NextState("COUNT")).Else(NextState("DATA")))
+        emit("COUNT", token.count, NextState("DATA"))
+        emit("DATA", token.d,
+                If(token.last, NextState("CKSUM")).Else(NextState("IDLE")))
+        emit("CKSUM", ssum, NextState("IDLE"), last=1)
+
 
 class BusInterleave(Module):
     def __init__(self, mux_ports):
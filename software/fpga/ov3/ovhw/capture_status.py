@@ -0,0 +1,128 @@
+from migen import *
+from migen.genlib.cdc import BusSynchronizer
+from migen.genlib.fsm import FSM, NextState
+from misoc.interconnect.csr import AutoCSR, CSRStatus, CSRStorage
+from misoc.interconnect.stream import Endpoint
+
+from ovhw.constants import STATUS_MAGIC, SYS_CLK_PER_US
+
+# Capture health snapshot
+#
+# Writing LATCH copies the ring pointers, wrap count, overflow counters and
+# the capture timestamp into the status registers below in a single cycle.
+# The overflow counters come from the ULPI clock domain through a bus
+# synchronizer, so they lag the pointers and timestamp by a few cycles.
+# The status registers are contiguous, so the host can fetch the snapshot
+# with one burst read instead of polling each block separately.
+#
+# With INTERVAL (in microseconds) non-zero, the same snapshot is also pushed
+# to the host periodically as a status record through the command
+# interleaver:
+#
+#   STATUS_MAGIC, length, wptr, rptr, wrap_count, num_ovf, num_total, ts
+#
+# length counts the bytes after it; fields are big endian, 4 bytes each
+# except the 8 byte timestamp.
+class CaptureStatus(Module, AutoCSR):
+    def __init__(self, sdram_sink, ovf_insert, cstream, ovf_domain="ulpi"):
+        self._latch = CSRStorage(1)
+
+        self._wptr = CSRStatus(len(sdram_sink.wptr))
+        self._rptr = CSRStatus(len(sdram_sink.rptr))
+        self._wrap_count = CSRStatus(32)
+        self._num_ovf = CSRStatus(32)
+        self._num_total = CSRStatus(32)
+        self._ts = CSRStatus(64)
+
+        self._interval = CSRStorage(24)
+
+        self.source = Endpoint([('d', 8), ('last', 1)])
+
+        # The overflow inserter runs in the ULPI clock domain
+        num_ovf = BusSynchronizer(32, ovf_domain, "sys")
+        num_total = BusSynchronizer(32, ovf_domain, "sys")
+        self.submodules += num_ovf, num_total
+
+        self.comb += [
+                num_ovf.i.eq(ovf_insert._num_ovf.acc.v),
+                num_total.i.eq(ovf_insert._num_total.acc.v),
+                ]
+
+        fields = [
+                (sdram_sink.wptr, 32),
+                (sdram_sink.rptr, 32),
+                (sdram_sink._wrap_count.acc.v, 32),
+                (num_ovf.o, 32),
+                (num_total.o, 32),
+                (cstream.producer.ulpi_sink.payload.ts, 64),
+                ]
+
+        self.sync += If(self._latch.re,
+                self._wptr.status.eq(sdram_sink.wptr),
+                self._rptr.status.eq(sdram_sink.rptr),
+                self._wrap_count.status.eq(sdram_sink._wrap_count.acc.v),
+                self._num_ovf.status.eq(num_ovf.o),
+                self._num_total.status.eq(num_total.o),
+                self._ts.status.eq(cstream.producer.ulpi_sink.payload.ts),
+                )
+
+        # Periodic tick, every INTERVAL microseconds
+
+        prescale = Signal(max=SYS_CLK_PER_US)
+        us_tick = Signal()
+        self.sync += If(prescale == SYS_CLK_PER_US - 1,
+                prescale.eq(0)
+            ).Else(
+                prescale.eq(prescale + 1)
+            )
+        self.comb += us_tick.eq(prescale == 0)
+
+        interval = self._interval.storage
+        count = Signal(len(interval))
+        tick = Signal()
+        self.comb += tick.eq(us_tick & (interval != 0) & (count == interval - 1))
+        self.sync += If(interval == 0,
+                count.eq(0)
+            ).Elif(us_tick,
+                If(count >= interval - 1,
+                    count.eq(0)
+                ).Else(
+                    count.eq(count + 1)
+                ))
+
+        # Status record, captured on the tick and sent MSB first. The record
+        # has its own copy of the fields so that a host LATCH can't change
+        # it halfway through.
+
+        record = [Signal(w) for _, w in fields]
+        self.sync += If(tick & ~self.source.stb,
+                [r.eq(v) for r, (v, _) in zip(record, fields)])
+
+        record_bytes = [STATUS_MAGIC, sum(w for _, w in fields) // 8]
+        for r in record:
+            record_bytes += [r[i:i+8] for i in reversed(range(0, len(r), 8))]
+
+        idx = Signal(max=len(record_bytes))
+
+        self.submodules.fsm = FSM()
+        self.fsm.act("IDLE",
+                If(tick,
+                    NextState("SEND")
+                ))
+
+        self.fsm.act("SEND",
+                self.source.stb.eq(1),
+                self.source.payload.d.eq(Array(record_bytes)[idx]),
+                self.source.payload.last.eq(idx == len(record_bytes) - 1),
+                If(self.source.ack,
+                    If(idx == len(record_bytes) - 1,
+                        NextState("IDLE")
+                    )
+                ))
+
+        self.sync += If(self.source.stb & self.source.ack,
+                If(self.source.payload.last,
+                    idx.eq(0)
+                ).Else(
+                    idx.eq(idx + 1)
+                ))
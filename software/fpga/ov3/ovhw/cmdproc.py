@@ -1,12 +1,18 @@
 from migen import *
+from misoc.interconnect.csr import AutoCSR, CSRStatus
 
 from ovhw.bus_interleave import BusDecode, BusEncode, BusInterleave
 from ovhw.csr_master import CSR_Master
 
+# Bits in the features register, so the host can tell which commands the
+# loaded gateware understands
+FEATURE_BURST = 0x01
+
 # CmdProc (perhaps misnamed) handles command parsing on the ftdi interface
 # inserting cmd responses, and multiplexing the cmd responses with the streaming data
-class CmdProc(Module):
+class CmdProc(Module, AutoCSR):
     def __init__(self, ftdi_sync, streaming_sources):
+        self._features = CSRStatus(8, reset=FEATURE_BURST)
 
         # CSR Command Decoding
         bdec = BusDecode()
@@ -34,6 +34,18 @@ FLUSH_TIMEOUT = 10000000
 FILLER_MAGIC = 0xA1
 FILLER_TIMEOUT = FLUSH_TIMEOUT//2
 
+# Periodic capture status record, see ovhw/capture_status.py
+STATUS_MAGIC = 0xC0
+
+# Queued ULPI register access completion, see ovhw/ulpicfg.py
+ULPI_EVENT_MAGIC = 0xC1
+
+# Sequence numbered loopback test packet, see ovhw/ftdi_lfsr_test.py
+SEQTEST_MAGIC = 0xAB
+
+# System clock ticks per microsecond
+SYS_CLK_PER_US = 100
+
 #  Physical layer error
 HF0_ERR =  0x01
 
@@ -52,3 +64,6 @@ HF0_FIRST = 0x10
 # Last packet of capture session; IE, when the cap hardware was disabled
 HF0_LAST = 0x20
 
+# Latency marker requested by the host, see Whacker MARKER
+HF0_MARKER = 0x40
+
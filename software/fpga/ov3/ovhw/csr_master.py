@@ -13,7 +13,10 @@ from misoc.interconnect.csr_bus import Interface
 # 
 # Trans_complete
 
-CMD_REC = [('wr', 1), ('a', 14), ('d', 8)]
+# burst, first, last and count describe the position of an access within a
+# burst command; for single accesses first = last = 1
+CMD_REC = [('wr', 1), ('a', 14), ('d', 8),
+           ('burst', 1), ('first', 1), ('last', 1), ('count', 8)]
 class CSR_Master(Module):
     def __init__(self, has_completion=True):
         self.cmd = Endpoint(CMD_REC)
@@ -37,6 +40,10 @@ class CSR_Master(Module):
             self.sync += If(self.cmd.ack, 
                     self.completion.payload.a.eq(self.cmd.payload.a),
                     self.completion.payload.wr.eq(self.cmd.payload.wr),
+                    self.completion.payload.burst.eq(self.cmd.payload.burst),
+                    self.completion.payload.first.eq(self.cmd.payload.first),
+                    self.completion.payload.last.eq(self.cmd.payload.last),
+                    self.completion.payload.count.eq(self.cmd.payload.count),
                     If(self.cmd.payload.wr,
                         self.completion.payload.d.eq(self.master.dat_w))
                     )
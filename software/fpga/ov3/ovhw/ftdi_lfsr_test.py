@@ -1,15 +1,33 @@
 # Module for generating a pseudorandom bitstream for testing data backhaul from FTDI chip
 # Packets are of form 0xAA n* rand
+#
+# In sequence mode (cfg bit 1) it instead produces packets of the form
+#   0xAB size[16] seq[32] sent[32] size* payload
+# (fields MSB first) for measuring sustained bandwidth and loss: packets
+# are produced at a fixed rate of one payload byte every div + 1 clocks,
+# whether or not the host keeps up. A packet produced while the previous one
+# is still being sent is dropped, as capture data would be on overflow, but
+# still takes a sequence number. 'sent' counts the bytes handed to the FTDI
+# before the packet, so the host also sees bytes lost on its side.
 
 from migen import *
 from misoc.interconnect.csr import AutoCSR, CSRStorage
 from migen.genlib.fsm import FSM, NextState
 from misoc.interconnect.stream import Endpoint
 
+from ovhw.constants import SEQTEST_MAGIC
+
+CFG_ENABLE = 0x01
+CFG_SEQUENCE = 0x02
+
 class FTDI_randtest(Module, AutoCSR):
     def __init__(self):
         self._size = CSRStorage(8, reset=8)
-        self._cfg = CSRStorage(1, reset=0)
+        self._cfg = CSRStorage(2, reset=0)
+
+        # Sequence mode payload size (nonzero) and production rate divider
+        self._seq_size = CSRStorage(16, reset=4096)
+        self._seq_div = CSRStorage(8, reset=0)
 
         self.source = Endpoint([('d', 8), ('last', 1)])
 
@@ -36,8 +54,78 @@ class FTDI_randtest(Module, AutoCSR):
 
         self.submodules.fsm = FSM()
 
+        enable = self._cfg.storage[0]
+        sequence = self._cfg.storage[1]
+
+        # Sequence mode packet production, independent of the sender
+
+        div = Signal(8)
+        prod_pos = Signal(16)
+        produced = Signal()
+        seq = Signal(32)
+        self.comb += produced.eq(enable & sequence & (div == 0) & (prod_pos == self._seq_size.storage - 1))
+        self.sync += If(~enable | ~sequence,
+                div.eq(0),
+                prod_pos.eq(0),
+                seq.eq(0)
+            ).Elif(div != 0,
+                div.eq(div - 1)
+            ).Else(
+                div.eq(self._seq_div.storage),
+                If(produced,
+                    prod_pos.eq(0),
+                    seq.eq(seq + 1)
+                ).Else(
+                    prod_pos.eq(prod_pos + 1)
+                ))
+
+        sent = Signal(32)
+        self.sync += If(~enable | ~sequence,
+                sent.eq(0)
+            ).Elif(self.source.stb & self.source.ack,
+                sent.eq(sent + 1))
+
+        # Header of the packet being sent, latched when it starts
+        seq_size = Signal(16)
+        seq_seq = Signal(32)
+        seq_sent = Signal(32)
+        header = [SEQTEST_MAGIC]
+        for v in [seq_size, seq_seq, seq_sent]:
+            header += [v[i:i+8] for i in reversed(range(0, len(v), 8))]
+
+        hdr_idx = Signal(max=len(header))
+        data_count = Signal(16)
+
         self.fsm.act("IDLE", 
-                If(self._cfg.storage[0], NextState("SEND_HEAD")))
+                If(enable & ~sequence, NextState("SEND_HEAD")),
+                If(produced, NextState("SEQ_HEAD")))
+
+        self.sync += If(self.fsm.ongoing("IDLE") & produced,
+                seq_size.eq(self._seq_size.storage),
+                seq_seq.eq(seq),
+                seq_sent.eq(sent),
+                hdr_idx.eq(0),
+                data_count.eq(0)
+            ).Elif(self.source.stb & self.source.ack,
+                If(self.fsm.ongoing("SEQ_HEAD"),
+                    hdr_idx.eq(hdr_idx + 1)),
+                If(self.fsm.ongoing("SEQ_DATA"),
+                    data_count.eq(data_count + 1)))
+
+        self.fsm.act("SEQ_HEAD",
+                self.source.payload.d.eq(Array(header)[hdr_idx]),
+                self.source.stb.eq(1),
+                If(self.source.ack & (hdr_idx == len(header) - 1),
+                    NextState("SEQ_DATA")))
+
+        # The payload is just the low byte of its offset in the packet
+        self.fsm.act("SEQ_DATA",
+                self.source.payload.d.eq(data_count),
+                self.source.stb.eq(1),
+                If(data_count + 1 == seq_size,
+                    self.source.payload.last.eq(1)),
+                If(self.source.ack & (data_count + 1 == seq_size),
+                    NextState("IDLE")))
 
         self.fsm.act("SEND_HEAD", 
                 self.source.payload.d.eq(0xAA),
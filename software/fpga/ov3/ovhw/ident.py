@@ -0,0 +1,12 @@
+from migen import *
+from misoc.interconnect.csr import AutoCSR, CSRStatus
+
+# Build identification
+#
+# BUILD_ID is a constant chosen when the bitstream is built and recorded in
+# the register map (as the reset value of the register) in the same firmware
+# package. The host reads it back to tell whether the FPGA is still running
+# the packaged bitstream, and can skip reconfiguring it if so. 0 means no ID.
+class Ident(Module, AutoCSR):
+    def __init__(self, build_id=0):
+        self._build_id = CSRStatus(32, reset=build_id)
@@ -23,11 +23,13 @@ from ovhw.cfilt import RXCmdFilter
 from ovhw.ov_types import ULPI_DATA_D
 from ovhw.sdram_host_read import SDRAM_Host_Read
 from ovhw.sdram_sink import SDRAM_Sink
+from ovhw.capture_status import CaptureStatus
+from ovhw.ident import Ident
 import ovplatform.sdram_params
 
 # Top level platform module
 class OV3(Module):
-    def __init__(self, plat):
+    def __init__(self, plat, build_id=0):
         # Clocking
 
         clk_ref = plat.request("clk12") # 12mhz reference clock from which all else is derived
@@ -113,10 +115,15 @@ class OV3(Module):
         self.submodules.ftdi_bus = ftdi_bus = FTDI_sync245(self.clockgen.cd_sys.rst,
                 ftdi_io)
 
+        # Capture health snapshot for host monitoring, also pushed
+        # periodically into the host stream
+        self.submodules.capture_status = CaptureStatus(self.sdram_sink,
+                self.ovf_insert, self.cstream)
+
         # FTDI command processor
         self.submodules.randtest = FTDI_randtest()
         self.submodules.cmdproc = CmdProc(self.ftdi_bus,
-                [self.randtest, self.sdram_host_read])
+                [self.randtest, self.sdram_host_read, self.capture_status, self.ucfg])
 
         # GPIOs (leds/buttons)
         self.submodules.leds = LED_outputs(plat.request('leds'),
@@ -128,6 +135,9 @@ class OV3(Module):
 
         self.submodules.buttons = BTN_status(~plat.request('btn'))
 
+        # Build ID, so the host can tell which bitstream is loaded
+        self.submodules.ident = Ident(build_id)
+
 
         # Bind all device CSRs
         self.csr_map = {
@@ -140,6 +150,9 @@ class OV3(Module):
                 'sdram_host_read' : 6,
                 'sdram_sink' : 7,
                 'ovf_insert' : 8,
+                'cmdproc' : 9,
+                'capture_status' : 10,
+                'ident' : 11,
                 }
 
         self.submodules.csrbankarray = CSRBankArray(self,
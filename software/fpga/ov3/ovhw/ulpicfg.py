@@ -1,6 +1,14 @@
 from migen import *
 from migen.genlib.cdc import MultiReg
+from migen.genlib.fifo import SyncFIFO
+from migen.genlib.fsm import FSM, NextState
 from misoc.interconnect.csr import CSR, CSRStorage, CSRStatus, AutoCSR
+from misoc.interconnect.stream import Endpoint
+
+from ovhw.constants import ULPI_EVENT_MAGIC
+
+# Queued accesses the host may have outstanding
+ULPI_QUEUE_DEPTH = 16
 
 class _ULPI_cmd_reg(Module, CSR):
     B_GO = 7
@@ -25,6 +33,18 @@ class _ULPI_cmd_reg(Module, CSR):
 
         self.comb += self.w.eq(Cat(self.addr, self.ack, self.trig))
 
+class _ULPI_queue_reg(Module, CSR):
+    B_WRITE = 7
+
+    def __init__(self, fifo, wdata):
+        CSR.__init__(self, size=8)
+
+        self.comb += [
+                fifo.we.eq(self.re),
+                fifo.din.eq(Cat(self.r[0:6], self.r[self.B_WRITE], wdata)),
+                self.w.eq(fifo.level),
+                ]
+
 class ULPICfg(Module, AutoCSR):
     def __init__(self, clk, cd_rst, ulpi_rst, ulpi_stp_ovr, ulpi_reg):
 
@@ -106,13 +126,109 @@ class ULPICfg(Module, AutoCSR):
         # To read: write ULPI_RCMD with GO | addr, poll 
         # until GO clear, then read ULPI_RDATA
 
+        # The accesses are done either by the xCMD registers or by the
+        # queue below, whichever is requesting
+        wreq, rreq = Signal(), Signal()
+        waddr, raddr = Signal(6), Signal(6)
+
         self._wdata = CSRStorage(8)
-        self._wcmd = _ULPI_cmd_reg(ulpi_reg.wreq, ulpi_reg.wack, ulpi_reg.waddr)
+        self._wcmd = _ULPI_cmd_reg(wreq, ulpi_reg.wack, waddr)
         self.submodules += self._wcmd
-        self.comb += ulpi_reg.wdata.eq(self._wdata.storage)
 
         self._rdata = CSRStatus(8)
-        self._rcmd = _ULPI_cmd_reg(ulpi_reg.rreq, ulpi_reg.rack, ulpi_reg.raddr)
+        self._rcmd = _ULPI_cmd_reg(rreq, ulpi_reg.rack, raddr)
         self.submodules += self._rcmd
         self.sync += If(ulpi_reg.rack,
                 self._rdata.status.eq(ulpi_reg.rdata))
+
+        # ULPI_QCMD register
+        #
+        # Queues a ULPI register access, completed in order without host
+        # polling. Each completion is pushed to the host through the command
+        # interleaver as an event:
+        #
+        #   ULPI_EVENT_MAGIC, W 0 UA5..UA0, DATA
+        #
+        # DATA is the value read, or for writes the value written.
+        #
+        # Format:
+        #
+        #    7    6    5    4    3    2    1    0
+        #    ----------------------------------------
+        #    W    0    UA5  UA4  UA3  UA2  UA1  UA0
+        #
+        # W: 1 to write UCFG_WDATA (as it is when QCMD is written), 0 to read
+        #
+        # Reads back the number of accesses queued. At most ULPI_QUEUE_DEPTH
+        # may be outstanding, and the xCMD registers must not be used while
+        # any are.
+
+        queue = SyncFIFO(15, ULPI_QUEUE_DEPTH)
+        self.submodules += queue
+
+        self._qcmd = _ULPI_queue_reg(queue, self._wdata.storage)
+        self.submodules += self._qcmd
+
+        self.source = Endpoint([('d', 8), ('last', 1)])
+
+        q_busy = Signal()
+        q_write = Signal()
+        q_addr = Signal(6)
+        q_data = Signal(8)
+
+        # The acks come from the ULPI clock domain
+        wack, rack = Signal(), Signal()
+        self.specials += MultiReg(ulpi_reg.wack, wack)
+        self.specials += MultiReg(ulpi_reg.rack, rack)
+
+        self.comb += [
+                ulpi_reg.wreq.eq(wreq | (q_busy & q_write)),
+                ulpi_reg.rreq.eq(rreq | (q_busy & ~q_write)),
+                ulpi_reg.waddr.eq(Mux(q_busy, q_addr, waddr)),
+                ulpi_reg.raddr.eq(Mux(q_busy, q_addr, raddr)),
+                ulpi_reg.wdata.eq(Mux(q_busy, q_data, self._wdata.storage)),
+                ]
+
+        ack = Signal()
+        self.comb += ack.eq(Mux(q_write, wack, rack))
+
+        self.submodules.fsm = FSM()
+        self.fsm.act("IDLE",
+                queue.re.eq(1),
+                If(queue.readable,
+                    NextState("ACCESS")
+                ))
+
+        self.sync += If(self.fsm.ongoing("IDLE") & queue.readable,
+                q_addr.eq(queue.dout[0:6]),
+                q_write.eq(queue.dout[6]),
+                q_data.eq(queue.dout[7:15]),
+                )
+
+        # Request until acked, then wait for the ack to drop again so it
+        # can't be taken for the next access's
+        self.fsm.act("ACCESS",
+                q_busy.eq(1),
+                If(ack,
+                    NextState("RELEASE")
+                ))
+
+        self.sync += If(self.fsm.ongoing("ACCESS") & ack & ~q_write,
+                q_data.eq(ulpi_reg.rdata))
+
+        self.fsm.act("RELEASE",
+                If(~ack,
+                    NextState("MAGIC")
+                ))
+
+        for state, value, next_state in [
+                ("MAGIC", ULPI_EVENT_MAGIC, "ADDR"),
+                ("ADDR", Cat(q_addr, 0, q_write), "DATA"),
+                ("DATA", q_data, "IDLE")]:
+            self.fsm.act(state,
+                    self.source.stb.eq(1),
+                    self.source.payload.d.eq(value),
+                    self.source.payload.last.eq(state == "DATA"),
+                    If(self.source.ack,
+                        NextState(next_state)
+                    ))
@@ -9,7 +9,7 @@ from ovhw.whacker.util import *
 
 class Producer(Module):
 
-    def __init__(self, wrport, depth, consume_watermark, ena, la_filters=[]):
+    def __init__(self, wrport, depth, consume_watermark, ena, la_filters=[], marker=0):
         self.ulpi_sink = Endpoint(ULPI_DATA_TAG)
 
         self.out_addr = Endpoint(dmatpl(depth))
@@ -29,6 +29,7 @@ class Producer(Module):
         self.submodules.flag_last = Acc(1)
         self.submodules.flag_ovf = Acc(1)
         self.submodules.flag_err = Acc(1)
+        self.submodules.flag_marker = Acc(1)
 
         self.submodules.to_start = Acc(1)
 
@@ -73,6 +74,23 @@ class Producer(Module):
             self.packet_last.set(1)).Elif(clear_acc_flags,
             self.packet_last.set(0))
 
+        # Markers requested while capturing and not sent yet. Each goes out
+        # as an empty packet of its own between two captured ones, after
+        # the start of capture one.
+        clear_marker = Signal()
+        request_marker = Signal()
+        self.comb += request_marker.eq(marker & ena)
+        markers_pending = Signal(4)
+        self.sync += If(request_marker & ~clear_marker & (markers_pending != 15),
+                markers_pending.eq(markers_pending + 1)
+            ).Elif(clear_marker & ~request_marker,
+                markers_pending.eq(markers_pending - 1)
+            )
+
+        # Not when an SOP was already taken in DATA, its timestamp is waiting
+        send_marker = Signal()
+        self.comb += send_marker.eq((markers_pending != 0) & ~self.packet_first.v & ~self.to_start.v)
+
         # Combine outputs of filters
         la_resets = [f.reset.eq(1) for f in la_filters]
         filter_done = 1
@@ -82,7 +100,22 @@ class Producer(Module):
             filter_reject = f.reject | filter_reject
 
         self.fsm.act("IDLE",
-                If(
+                If(send_marker & has_space,
+                    self.produce_write.set(self.produce_header.v),
+                    self.pid.set(0),
+                    self.pid_valid.set(0),
+                    self.discard.set(0),
+                    self.size.set(0),
+                    self.flag_first.set(0),
+                    self.flag_last.set(0),
+                    self.flag_ovf.set(0),
+                    self.flag_err.set(0),
+                    self.flag_marker.set(1),
+
+                    grab_timestamp.eq(1),
+                    NextState("waitdone")
+
+                ).Elif(
                     ((self.ulpi_sink.stb | self.to_start.v) & ena 
                      | stuff_packet) & has_space,
 
@@ -100,6 +133,7 @@ class Producer(Module):
                     self.flag_last.set(self.packet_last.v),
                     self.flag_ovf.set(0),
                     self.flag_err.set(0),
+                    self.flag_marker.set(0),
                     self.to_start.set(0),
 
                     la_resets,
@@ -180,6 +214,7 @@ class Producer(Module):
 
         self.fsm.act("waitdone",
             clear_acc_flags.eq(self.flag_first.v | self.flag_last.v),
+            clear_marker.eq(self.flag_marker.v),
             NextState("SEND")
         )
 
@@ -193,6 +228,7 @@ class Producer(Module):
             self.out_addr.payload.flag_last.eq(self.flag_last.v),
             self.out_addr.payload.flag_ovf.eq(self.flag_ovf.v),
             self.out_addr.payload.flag_err.eq(self.flag_err.v),
+            self.out_addr.payload.flag_marker.eq(self.flag_marker.v),
             self.out_addr.payload.start.eq(self.produce_header.v),
             self.out_addr.payload.count.eq(self.size.v),
             If(self.out_addr.ack,
@@ -34,7 +34,9 @@ class Whacker(Module, AutoCSR):
         self.submodules.consumer = Consumer(rdport, depth, self._cfg.storage[1])
         self.submodules.filter_nak = FilterNAK(depth, self._cfg.storage[2])
         self.submodules.filter_sof = FilterSOF(depth, self._cfg.storage[3])
-        self.submodules.producer = Producer(wrport, depth, self.consumer.pos, self._cfg.storage[0])
+        marker = Signal()
+        self.submodules.producer = Producer(wrport, depth, self.consumer.pos, self._cfg.storage[0],
+                                            marker=marker)
 
         self.submodules.pkt_fifo = SyncFIFO(dmatpl(depth), 8)
 
@@ -47,6 +49,31 @@ class Whacker(Module, AutoCSR):
         ]
         self.source = self.consumer.source
 
+        # Timestamp correlation
+        #
+        # Writing TS_SNAPSHOT latches the free-running capture timestamp into
+        # TS. START_TS holds the timestamp of the first (stuffed) packet of
+        # the current capture session, so TS - START_TS is on the same scale
+        # as the timestamps the host reconstructs from the packet deltas.
+        self._ts_snapshot = CSRStorage(1)
+        self._ts = CSRStatus(64)
+        self._start_ts = CSRStatus(64)
+
+        # Writing MARKER while capturing injects an empty packet flagged
+        # HF0_MARKER, for measuring how long captured data takes to reach
+        # the host. It is sent, and timestamped, as soon as the producer is
+        # between packets, so at most one packet after the write.
+        self._marker = CSRStorage(1)
+        self.comb += marker.eq(self._marker.re)
+
+        self.sync += [
+                If(self._ts_snapshot.re,
+                    self._ts.status.eq(self.producer.ulpi_sink.payload.ts)),
+                If(self.producer.out_addr.stb & self.producer.out_addr.ack &
+                        self.producer.out_addr.payload.flag_first,
+                    self._start_ts.status.eq(self.producer.out_addr.payload.ts))
+                ]
+
         # Debug signals for state tracing
         if debug_signals:
             self._cons_lo = CSRStatus(8)
@@ -0,0 +1,144 @@
+from migen import *
+from misoc.interconnect.csr_bus import CSRBank
+from migen.sim import run_simulation
+
+from ovhw.capture_status import CaptureStatus
+from ovhw.constants import STATUS_MAGIC, SYS_CLK_PER_US
+from ovhw.whacker.util import Acc_inc
+
+import unittest
+
+
+class _Counter(Module):
+    def __init__(self):
+        self.submodules.acc = Acc_inc(32)
+
+class _Stub:
+    pass
+
+class TestBench(Module):
+    def __init__(self):
+        self.sink = _Stub()
+        self.sink.wptr = Signal(25)
+        self.sink.rptr = Signal(25)
+        self.submodules.wrap_count = self.sink._wrap_count = _Counter()
+
+        self.ovf = _Stub()
+        self.submodules.num_ovf = self.ovf._num_ovf = _Counter()
+        self.submodules.num_total = self.ovf._num_total = _Counter()
+
+        self.ts = Signal(64)
+        self.cstream = _Stub()
+        self.cstream.producer = _Stub()
+        self.cstream.producer.ulpi_sink = _Stub()
+        self.cstream.producer.ulpi_sink.payload = _Stub()
+        self.cstream.producer.ulpi_sink.payload.ts = self.ts
+
+        self.submodules.cs = CaptureStatus(self.sink, self.ovf, self.cstream, ovf_domain="sys")
+        self.submodules.csr = CSRBank(self.cs.get_csrs())
+
+        self.registers = {}
+        offset = 0
+        for csr in self.cs.get_csrs():
+            self.registers[csr.name.upper()] = offset, (csr.size + 7) // 8
+            offset += (csr.size + 7) // 8
+
+    def rd(self, name):
+        addr, size = self.registers[name]
+        v = 0
+        for i in range(size):
+            v = v << 8 | (yield from self.csr.bus.read(addr + i))
+        return v
+
+
+class CaptureStatusTests(unittest.TestCase):
+    def setUp(self):
+        self.tb = TestBench()
+
+    def test_window_is_contiguous(self):
+        addrs = sorted(self.tb.registers.values())
+        self.assertEqual(addrs[0], (0, 1))
+        for (a, n), (b, _) in zip(addrs, addrs[1:]):
+            self.assertEqual(a + n, b)
+
+    def test_latch(self):
+        tb = self.tb
+
+        def gen():
+            yield tb.sink.wptr.eq(0x123456)
+            yield tb.sink.rptr.eq(0x100000)
+            yield tb.ts.eq(0x1122334455667788)
+            yield from tb.wrap_count.acc.set(3)
+            yield from tb.num_ovf.acc.set(5)
+            yield from tb.num_total.acc.set(0x10000)
+            yield
+            yield tb.wrap_count.acc._s.eq(0)
+            yield tb.num_ovf.acc._s.eq(0)
+            yield tb.num_total.acc._s.eq(0)
+
+            # Let the counters cross the synchronizers
+            for i in range(20):
+                yield
+
+            # Nothing is visible before the latch
+            self.assertEqual((yield from tb.rd("WPTR")), 0)
+
+            yield from tb.csr.bus.write(tb.registers["LATCH"][0], 1)
+            yield
+            yield
+
+            # Values move on after the latch
+            yield tb.sink.wptr.eq(0)
+            yield tb.ts.eq(0)
+
+            self.assertEqual((yield from tb.rd("WPTR")), 0x123456)
+            self.assertEqual((yield from tb.rd("RPTR")), 0x100000)
+            self.assertEqual((yield from tb.rd("WRAP_COUNT")), 3)
+            self.assertEqual((yield from tb.rd("NUM_OVF")), 5)
+            self.assertEqual((yield from tb.rd("NUM_TOTAL")), 0x10000)
+            self.assertEqual((yield from tb.rd("TS")), 0x1122334455667788)
+
+        run_simulation(self.tb, gen())
+
+    def test_record(self):
+        tb = self.tb
+        record = []
+
+        def gen():
+            yield tb.sink.wptr.eq(0x123456)
+            yield tb.sink.rptr.eq(0x100000)
+            yield tb.ts.eq(0x1122334455667788)
+            yield from tb.wrap_count.acc.set(3)
+            yield
+            yield tb.wrap_count.acc._s.eq(0)
+
+            # Nothing is sent while the interval is zero
+            for i in range(3 * SYS_CLK_PER_US):
+                self.assertEqual((yield tb.cs.source.stb), 0)
+                yield
+
+            addr, size = tb.registers["INTERVAL"]
+            yield from tb.csr.bus.write(addr + size - 1, 2)
+
+            for i in range(4 * SYS_CLK_PER_US):
+                yield tb.cs.source.ack.eq(i % 3 != 0)
+                yield
+                if (yield tb.cs.source.stb) and (yield tb.cs.source.ack):
+                    record.append(((yield tb.cs.source.payload.d),
+                                   (yield tb.cs.source.payload.last)))
+                    if record[-1][1]:
+                        break
+
+        run_simulation(self.tb, gen())
+
+        data = bytes(d for d, _ in record)
+        self.assertEqual([l for _, l in record], [0] * (len(record) - 1) + [1])
+        self.assertEqual(data[0], STATUS_MAGIC)
+        self.assertEqual(data[1], len(data) - 2)
+        self.assertEqual(data[2:], bytes.fromhex(
+            "00123456" "00100000" "00000003" "00000000" "00000000"
+            "1122334455667788"))
+
+
+if __name__ == '__main__':
+    unittest.main()
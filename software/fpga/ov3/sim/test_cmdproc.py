@@ -88,6 +88,88 @@ class TestCmdproc(unittest.TestCase):
 
         self.sim = run_simulation(self.tb, [gen(), collector()], vcd_name="test_cmdproc.vcd")
 
+    def _run_commands(self, cmd, cycles):
+        """
+        Feed cmd to the command processor, with CSR reads returning the low
+        address byte, and return (write accesses, responses). Responses are
+        picked out of the output stream by skipping the dummy sources' packets.
+        """
+        write_transactions = []
+        output = []
+
+        def csr():
+            yield "passive"
+            while 1:
+                if (yield self.tb.cm.master.we):
+                    write_transactions.append(((yield self.tb.cm.master.adr), (yield self.tb.cm.master.dat_w)))
+                yield self.tb.cm.master.dat_r.eq((yield self.tb.cm.master.adr) & 0xFF)
+                yield
+
+        def out():
+            yield "passive"
+            while 1:
+                if (yield self.tb.ff.output_fifo.we):
+                    output.append((yield self.tb.ff.output_fifo.din))
+                yield
+
+        def gen():
+            o = self.tb.ff.incoming_fifo
+            for v in cmd:
+                yield o.readable.eq(1)
+                yield o.dout.eq(v)
+                yield
+                while (yield o.re) == 0:
+                    yield
+            yield o.readable.eq(0)
+
+            for i in range(cycles):
+                yield
+
+        run_simulation(self.tb, [gen(), csr(), out()])
+
+        responses = []
+        i = 0
+        while i < len(output):
+            if output[i] in (0xE0, 0xE8):
+                i += 2 + 301
+            elif output[i] == 0x55:
+                responses.append(output[i:i+5])
+                i += 5
+            elif output[i] == 0x56:
+                n = 4 + output[i+3] + 1 + 1
+                responses.append(output[i:i+n])
+                i += n
+            else:
+                self.fail("unexpected byte %02x in output" % output[i])
+
+        return write_transactions, responses
+
+    def test_burst_read(self):
+        cmd = [0x56, 0x12, 0x30, 3, 0x00]
+        writes, responses = self._run_commands(cmd, 1000)
+
+        self.assertEqual(writes, [])
+        expect = [0x56, 0x12, 0x30, 3, 0x30, 0x31, 0x32, 0x33]
+        self.assertEqual(responses, [expect + [sum(expect) & 0xFF]])
+
+    def test_burst_write(self):
+        cmd = [0x56, 0x92, 0x30, 2, 0xA0, 0xA1, 0xA2, 0x00]
+        writes, responses = self._run_commands(cmd, 1000)
+
+        self.assertEqual(writes, [(0x1230, 0xA0), (0x1231, 0xA1), (0x1232, 0xA2)])
+        expect = [0x56, 0x92, 0x30, 2, 0xA0, 0xA1, 0xA2]
+        self.assertEqual(responses, [expect + [sum(expect) & 0xFF]])
+
+    def test_single_after_burst(self):
+        cmd = [0x56, 0x00, 0x10, 0, 0x00,
+               0x55, 0x00, 0x20, 0x00, 0x00]
+        writes, responses = self._run_commands(cmd, 1000)
+
+        self.assertEqual(responses, [
+            [0x56, 0x00, 0x10, 0, 0x10, (0x56 + 0x10 + 0x10) & 0xFF],
+            [0x55, 0x00, 0x20, 0x20, (0x55 + 0x20 + 0x20) & 0xFF],
+            ])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -35,8 +35,10 @@ class TestBench(Module):
         self.sink = Endpoint(dmatpl(1024))
         self.consume_watermark = Signal(max=1024)
         self.ena = Signal(1)
+        self.marker = Signal()
 
-        self.submodules.p = Producer(self.port, 1024, self.consume_watermark, self.ena)
+        self.submodules.p = Producer(self.port, 1024, self.consume_watermark, self.ena,
+                                     marker=self.marker)
         self.comb += [self.source.connect(self.p.ulpi_sink),
                       self.p.out_addr.connect(self.sink)]
 
@@ -169,6 +171,82 @@ class TestProducer(unittest.TestCase):
         #vcd = "test_producer.vcd"
         run_simulation(self.tb, [src_gen(), sink_gen(), self.tb.port.gen()], vcd_name=vcd)
 
+    def test_marker(self):
+        headers = []
+
+        def src_gen():
+            yield self.tb.source.payload.ts.eq(0x1000)
+            yield
+            yield self.tb.ena.eq(1)
+            for i in range(10):
+                yield
+
+            yield from self.tb.packet(4, 0, 1, 0x2000)
+
+            # Marker between packets, stamped with the current time
+            yield self.tb.source.payload.ts.eq(0x3000)
+            yield self.tb.marker.eq(1)
+            yield
+            yield self.tb.marker.eq(0)
+            for i in range(10):
+                yield
+
+            yield from self.tb.packet(4, 0, 1, 0x4000)
+
+            # Two markers requested while a packet is captured go out after
+            # it, each as an empty packet of its own...
+            beats = [dict(is_start=1, ts=0x6000)] + \
+                    [dict(d=i, ts=0x6000) for i in range(4)] + \
+                    [dict(is_end=1, ts=0x6000)]
+            yield self.tb.source.stb.eq(1)
+            for i, beat in enumerate(beats):
+                for name in ["is_start", "is_end", "is_ovf", "is_err", "d", "ts"]:
+                    yield getattr(self.tb.source.payload, name).eq(beat.get(name, 0))
+                yield self.tb.marker.eq(i in (2, 3))
+                yield
+                yield self.tb.marker.eq(0)
+                while not (yield self.tb.source.ack):
+                    yield
+            # and before the next one, already waiting. They are stamped
+            # when sent.
+            yield from self.tb.packet(4, 0, 1, 0x8000)
+            for i in range(10):
+                yield
+
+            # Ignored while not capturing
+            yield self.tb.source.payload.ts.eq(0x5000)
+            yield self.tb.ena.eq(0)
+            for i in range(10):
+                yield
+            yield self.tb.marker.eq(1)
+            yield
+            yield self.tb.marker.eq(0)
+
+        def sink_gen():
+            yield self.tb.sink.ack.eq(1)
+            for i in range(300):
+                yield
+                if (yield self.tb.sink.stb):
+                    headers.append(((yield self.tb.sink.payload.ts),
+                                    (yield self.tb.sink.payload.count),
+                                    (yield self.tb.sink.payload.flag_first),
+                                    (yield self.tb.sink.payload.flag_last),
+                                    (yield self.tb.sink.payload.flag_marker)))
+
+        run_simulation(self.tb, [src_gen(), sink_gen(), self.tb.port.gen()])
+
+        self.assertEqual(headers, [
+            (0x1000, 0, 1, 0, 0),
+            (0x2000, 4, 0, 0, 0),
+            (0x3000, 0, 0, 0, 1),
+            (0x4000, 4, 0, 0, 0),
+            (0x6000, 4, 0, 0, 0),
+            (0x8000, 0, 0, 0, 1),
+            (0x8000, 0, 0, 0, 1),
+            (0x8000, 4, 0, 0, 0),
+            (0x5000, 0, 0, 1, 0),
+            ])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,83 @@
+from migen.sim import run_simulation
+
+from ovhw.ftdi_lfsr_test import FTDI_randtest, CFG_ENABLE, CFG_SEQUENCE
+from ovhw.constants import SEQTEST_MAGIC
+
+import unittest
+
+HEADER_LEN = 11
+
+
+def parse(stream):
+    """Split a sequence mode stream into (size, seq, sent, payload)"""
+    packets = []
+    while stream:
+        assert stream[0] == SEQTEST_MAGIC
+        size = int.from_bytes(stream[1:3], 'big')
+        seq = int.from_bytes(stream[3:7], 'big')
+        sent = int.from_bytes(stream[7:11], 'big')
+        packets.append((size, seq, sent, stream[HEADER_LEN:HEADER_LEN + size]))
+        stream = stream[HEADER_LEN + size:]
+    return packets
+
+
+class RandTestSequenceTests(unittest.TestCase):
+    def run_sequence(self, size, div, ack, cycles):
+        dut = FTDI_randtest()
+        out = []
+        lasts = []
+
+        def gen():
+            yield dut._seq_size.storage.eq(size)
+            yield dut._seq_div.storage.eq(div)
+            yield dut._cfg.storage.eq(CFG_ENABLE | CFG_SEQUENCE)
+            for i in range(cycles):
+                yield dut.source.ack.eq(ack(i))
+                yield
+                if (yield dut.source.stb) and (yield dut.source.ack):
+                    out.append((yield dut.source.payload.d))
+                    lasts.append((yield dut.source.payload.last))
+
+            # Let the packet in progress finish
+            yield dut._cfg.storage.eq(0)
+            yield dut.source.ack.eq(1)
+            for i in range(size + HEADER_LEN):
+                yield
+                if (yield dut.source.stb) and (yield dut.source.ack):
+                    out.append((yield dut.source.payload.d))
+                    lasts.append((yield dut.source.payload.last))
+
+        run_simulation(dut, gen())
+
+        packets = parse(bytes(out))
+        self.assertEqual(sum(lasts), len(packets))
+        return packets
+
+    def test_no_drops(self):
+        # Production (one byte every 4 clocks) slower than the sink
+        packets = self.run_sequence(20, 3, lambda i: 1, 1000)
+
+        self.assertGreater(len(packets), 5)
+        for n, (size, seq, sent, payload) in enumerate(packets):
+            self.assertEqual(size, 20)
+            self.assertEqual(seq, n)
+            self.assertEqual(sent, n * (HEADER_LEN + 20))
+            self.assertEqual(payload, bytes(range(20)))
+
+    def test_drops(self):
+        # Sink takes a byte every third clock, production runs at full rate
+        packets = self.run_sequence(16, 0, lambda i: i % 3 == 0, 1500)
+
+        self.assertGreater(len(packets), 5)
+        seqs = [seq for _, seq, _, _ in packets]
+        self.assertGreater(seqs[-1], len(packets) - 1)
+        self.assertEqual(seqs, sorted(set(seqs)))
+
+        # Dropped packets cost nothing on the link
+        for n, (size, seq, sent, payload) in enumerate(packets):
+            self.assertEqual(sent, n * (HEADER_LEN + 16))
+            self.assertEqual(len(payload), 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+from migen import *
+from migen.genlib.record import Record
+from migen.sim import run_simulation
+
+from ovhw.ulpi import ULPI_REG
+from ovhw.ulpicfg import ULPICfg
+from ovhw.constants import ULPI_EVENT_MAGIC
+
+import unittest
+
+
+class FakePHY(Module):
+    """Acks ULPI register requests after a few cycles; reads return addr ^ 0x5A"""
+    def __init__(self, ulpi_reg, latency=4):
+        wcount = Signal(max=latency + 1)
+        rcount = Signal(max=latency + 1)
+
+        self.sync += [
+                If(~ulpi_reg.wreq,
+                    wcount.eq(0),
+                    ulpi_reg.wack.eq(0)
+                ).Elif(wcount == latency,
+                    ulpi_reg.wack.eq(1)
+                ).Else(
+                    wcount.eq(wcount + 1)
+                ),
+
+                If(~ulpi_reg.rreq,
+                    rcount.eq(0),
+                    ulpi_reg.rack.eq(0)
+                ).Elif(rcount == latency,
+                    ulpi_reg.rdata.eq(ulpi_reg.raddr ^ 0x5A),
+                    ulpi_reg.rack.eq(1)
+                ).Else(
+                    rcount.eq(rcount + 1)
+                ),
+                ]
+
+
+class TestBench(Module):
+    def __init__(self):
+        self.ulpi_reg = Record(ULPI_REG)
+        self.submodules.phy = FakePHY(self.ulpi_reg)
+        self.submodules.ucfg = ULPICfg(Signal(), Signal(), Signal(), Signal(), self.ulpi_reg)
+
+    def queue(self, addr, value=None):
+        if value is not None:
+            yield self.ucfg._wdata.storage.eq(value)
+        yield self.ucfg._qcmd.r.eq(addr | (0x80 if value is not None else 0))
+        yield self.ucfg._qcmd.re.eq(1)
+        yield
+        yield self.ucfg._qcmd.re.eq(0)
+
+
+class ULPICfgQueueTests(unittest.TestCase):
+    def test_events(self):
+        tb = TestBench()
+        events = []
+        writes = []
+
+        def gen():
+            # Queued back to back, faster than they complete
+            yield from tb.queue(0x16, 0x12)
+            yield from tb.queue(0x04)
+            yield from tb.queue(0x0A, 0x34)
+            yield from tb.queue(0x3F)
+
+            self.assertGreater((yield tb.ucfg._qcmd.w), 0)
+
+            last_wack = 0
+            for i in range(400):
+                yield tb.ucfg.source.ack.eq(i % 2)
+                wack = yield tb.ulpi_reg.wack
+                if wack and not last_wack:
+                    writes.append(((yield tb.ulpi_reg.waddr), (yield tb.ulpi_reg.wdata)))
+                last_wack = wack
+                yield
+                if (yield tb.ucfg.source.stb) and (yield tb.ucfg.source.ack):
+                    events.append(((yield tb.ucfg.source.payload.d),
+                                   (yield tb.ucfg.source.payload.last)))
+
+            self.assertEqual((yield tb.ucfg._qcmd.w), 0)
+
+        run_simulation(tb, gen())
+
+        self.assertEqual([l for _, l in events], [0, 0, 1] * 4)
+        self.assertEqual(bytes(d for d, _ in events), bytes([
+            ULPI_EVENT_MAGIC, 0x96, 0x12,
+            ULPI_EVENT_MAGIC, 0x04, 0x04 ^ 0x5A,
+            ULPI_EVENT_MAGIC, 0x8A, 0x34,
+            ULPI_EVENT_MAGIC, 0x3F, 0x3F ^ 0x5A,
+            ]))
+        self.assertEqual(writes, [(0x16, 0x12), (0x0A, 0x34)])
+
+
+if __name__ == '__main__':
+    unittest.main()
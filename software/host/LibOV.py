@@ -1,11 +1,11 @@
-import ctypes
 import re
 import os
 import sys
-import queue
 import threading
 import collections
-from usb_interp import USBInterpreter
+import concurrent.futures
+import time
+from usb_interp import USBInterpreter, data_crc
 
 _lpath = (os.path.dirname(__file__))
 if _lpath == '':
@@ -18,102 +18,203 @@ elif sys.platform == 'win32':
 else:
     _lib_suffix = 'so'
 
-libov = ctypes.cdll.LoadLibrary(_lpath + "/libov." + _lib_suffix)
-
-class FTDI_Device(ctypes.Structure):
-    _fields_ = [
-                ('_1', ctypes.c_void_p),
-                ('_2', ctypes.c_void_p),
-                ]
-
-pFTDI_Device = ctypes.POINTER(FTDI_Device)
-
-# FTDIDevice_Open
-FTDIDevice_Open = libov.FTDIDevice_Open
-FTDIDevice_Open.argtypes = [pFTDI_Device]
-FTDIDevice_Open.restype = ctypes.c_int
-
-# FTDIDevice_Close
-FTDIDevice_Close = libov.FTDIDevice_Close
-FTDIDevice_Close.argtypes = [pFTDI_Device]
-
-FTDIDevice_Write = libov.FTDIDevice_Write
-FTDIDevice_Write.argtypes = [
-        pFTDI_Device, # Dev
-        ctypes.c_int, # Interface
-        ctypes.c_char_p, # Buf
-        ctypes.c_size_t, # N
-        ctypes.c_bool, # async
-        ]
-FTDIDevice_Write.restype = ctypes.c_int
-
-p_cb_StreamCallback = ctypes.CFUNCTYPE(
-        ctypes.c_int,    # retval
-        ctypes.POINTER(ctypes.c_uint8), # buf
-        ctypes.c_int, # length
-        ctypes.c_void_p, # progress
-        ctypes.c_void_p) # userdata
-
-FTDIDevice_ReadStream = libov.FTDIDevice_ReadStream
-FTDIDevice_ReadStream.argtypes = [
-        pFTDI_Device,    # dev
-        ctypes.c_int,    # interface
-        p_cb_StreamCallback, # callback
-        ctypes.c_void_p, # userdata
-        ctypes.c_int, # packetsPerTransfer
-        ctypes.c_int, # numTransfers
-        ]
-FTDIDevice_ReadStream.restype = ctypes.c_int
-
-# void ChandlePacket(unsigned int ts, unsigned int flags, unsigned char *buf, unsigned int len)
-ChandlePacket = libov.ChandlePacket
-ChandlePacket.argtypes = [
-    ctypes.c_ulonglong, # ts
-    ctypes.c_int, # flags
-    ctypes.c_char_p, # buf
-    ctypes.c_int, # len
-]
-
-# int FTDIEEP_Erase(FTDIDevice *dev)
-FTDIEEP_Erase = libov.FTDIEEP_Erase
-FTDIEEP_Erase.argtypes = [
-        pFTDI_Device,    # dev
-        ]
-FTDIEEP_Erase.restype = ctypes.c_int
-
-# int FTDIEEP_CheckAndProgram(FTDIDevice *dev, unsigned int number)
-FTDIEEP_CheckAndProgram = libov.FTDIEEP_CheckAndProgram
-FTDIEEP_CheckAndProgram.argtypes = [
-        pFTDI_Device,    # dev
-        ctypes.c_int,    # serial number
-        ]
-FTDIEEP_CheckAndProgram.restype = ctypes.c_int
-
-# int FTDIEEP_SanityCheck(FTDIDevice *dev, bool verbose)
-FTDIEEP_SanityCheck = libov.FTDIEEP_SanityCheck
-FTDIEEP_SanityCheck.argtypes = [
-        pFTDI_Device,    # dev
-        ctypes.c_bool,   # verbose
-        ]
-FTDIEEP_SanityCheck.restype = ctypes.c_int
-
-
 FTDI_INTERFACE_A = 1
 FTDI_INTERFACE_B = 2
 
 # hack
 keeper = []
 
+_libov = None
+
+def _lib():
+    """
+    libov with its prototypes declared. Loaded on first use rather than at
+    import, so commands that never touch the hardware (and --replay) start
+    quickly.
+    """
+    global _libov
+    if _libov is not None:
+        return _libov
+
+    import ctypes
+
+    libov = ctypes.cdll.LoadLibrary(_lpath + "/libov." + _lib_suffix)
+
+    class FTDI_Device(ctypes.Structure):
+        _fields_ = [
+                    ('_1', ctypes.c_void_p),
+                    ('_2', ctypes.c_void_p),
+                    ]
+
+    pFTDI_Device = ctypes.POINTER(FTDI_Device)
+    libov.FTDI_Device = FTDI_Device
+
+    # FTDIDevice_Open
+    libov.FTDIDevice_Open.argtypes = [pFTDI_Device]
+    libov.FTDIDevice_Open.restype = ctypes.c_int
+
+    # FTDIDevice_OpenBySerial
+    libov.FTDIDevice_OpenBySerial.argtypes = [pFTDI_Device, ctypes.c_char_p]
+    libov.FTDIDevice_OpenBySerial.restype = ctypes.c_int
+
+    # FTDIDevice_Close
+    libov.FTDIDevice_Close.argtypes = [pFTDI_Device]
+
+    libov.FTDIDevice_Write.argtypes = [
+            pFTDI_Device, # Dev
+            ctypes.c_int, # Interface
+            ctypes.c_char_p, # Buf
+            ctypes.c_size_t, # N
+            ctypes.c_bool, # async
+            ]
+    libov.FTDIDevice_Write.restype = ctypes.c_int
+
+    # void FTDIWriteCallback(int status, void *userdata)
+    libov.p_cb_WriteCallback = ctypes.CFUNCTYPE(None, ctypes.c_int, ctypes.c_void_p)
+
+    libov.FTDIDevice_WriteAsync.argtypes = [
+            pFTDI_Device, # Dev
+            ctypes.c_int, # Interface
+            ctypes.c_char_p, # Buf
+            ctypes.c_size_t, # N
+            libov.p_cb_WriteCallback, # callback
+            ctypes.c_void_p, # userdata
+            ]
+    libov.FTDIDevice_WriteAsync.restype = ctypes.c_int
+
+    libov.p_cb_StreamCallback = ctypes.CFUNCTYPE(
+            ctypes.c_int,    # retval
+            ctypes.POINTER(ctypes.c_uint8), # buf
+            ctypes.c_int, # length
+            ctypes.c_void_p, # progress
+            ctypes.c_void_p) # userdata
+
+    libov.FTDIDevice_ReadStream.argtypes = [
+            pFTDI_Device,    # dev
+            ctypes.c_int,    # interface
+            libov.p_cb_StreamCallback, # callback
+            ctypes.c_void_p, # userdata
+            ctypes.c_int, # packetsPerTransfer
+            ctypes.c_int, # numTransfers
+            ]
+    libov.FTDIDevice_ReadStream.restype = ctypes.c_int
+
+    # void ChandlePacket(unsigned int ts, unsigned int flags, unsigned char *buf, unsigned int len)
+    libov.ChandlePacket.argtypes = [
+        ctypes.c_ulonglong, # ts
+        ctypes.c_int, # flags
+        ctypes.c_char_p, # buf
+        ctypes.c_int, # len
+    ]
+
+    # int FTDIEEP_Erase(FTDIDevice *dev)
+    libov.FTDIEEP_Erase.argtypes = [
+            pFTDI_Device,    # dev
+            ]
+    libov.FTDIEEP_Erase.restype = ctypes.c_int
+
+    # int FTDIEEP_CheckAndProgram(FTDIDevice *dev, unsigned int number)
+    libov.FTDIEEP_CheckAndProgram.argtypes = [
+            pFTDI_Device,    # dev
+            ctypes.c_int,    # serial number
+            ]
+    libov.FTDIEEP_CheckAndProgram.restype = ctypes.c_int
+
+    # int FTDIEEP_SanityCheck(FTDIDevice *dev, bool verbose)
+    libov.FTDIEEP_SanityCheck.argtypes = [
+            pFTDI_Device,    # dev
+            ctypes.c_bool,   # verbose
+            ]
+    libov.FTDIEEP_SanityCheck.restype = ctypes.c_int
+
+    libov.FPGA_GetConfigStatus.restype = ctypes.c_int
+    libov.FPGA_GetConfigStatus.argtypes = [pFTDI_Device]
+
+    libov.HW_Init.argtypes = [pFTDI_Device, ctypes.c_char_p]
+
+    # int HW_InitBuffer(FTDIDevice *dev, const uint8_t *bitstream, size_t length)
+    libov.HW_InitBuffer.argtypes = [pFTDI_Device, ctypes.c_char_p, ctypes.c_size_t]
+    libov.HW_InitBuffer.restype = ctypes.c_int
+
+    # int HW_InitConfigData(FTDIDevice *dev, const uint8_t *data, size_t length)
+    libov.HW_InitConfigData.argtypes = [pFTDI_Device, ctypes.c_char_p, ctypes.c_size_t]
+    libov.HW_InitConfigData.restype = ctypes.c_int
+
+    class LFSRCheck(ctypes.Structure):
+        _fields_ = [('state', ctypes.c_uint32),
+                    ('history', ctypes.c_uint32),
+                    ('resync', ctypes.c_int),
+                    ('lastError', ctypes.c_int),
+                    ('offset', ctypes.c_uint64),
+                    ('errors', ctypes.c_uint64),
+                    ('resyncs', ctypes.c_uint64)]
+
+    libov.LFSRCheck = LFSRCheck
+
+    # void LFSRCheck_Init(LFSRCheck *check, uint32_t state)
+    libov.LFSRCheck_Init.argtypes = [ctypes.POINTER(LFSRCheck), ctypes.c_uint32]
+    libov.LFSRCheck_Init.restype = None
+
+    # size_t LFSRCheck_Feed(LFSRCheck *check, const uint8_t *data, size_t length,
+    #                       uint64_t *errorOffsets, size_t maxErrorOffsets)
+    libov.LFSRCheck_Feed.argtypes = [
+            ctypes.POINTER(LFSRCheck),
+            ctypes.c_char_p, # data
+            ctypes.c_size_t, # length
+            ctypes.POINTER(ctypes.c_uint64), # errorOffsets
+            ctypes.c_size_t, # maxErrorOffsets
+            ]
+    libov.LFSRCheck_Feed.restype = ctypes.c_size_t
+
+    _libov = libov
+    return libov
+
+def __getattr__(name):
+    # The library and its entry points used to be loaded at import time as
+    # module globals
+    if name == 'libov':
+        return _lib()
+    if name in ('FTDIDevice_Open', 'FTDIDevice_OpenBySerial', 'FTDIDevice_Close',
+                'FTDIDevice_Write', 'FTDIDevice_ReadStream', 'ChandlePacket',
+                'FTDIEEP_Erase', 'FTDIEEP_CheckAndProgram', 'FTDIEEP_SanityCheck',
+                'FTDI_Device', 'p_cb_StreamCallback'):
+        return getattr(_lib(), name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+def serial_string(serial):
+    """
+    Turn a serial number as given to eep-program (or the full USB serial
+    string) into the USB serial string stored in the EEPROM.
+    """
+    if serial is None:
+        return None
+
+    if isinstance(serial, int) or serial.isdigit():
+        return "OV%06u" % int(serial)
+
+    return serial
+
 class FTDIDevice:
     def __init__(self):
         self.__is_open = False
-        self._dev = FTDI_Device()
+        self._lib = _lib()
+        self._dev = self._lib.FTDI_Device()
+
+        # Completion callbacks of write_async() by userdata key; the one
+        # C callback must outlive every transfer, so it is kept here
+        self.__write_callbacks = {}
+        self.__write_key = 0
+        self.__write_lock = threading.Lock()
+        self.__write_cb = self._lib.p_cb_WriteCallback(self.__write_done)
 
     def __del__(self):
         self.close()
 
-    def open(self):
-        err = FTDIDevice_Open(self._dev)
+    def open(self, serial=None):
+        if serial is None:
+            err = self._lib.FTDIDevice_Open(self._dev)
+        else:
+            err = self._lib.FTDIDevice_OpenBySerial(self._dev, serial.encode('ascii'))
         if not err:
             self.__is_open = True
 
@@ -122,26 +223,55 @@ class FTDIDevice:
     def close(self):
         if self.__is_open:
             self.__is_open = False
-            FTDIDevice_Close(self._dev)
+            self._lib.FTDIDevice_Close(self._dev)
 
     def write(self, intf, buf, async_=False):
         if not isinstance(buf, bytes):
             raise TypeError("buf must be bytes")
 
-        return FTDIDevice_Write(self._dev, intf, buf, len(buf), async_)
+        return self._lib.FTDIDevice_Write(self._dev, intf, buf, len(buf), async_)
+
+    def __write_done(self, status, key):
+        with self.__write_lock:
+            callback = self.__write_callbacks.pop(key)
+        callback(status)
+
+    def write_async(self, intf, buf, callback):
+        """
+        Submit a write, callback(status) is called once it completed (status
+        0) or failed (a libusb error code). Completions are handled by the
+        thread running read_async(). Returns nonzero if the write could not
+        be submitted, callback is not called then.
+        """
+        if not isinstance(buf, bytes):
+            raise TypeError("buf must be bytes")
 
-    def read(self, intf, n):
+        with self.__write_lock:
+            # Keys start at 1, a NULL userdata arrives as None
+            self.__write_key += 1
+            key = self.__write_key
+            self.__write_callbacks[key] = callback
+
+        err = self._lib.FTDIDevice_WriteAsync(self._dev, intf, buf, len(buf), self.__write_cb, key)
+        if err:
+            with self.__write_lock:
+                del self.__write_callbacks[key]
+        return err
+
+    def read(self, intf, n, packetsPerTransfer=4, numTransfers=4):
         buf = []
 
         def callback(b, prog):
             buf.extend(b)
             return int(len(buf) >= n)
 
-        self.read_async(intf, callback, 4, 4)
+        self.read_async(intf, callback, packetsPerTransfer, numTransfers)
 
         return buf
 
     def read_async(self, intf, callback, packetsPerTransfer, numTransfers):
+        import ctypes
+
         def callback_wrapper(buf, ll, prog, user):
             if ll:
                 b = ctypes.string_at(buf, ll)
@@ -149,38 +279,96 @@ class FTDIDevice:
                 b = b''
             return callback(b, prog)
 
-        cb = p_cb_StreamCallback(callback_wrapper)
+        cb = self._lib.p_cb_StreamCallback(callback_wrapper)
 
         # HACK
         keeper.append(cb)
 
-        return FTDIDevice_ReadStream(self._dev, intf, cb, 
+        return self._lib.FTDIDevice_ReadStream(self._dev, intf, cb, 
                 None, packetsPerTransfer, numTransfers)
         # uncomment next lines to use C code to parse packets
-        #return FTDIDevice_ReadStream(self._dev, intf, p_cb_StreamCallback(libov.CStreamCallback), 
+        #return self._lib.FTDIDevice_ReadStream(self._dev, intf, self._lib.p_cb_StreamCallback(self._lib.CStreamCallback), 
         #        cb, packetsPerTransfer, numTransfers)
 
     def eeprom_erase(self):
-        return FTDIEEP_Erase(self._dev)
+        return self._lib.FTDIEEP_Erase(self._dev)
 
     def eeprom_program(self, serialno):
-        return FTDIEEP_CheckAndProgram(self._dev, serialno)
+        return self._lib.FTDIEEP_CheckAndProgram(self._dev, serialno)
 
     def eeprom_sanitycheck(self, verbose=False):
-        return FTDIEEP_SanityCheck(self._dev, verbose)
+        return self._lib.FTDIEEP_SanityCheck(self._dev, verbose)
 
-_FPGA_GetConfigStatus = libov.FPGA_GetConfigStatus
-_FPGA_GetConfigStatus.restype = ctypes.c_int
-_FPGA_GetConfigStatus.argtypes = [pFTDI_Device]
+    def config_status(self):
+        return self._lib.FPGA_GetConfigStatus(self._dev)
 
-def FPGA_GetConfigStatus(dev):
-    return _FPGA_GetConfigStatus(dev._dev)
+    def hw_init(self, bitstream):
+        return self._lib.HW_Init(self._dev, bitstream)
+
+    def hw_init_buffer(self, bitstream):
+        """hw_init() with the contents of a .bit file rather than its path"""
+        return self._lib.HW_InitBuffer(self._dev, bitstream, len(bitstream))
+
+    def hw_init_config(self, data):
+        """hw_init() with prepared configuration data, see ConfigData"""
+        return self._lib.HW_InitConfigData(self._dev, data, len(data))
+
+class ConfigData(bytes):
+    """
+    FPGA configuration data ready to be sent: the .bit header stripped and
+    the bits of every byte reversed for the SelectMAP port. Loads faster
+    than a .bit file and can be cached, see fwpkg.Package.config_data().
+    """
 
-_HW_Init = libov.HW_Init
-_HW_Init.argtypes = [pFTDI_Device, ctypes.c_char_p]
+def FPGA_GetConfigStatus(dev):
+    return dev.config_status()
 
 def HW_Init(dev, bitstream):
-    return _HW_Init(dev._dev, bitstream)
+    return dev.hw_init(bitstream)
+
+
+# Register attributes from the map file (see gen_mapfile in build.py)
+#   access: 'ro' status, 'rw' host owned storage, 'rwh' storage the gateware
+#           also writes, 'cmd' raw register with side effects
+RegAttrs = collections.namedtuple('RegAttrs', ['access', 'reset', 'bits'])
+
+def parse_mapfile(mapfile, attrs=None):
+    """
+    Parse a map.txt register map into {name: (addr, size)}. If attrs is a
+    dict it is filled with {name: RegAttrs} for the registers whose map line
+    carries them; maps from older builds have none.
+    """
+    addrmap = {}
+
+    for line in mapfile.readlines():
+        line = line.strip().decode('utf-8')
+
+        line = re.sub('#.*', '', line)
+        if not line:
+            continue
+
+        m = re.match('\s*(\w+)\s*=\s*(\w+)(:\w+)?\s*(.*)', line)
+        if not m:
+            raise ValueError("Mapfile - could not parse %s" % line)
+
+        name = m.group(1)
+        value = int(m.group(2), 16)
+        if m.group(3) is None:
+            size = 1
+        else:
+            size = int(m.group(3)[1:], 16) + 1 - value
+            assert size > 1
+
+        addrmap[name] = value, size
+
+        tokens = m.group(4).split()
+        if attrs is not None and tokens:
+            fields = dict(t.split('=', 1) for t in tokens[1:] if '=' in t)
+            attrs[name] = RegAttrs(tokens[0],
+                                   int(fields.get('reset', '0'), 0),
+                                   int(fields.get('bits', str(size * 8)), 0))
+
+    return addrmap
 
 
 class ProtocolError(Exception):
@@ -190,29 +378,185 @@ class TimeoutError(Exception):
     pass
 
 class _mapped_reg:
-    def __init__(self, readfn, writefn, name, addr, size):
+    def __init__(self, readfn, writefn, name, addr, size, readmultifn=None, writemultifn=None,
+                 attrs=None):
         self.readfn = readfn
         self.writefn = writefn
+        self.readmultifn = readmultifn
+        self.writemultifn = writemultifn
         self.addr = addr
         self.size = size
+        self.attrs = attrs
         self.shadow = 0
 
-    def rd(self):
+        # Storage registers only change when the host writes them, so once
+        # the shadow is known to match the hardware reads are served from it
+        self.cacheable = attrs is not None and attrs.access == 'rw'
+        self.valid = False
+
+    def invalidate(self):
+        self.valid = False
+
+    def load_reset(self):
+        """The gateware was just (re)configured, registers hold their reset values"""
+        if self.attrs is not None:
+            self.shadow = self.attrs.reset
+            self.valid = self.cacheable
+
+    def rd(self, cached=True):
+        if cached and self.valid:
+            return self.shadow
+
+        if self.size > 1 and self.readmultifn is not None:
+            values = self.readmultifn(range(self.addr, self.addr + self.size))
+        else:
+            values = [self.readfn(self.addr + i) for i in range(self.size)]
+
         self.shadow = 0
-        for i in range(self.size):
+        for v in values:
             self.shadow <<= 8
-            self.shadow |= self.readfn(self.addr + i)
+            self.shadow |= v
+        self.valid = self.cacheable
         return self.shadow
 
     def wr(self, value):
+        # Written LSB first, the base address last
+        writes = [(self.addr + self.size - 1 - i, (value >> (i * 8)) & 0xFF)
+                  for i in range(self.size)]
+
+        # The shadow only takes the value once the hardware has it
+        try:
+            if self.size > 1 and self.writemultifn is not None:
+                self.writemultifn(writes)
+            else:
+                for addr, v in writes:
+                    self.writefn(addr, v)
+        except BaseException:
+            self.invalidate()
+            raise
+
         self.shadow = value
-        for i in range(self.size):
-            self.writefn(self.addr + self.size - 1 - i, (value >> (i * 8)) & 0xFF)
+        self.valid = self.cacheable
+
+class Batch:
+    """
+    Register accesses collected and sent in a single USB write when the
+    batch is flushed, normally at the end of a 'with dev.batch() as b:'
+    block. Reads return futures that resolve once the batch has been sent.
+    Register shadows are only updated once the device acknowledged the
+    writes.
+    """
+
+    def __init__(self, dev):
+        self.__dev = dev
+        self.__ops = []
+        self.__reads = []
+        # reg -> value written in this batch, in write order
+        self.__writes = {}
+        # Addresses written with iowrite(), their registers' shadows go stale
+        self.__raw_writes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            for fut, _, _ in self.__reads:
+                fut.cancel()
+            self.__ops = []
+            self.__reads = []
+            self.__writes = {}
+            self.__raw_writes = []
+
+    def __reg(self, reg):
+        if isinstance(reg, str):
+            reg = getattr(self.__dev.regs, reg)
+        return reg
+
+    def iowrite(self, addr, value):
+        addr = self.__dev.resolve_addr(addr)
+        self.__raw_writes.append(addr)
+        self.__ops.append((addr, value))
+
+    def ioread(self, addr):
+        fut = concurrent.futures.Future()
+        self.__reads.append((fut, [len(self.__ops)], lambda values: values[0]))
+        self.__ops.append((self.__dev.resolve_addr(addr), None))
+        return fut
+
+    def wr(self, reg, value):
+        reg = self.__reg(reg)
+        self.__writes.pop(reg, None)
+        self.__writes[reg] = value
+        # Same order as _mapped_reg.wr, base address last
+        for i in range(reg.size):
+            self.__ops.append((reg.addr + reg.size - 1 - i, (value >> (i * 8)) & 0xFF))
+
+    def rd(self, reg, cached=True):
+        reg = self.__reg(reg)
+
+        fut = concurrent.futures.Future()
+        if cached and reg in self.__writes:
+            # Written earlier in this batch, known once that went through
+            value = self.__writes[reg]
+            self.__reads.append((fut, [], lambda values: value))
+            return fut
+        if cached and reg.valid:
+            fut.set_result(reg.shadow)
+            return fut
+
+        def combine(values):
+            v = 0
+            for b in values:
+                v = v << 8 | b
+            reg.shadow = v
+            reg.valid = reg.cacheable
+            return v
+
+        start = len(self.__ops)
+        self.__reads.append((fut, range(start, start + reg.size), combine))
+        self.__ops += [(reg.addr + i, None) for i in range(reg.size)]
+        return fut
+
+    def flush(self):
+        ops, reads, writes = self.__ops, self.__reads, self.__writes
+        raw_writes = self.__raw_writes
+        self.__ops = []
+        self.__reads = []
+        self.__writes = {}
+        self.__raw_writes = []
+
+        if not ops:
+            return
+
+        try:
+            values = self.__dev.io.do_batch(ops)
+        except Exception as e:
+            self.__dev.forget_shadows(raw_writes)
+            # Some of the writes may have arrived, the shadows can't be trusted
+            for reg in writes:
+                reg.valid = False
+            for fut, _, _ in reads:
+                fut.set_exception(e)
+            raise
+
+        for fut, indices, combine in reads:
+            fut.set_result(combine([values[i] for i in indices]))
+
+        self.__dev.forget_shadows(raw_writes)
+        for reg, value in writes.items():
+            reg.shadow = value
+            reg.valid = reg.cacheable
 
 class _mapped_regs:
     def __init__(self, d):
         self._d = d
 
+    def __iter__(self):
+        return iter(self._d.values())
+
     def __getattr__(self, attr):
         try:
             return self.__dict__['_d'][attr.upper()]
@@ -221,10 +565,20 @@ class _mapped_regs:
 
         raise KeyError("No such register %s - did you specify a mapfile?" % attr)
 
+    def __contains__(self, name):
+        return name.upper() in self._d
+
 
 UCFG_REG_GO = 0x80
 UCFG_REG_ADDRMASK = 0x3F
 
+# UCFG_QCMD, see ovhw/ulpicfg.py
+UCFG_QCMD_WRITE = 0x80
+ULPI_QUEUE_DEPTH = 16
+
+# CMDPROC_FEATURES bits, see ovhw/cmdproc.py
+CMDPROC_FEATURE_BURST = 0x01
+
 SMSC_334x_MAGIC = 0x4240009
 SMSC_334x_MAP = {
     "VIDL": 0x00,
@@ -285,6 +639,72 @@ SMSC_334x_MAP = {
     "USBIO_PWR_MGMT_CLR": 0x3B,
 }
 
+# Registers that only report PHY state, see OVDevice.ulpi_restore()
+SMSC_334x_READONLY = {"VIDL", "VIDH", "PIDL", "PIDH", "USB_INT_STAT", "USB_INT_LATCH",
+                      "DEBUG", "CARKIT_INT_STAT", "CARKIT_INT_LATCH"}
+
+
+class StageStats:
+    """
+    Call counts and time spent in the stages of the host pipeline.
+
+    Stages are instrumented by wrapping the callable that implements them,
+    so nothing is paid when stats are not in use. Times are inclusive: the
+    USB callback contains framing, which contains SDRAM de-framing and so on.
+    Counters are shared between threads without locking and may miss the
+    odd update when several devices feed the same StageStats.
+    """
+
+    def __init__(self):
+        self.counters = collections.OrderedDict()
+
+    def wrap(self, name, fn):
+        counter = self.counters.setdefault(name, [0, 0])
+        clock = time.perf_counter_ns
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                counter[0] += 1
+                counter[1] += clock() - start
+
+        return timed
+
+    def instrument(self, obj, attr, name):
+        setattr(obj, attr, self.wrap(name, getattr(obj, attr)))
+
+    def wrap_file(self, f):
+        return _TimedFile(f, self.wrap("file write", f.write))
+
+    def snapshot(self):
+        return {name: {"calls": calls, "ns": ns}
+                for name, (calls, ns) in self.counters.items()}
+
+    def reset(self):
+        for counter in self.counters.values():
+            counter[0] = counter[1] = 0
+
+    def report(self, file=sys.stderr):
+        for name, (calls, ns) in self.counters.items():
+            print("%-28s %10d calls %12.3f ms %10.3f us/call" % (
+                name, calls, ns / 1e6, ns / 1e3 / calls if calls else 0), file=file)
+
+class _TimedFile:
+    def __init__(self, f, write):
+        self.__f = f
+        self.write = write
+
+    def __getattr__(self, attr):
+        return getattr(self.__f, attr)
+
+def handler_name(handler):
+    owner = getattr(handler, '__self__', None)
+    if owner is not None:
+        return "%s.%s" % (type(owner).__name__.lstrip("_"), handler.__name__)
+    return getattr(handler, '__name__', repr(handler))
+
 
 INCOMPLETE = -1
 UNMATCHED = 0
@@ -311,65 +731,468 @@ class baseService:
 
         return size
 
+def dispatch(buf, services):
+    """
+    Hand each complete packet at the start of buf to the first service that
+    claims it. Returns what is left over, the start of an incomplete packet.
+    """
+    while buf:
+        for service in services:
+            code = service.presentBytes(buf)
+            if code == INCOMPLETE:
+                return buf
+            elif code:
+                buf = buf[code:]
+                break
+        else:
+            print("Unmatched byte %02x - discarding" % buf[0])
+            buf = buf[1:]
+
+    return buf
+
 class IO:
+    """
+    Register access transactions over the 0x55 protocol, and the 0x56
+    burst commands where the gateware supports them (see
+    OVDevice.has_burst).
+
+    Any number of transactions may be in flight, from any number of threads.
+    The gateware executes commands in the order they arrive and each response
+    echoes the command's address, but carries no sequence number, so
+    responses are matched to the oldest pending transaction for that address
+    (and direction). A transaction that
+    timed out stays queued until its response arrives, the response is then
+    dropped, so later transactions on the same address still line up.
+    """
+
+    MAGIC_BURST = 0x56
+
+    # Accesses per burst command, the count is sent as count - 1 in one byte
+    MAX_BURST = 256
+
+    class _Transaction(concurrent.futures.Future):
+        def __init__(self, io_ext, cmd, count=None):
+            super().__init__()
+            self.io_ext = io_ext
+            self.cmd = cmd
+
+            # Responses are matched on what they echo of the command: the
+            # address, and for bursts also the count
+            self.key = io_ext if count is None else (io_ext, count)
+
     class __IOService(baseService):
         MAGIC = 0x55
         NEEDED_FOR_SIZE = 1
 
         def __init__(self):
-            self.q = queue.Queue()
+            # key -> deque of pending _Transaction, oldest first
+            self.pending = {}
+            self.lock = threading.Lock()
+
+            # Responses nobody was waiting for
+            self.unmatched = 0
+
+        def matchMagic(self, byt):
+            return byt == self.MAGIC or byt == IO.MAGIC_BURST
+
+        def getNeededSizeForMagic(self, byt):
+            return 4 if byt == IO.MAGIC_BURST else 1
 
         def getPacketSize(self, buf):
+            if buf[0] == IO.MAGIC_BURST:
+                # header, count data bytes, checksum
+                return 4 + buf[3] + 1 + 1
             return 5
 
         def consume(self, buf):
-            assert buf[0] == self.MAGIC
-            assert len(buf) == 5
-
-            calc_ck = (sum(buf[0:4]) & 0xFF)
+            calc_ck = (sum(buf[:-1]) & 0xFF)
 
-            if calc_ck != buf[4]:
+            if calc_ck != buf[-1]:
                 raise ProtocolError(
                     "Checksum for response incorrect: expected %02x, got %02x" %
-                    (calc_ck, buf[4])
+                    (calc_ck, buf[-1])
                 )
 
-            self.q.put((buf[1] << 8 | buf[2], buf[3]))
+            io_ext = buf[1] << 8 | buf[2]
 
-    def __init__(self):
+            if buf[0] == IO.MAGIC_BURST:
+                key = (io_ext, buf[3] + 1)
+                result = list(buf[4:-1])
+            else:
+                key = io_ext
+                result = buf[3]
+
+            with self.lock:
+                waiting = self.pending.get(key)
+                if not waiting:
+                    self.unmatched += 1
+                    return
+
+                txn = waiting.popleft()
+                if not waiting:
+                    del self.pending[key]
+
+            # Cancelled (timed out) transactions just absorb their response
+            if txn.set_running_or_notify_cancel():
+                txn.set_result(result)
+
+    def __init__(self, timeout=None):
         self.service = IO.__IOService()
 
+        # Default timeout in seconds for the blocking calls, None waits forever
+        self.timeout = timeout
+
+        self.__send_lock = threading.Lock()
+
+    def submit(self, ops, burst=None):
+        """
+        Start transactions without waiting for them. ops are (addr, value)
+        pairs, a value of None is a read. All commands go out in a single USB
+        write. Returns one future per op, resolving to the register value
+        (for writes, the value written).
+
+        burst, an (addr, count) pair, adds the commands of a read burst (see
+        submit_burst()) after ops to the same write, and their futures to
+        the result.
+        """
+        cmds = []
+        for addr, value in ops:
+            io_ext = addr if value is None else 0x8000 | addr
+            value = 0 if value is None else value
+
+            cmd = [0x55, (io_ext >> 8), io_ext & 0xFF, value]
+            cmd.append(sum(cmd) & 0xFF)
+            cmds.append((io_ext, bytes(cmd), None))
+
+        if burst is not None:
+            cmds += self.__burst_commands(*burst)
+
+        return self.__send(cmds)
+
+    def submit_burst(self, addr, count=None, values=None):
+        """
+        Start burst commands covering count consecutive addresses from addr,
+        reading, or writing values if given. Only for gateware that supports
+        them. Returns one future per burst command (of up to MAX_BURST
+        accesses), each resolving to a list of values.
+        """
+        if values is not None:
+            count = len(values)
+
+        return self.__send(self.__burst_commands(addr, count, values))
+
+    @staticmethod
+    def __burst_commands(addr, count, values=None):
+        cmds = []
+        for start in range(0, count, IO.MAX_BURST):
+            n = min(count - start, IO.MAX_BURST)
+            io_ext = addr + start if values is None else 0x8000 | (addr + start)
+
+            cmd = [IO.MAGIC_BURST, (io_ext >> 8), io_ext & 0xFF, n - 1]
+            if values is not None:
+                cmd += values[start:start + n]
+            cmd.append(sum(cmd) & 0xFF)
+            cmds.append((io_ext, bytes(cmd), n))
+
+        return cmds
+
+    def __send(self, cmds):
+        txns = []
+        msg = bytearray()
+
+        # Registering and sending under one lock keeps the per address pending
+        # order identical to the order the gateware sees. The service lock is
+        # only held briefly, the reader thread must not wait on a USB write.
+        with self.__send_lock:
+            with self.service.lock:
+                for io_ext, cmd, count in cmds:
+                    txn = IO._Transaction(io_ext, cmd, count)
+                    self.service.pending.setdefault(txn.key, collections.deque()).append(txn)
+                    txns.append(txn)
+                    msg += cmd
+
+            try:
+                sent = self.service.write(bytes(msg))
+            except BaseException:
+                # Never sent, so no responses will come for these
+                self.__forget(txns)
+                for txn in txns:
+                    txn.cancel()
+                raise
+
+        # Queued writes (see WriteQueue) fail later, if at all
+        if sent is not None:
+            sent.add_done_callback(lambda f: self.__write_done(txns, f))
+
+        return txns
+
+    def __forget(self, txns):
+        with self.service.lock:
+            for txn in txns:
+                waiting = self.service.pending.get(txn.key)
+                if waiting is not None and txn in waiting:
+                    waiting.remove(txn)
+                    if not waiting:
+                        del self.service.pending[txn.key]
+
+    def __write_done(self, txns, sent):
+        e = sent.exception()
+        if e is None:
+            return
+
+        self.__forget(txns)
+        for txn in txns:
+            if txn.set_running_or_notify_cancel():
+                txn.set_exception(e)
+
+    def wait(self, txns, timeout=None):
+        """Wait for transactions from submit(), returning their values"""
+        if timeout is None:
+            timeout = self.timeout
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        values = []
+        for txn in txns:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                values.append(txn.result(remaining))
+            except concurrent.futures.TimeoutError:
+                for t in txns:
+                    t.cancel()
+                raise TimeoutError("IO access to %04x timed out" % (txn.io_ext & 0x3FFF))
+
+        return values
+
+    def reset(self):
+        """
+        Forget every pending transaction, e.g. when the gateware was
+        reconfigured and their responses will never arrive. They are
+        cancelled, so nothing waits on them forever.
+        """
+        with self.service.lock:
+            pending = self.service.pending
+            self.service.pending = {}
+
+        for waiting in pending.values():
+            for txn in waiting:
+                txn.cancel()
+
+    async def wait_async(self, txns, timeout=None):
+        """asyncio counterpart of wait()"""
+        import asyncio
+
+        if timeout is None:
+            timeout = self.timeout
+
+        try:
+            return await asyncio.wait_for(
+                asyncio.gather(*(asyncio.wrap_future(txn) for txn in txns)), timeout)
+        except asyncio.TimeoutError:
+            for txn in txns:
+                txn.cancel()
+            raise TimeoutError("IO access timed out")
+
     def do_read(self, addr, timeout=None):
-        return self.__txn(addr, 0, timeout)
+        return self.wait(self.submit([(addr, None)]), timeout)[0]
 
     def do_write(self, addr, value, timeout=None):
-        return self.__txn(0x8000 | addr, value, timeout)
+        return self.wait(self.submit([(addr, value)]), timeout)[0]
 
-    def __txn(self, io_ext, value, timeout):
-        msg = [0x55, (io_ext >> 8), io_ext & 0xFF, value]
-        checksum = (sum(msg) & 0xFF)
-        msg.append(checksum)
-        msg = bytes(msg)
+    def do_read_multi(self, addrs, timeout=None):
+        return self.wait(self.submit([(addr, None) for addr in addrs]), timeout)
 
-        self.service.write(msg)
+    def do_write_multi(self, writes, timeout=None):
+        return self.wait(self.submit(writes), timeout)
 
-        try:
-            resp = self.service.q.get(True, timeout)
-        except queue.Empty:
-            raise TimeoutError("IO access timed out")
+    def do_batch(self, ops, timeout=None):
+        """ops are (addr, value) pairs, a value of None is a read"""
+        return self.wait(self.submit(ops), timeout)
+
+    def do_read_burst(self, addr, count, timeout=None):
+        return sum(self.wait(self.submit_burst(addr, count), timeout), [])
+
+    def do_write_burst(self, addr, values, timeout=None):
+        return sum(self.wait(self.submit_burst(addr, values=list(values)), timeout), [])
+
+    async def submit_async(self, ops):
+        """
+        submit() from a worker thread, the USB write blocks without a
+        WriteQueue and must not hold up the event loop
+        """
+        import asyncio
+
+        return await asyncio.get_running_loop().run_in_executor(None, self.submit, ops)
+
+    async def read_async(self, addr, timeout=None):
+        return (await self.wait_async(await self.submit_async([(addr, None)]), timeout))[0]
+
+    async def write_async(self, addr, value, timeout=None):
+        return (await self.wait_async(await self.submit_async([(addr, value)]), timeout))[0]
 
-        r_addr, r_value = resp
+# Bytes per SDRAM ring word, ring pointers and sizes count words
+RING_WORD_BYTES = 2
 
-        assert r_addr == io_ext
+class CaptureStatus(collections.namedtuple('CaptureStatus',
+        ['rptr', 'wptr', 'wrap_count', 'num_ovf', 'num_total', 'ts'])):
+    """
+    Capture health snapshot, see OVDevice.capture_status(). rptr and wptr
+    are absolute SDRAM ring addresses, wrap_count counts ring wraps since
+    capture was enabled, num_ovf and num_total count overflowed and all
+    received ULPI bytes. ts is the capture timestamp at the snapshot, or
+    None if the gateware has no status block.
+    """
+    __slots__ = ()
 
-        return r_value
+    def fill(self, ring_size):
+        """Ring words written but not yet read by the host"""
+        return (self.wptr - self.rptr) % ring_size
+
+    def total(self, ring_base, ring_size):
+        """Ring words written since capture was enabled"""
+        return self.wrap_count * ring_size + self.wptr - ring_base
+
+# Capture status records pushed by the gateware every CAPTURE_STATUS_INTERVAL
+# microseconds, see OVDevice.enable_status_records()
+STATUS_MAGIC = 0xC0
+
+class StatusRecords:
+    # Record fields in gateware order, with their size in bytes
+    FIELDS = [('wptr', 4), ('rptr', 4), ('wrap_count', 4),
+              ('num_ovf', 4), ('num_total', 4), ('ts', 8)]
+
+    class __StatusRecordsService(baseService):
+        MAGIC = STATUS_MAGIC
+
+        NEEDED_FOR_SIZE = 2
+
+        def __init__(self):
+            self.handlers = []
+            self.last = None
+            self.count = 0
+
+        def getPacketSize(self, buf):
+            # overhead is magic, length
+            return buf[1] + 2
+
+        def consume(self, buf):
+            values = {}
+            offset = 2
+            for name, size in StatusRecords.FIELDS:
+                values[name] = int.from_bytes(bytes(buf[offset:offset + size]), 'big')
+                offset += size
+
+            self.last = CaptureStatus(**values)
+            self.count += 1
+
+            for handler in self.handlers:
+                handler(self.last)
+
+    def __init__(self):
+        self.service = StatusRecords.__StatusRecordsService()
+
+    @property
+    def handlers(self):
+        return self.service.handlers
+
+    @handlers.setter
+    def handlers(self, handlers):
+        self.service.handlers = handlers
+
+    @property
+    def last(self):
+        """The most recent CaptureStatus received, or None"""
+        return self.service.last
+
+# Completion events of queued ULPI register accesses, see OVDevice.ulpi_batch()
+ULPI_EVENT_MAGIC = 0xC1
+
+class ULPIEvents:
+    """
+    The gateware completes queued ULPI accesses in order, so each event
+    belongs to the oldest access still pending. As with IO transactions, an
+    access that timed out stays queued and absorbs its event.
+    """
+
+    class __ULPIEventsService(baseService):
+        MAGIC = ULPI_EVENT_MAGIC
+
+        NEEDED_FOR_SIZE = 1
+
+        def __init__(self):
+            self.pending = collections.deque()
+            self.lock = threading.Lock()
+
+            # Events nobody was waiting for
+            self.unmatched = 0
+
+        def getPacketSize(self, buf):
+            # magic, write flag and address, data
+            return 3
+
+        def consume(self, buf):
+            with self.lock:
+                if not self.pending:
+                    self.unmatched += 1
+                    return
+                fut = self.pending.popleft()
+
+            if not fut.set_running_or_notify_cancel():
+                return
+
+            if buf[1] & UCFG_REG_ADDRMASK != fut.addr:
+                fut.set_exception(ProtocolError(
+                    "ULPI event for register %02x, expected %02x" % (buf[1] & UCFG_REG_ADDRMASK, fut.addr)))
+            else:
+                fut.set_result(buf[2])
+
+    def __init__(self):
+        self.service = ULPIEvents.__ULPIEventsService()
+
+    def expect(self, addrs):
+        """Futures for the events of accesses to addrs, about to be queued"""
+        futs = []
+        for addr in addrs:
+            fut = concurrent.futures.Future()
+            fut.addr = addr & UCFG_REG_ADDRMASK
+            futs.append(fut)
+
+        with self.service.lock:
+            self.service.pending.extend(futs)
+
+        return futs
+
+    def wait(self, futs, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        values = []
+        for fut in futs:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                values.append(fut.result(remaining))
+            except concurrent.futures.TimeoutError:
+                for f in futs:
+                    f.cancel()
+                raise TimeoutError("ULPI access to %02x timed out" % fut.addr)
+
+        return values
+
+# Basic Test service for testing stream rates and ordering. Every payload
+# byte is checked against the generator's LFSR, in C (lfsr_check.c) since
+# python is too slow; the rates are still CPU-bound by the packet dispatch.
+
+# Generator state after it was stopped, see lfsr_check.h
+LFSR_RESET_STATE = 1
+
+# Bytes the checker needs to pick up the stream from an unknown state
+LFSR_BITS = 17
 
-# Basic Test service for testing stream rates and ordering
-# Ideally we'd verify the entire LFSR, but python is too slow
-# As it is, the rates are CPU-bound
 class LFSRTest:
     __stats = collections.namedtuple('LFSR_Stat', 
-            ['total', 'error'])
+            ['total', 'error', 'errors', 'resyncs', 'error_offsets'])
+
+    # Error offsets kept, the errors themselves are all counted
+    MAX_ERROR_OFFSETS = 64
 
     class __LFSRTestService(baseService):
         MAGIC = 0xAA
@@ -377,13 +1200,46 @@ class LFSRTest:
         NEEDED_FOR_SIZE = 2
 
         def __init__(self):
+            # Packets before the first reset() are from a generator in an
+            # unknown state
+            self.reset(None)
+
+        def reset(self, state=LFSR_RESET_STATE):
+            # The checker is set up on the first packet, so the library is
+            # only loaded when the test actually runs
+            self.seed = state
+            self.check = None
+            self.feed = None
+            self.error_offsets = []
             self.total = 0
-            self.reset()
 
-        def reset(self):
-            self.state = None
-            self.error = 0
-            self.total = 0
+        def __start(self):
+            import ctypes
+
+            lib = _lib()
+            self.check = lib.LFSRCheck()
+            lib.LFSRCheck_Init(ctypes.byref(self.check), self.seed or 0)
+            if self.seed is None:
+                self.check.resync = LFSR_BITS
+
+            offsets = (ctypes.c_uint64 * LFSRTest.MAX_ERROR_OFFSETS)()
+            check = ctypes.byref(self.check)
+
+            def feed(data):
+                room = LFSRTest.MAX_ERROR_OFFSETS - len(self.error_offsets)
+                n = lib.LFSRCheck_Feed(check, data, len(data), offsets, room)
+                if n:
+                    self.error_offsets.extend(offsets[:n])
+
+            self.feed = feed
+
+        @property
+        def errors(self):
+            return self.check.errors if self.check is not None else 0
+
+        @property
+        def resyncs(self):
+            return self.check.resyncs if self.check is not None else 0
 
         def getPacketSize(self, buf):
             # overhead is magic, length
@@ -393,21 +1249,219 @@ class LFSRTest:
             assert buf[0] == self.MAGIC
             assert buf[1] + 2 == len(buf)
 
+            if self.feed is None:
+                self.__start()
+
+            self.feed(buf[2:])
             self.total += buf[1]
 
-            if self.state != None:
-                if buf[2] & 0xFE != (self.state << 1) & 0xFE:
-                    self.error = 1
+    def __init__(self):
+        self.service = LFSRTest.__LFSRTestService()
+
+        self.reset = self.service.reset
+
+    def stats(self):
+        s = self.service
+        return LFSRTest.__stats(total=s.total, error=int(s.errors > 0), errors=s.errors,
+                                resyncs=s.resyncs, error_offsets=list(s.error_offsets))
+
+# Sequence numbered loopback test packets (FTDI_randtest sequence mode):
+# magic, size[16], seq[32], sent[32] MSB first, then size payload bytes
+SEQTEST_MAGIC = 0xAB
+SEQTEST_HEADER_LEN = 11
+
+class SequenceTest:
+    """
+    Only the packet headers are looked at, so this keeps up with the link.
+    A gap in the sequence numbers is packets the gateware dropped because
+    the host didn't keep up; a 'sent' count other than the bytes received
+    so far is data lost between the FTDI and here.
+    """
+    __stats = collections.namedtuple('SequenceTest_Stat',
+            ['total', 'packets', 'dropped', 'dropped_bytes', 'lost_bytes', 'errors', 'events'])
 
-            self.state = buf[-1]
+    # Drop/loss events kept, each is (kind, stream offset, seq, bytes or packets)
+    MAX_EVENTS = 64
+
+    class __SequenceTestService(baseService):
+        MAGIC = SEQTEST_MAGIC
+
+        NEEDED_FOR_SIZE = 3
+
+        def __init__(self):
+            self.reset()
+
+        def reset(self):
+            self.total = 0
+            self.packets = 0
+            self.dropped = 0
+            self.dropped_bytes = 0
+            self.lost_bytes = 0
+            self.errors = 0
+            self.events = []
+
+            # The generator numbers from 0 when it is started
+            self.next_seq = 0
+            self.next_sent = 0
+
+        def getPacketSize(self, buf):
+            return SEQTEST_HEADER_LEN + (buf[1] << 8 | buf[2])
+
+        def __event(self, kind, seq, n):
+            self.errors += 1
+            if len(self.events) < SequenceTest.MAX_EVENTS:
+                self.events.append((kind, self.total, seq, n))
+
+        def consume(self, buf):
+            seq = int.from_bytes(buf[3:7], 'big')
+            sent = int.from_bytes(buf[7:11], 'big')
+
+            # Both counters wrap at 32 bits
+            if seq != self.next_seq:
+                n = (seq - self.next_seq) & 0xFFFFFFFF
+                self.dropped += n
+                self.dropped_bytes += n * len(buf)
+                self.__event("dropped", seq, n)
+
+            if sent != self.next_sent:
+                n = (sent - self.next_sent) & 0xFFFFFFFF
+                self.lost_bytes += n
+                self.__event("lost", seq, n)
+
+            self.next_seq = (seq + 1) & 0xFFFFFFFF
+            self.next_sent = (sent + len(buf)) & 0xFFFFFFFF
+
+            self.total += len(buf)
+            self.packets += 1
 
     def __init__(self):
-        self.service = LFSRTest.__LFSRTestService()
+        self.service = SequenceTest.__SequenceTestService()
 
         self.reset = self.service.reset
 
     def stats(self):
-        return LFSRTest.__stats(total=self.service.total, error=self.service.error)
+        s = self.service
+        return SequenceTest.__stats(total=s.total, packets=s.packets, dropped=s.dropped,
+                                    dropped_bytes=s.dropped_bytes, lost_bytes=s.lost_bytes,
+                                    errors=s.errors, events=list(s.events))
+
+class WriteQueue:
+    """
+    Coalescing asynchronous writes to an FTDI interface. Writes queued while
+    'depth' transfers are in flight, or within 'window' seconds of the
+    first, go out together as one bulk transfer. write() returns a future
+    for when its transfer completed; it fails with IOError if the transfer
+    did, or with the exception if it could not be submitted.
+
+    Completions come from the USB reader thread (see
+    FTDIDevice.write_async), so the queue is only usable while it runs.
+    """
+
+    def __init__(self, dev, intf, window=0.0, depth=2):
+        self.dev = dev
+        self.intf = intf
+        self.window = window
+        self.depth = depth
+
+        self.__cond = threading.Condition()
+        self.__buf = bytearray()
+        self.__futs = []
+        self.__closed = False
+
+        # Futures of the transfers in flight, by transfer number
+        self.__in_flight = {}
+
+        # Writes queued and bulk transfers they went out in
+        self.writes = 0
+        self.transfers = 0
+
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def write(self, data):
+        fut = concurrent.futures.Future()
+        with self.__cond:
+            if self.__closed:
+                raise ValueError("Write queue is closed")
+
+            self.__buf += data
+            self.__futs.append(fut)
+            self.writes += 1
+            self.__cond.notify_all()
+
+        return fut
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                while not self.__buf and not self.__closed or \
+                        self.__buf and len(self.__in_flight) >= self.depth:
+                    self.__cond.wait()
+                if not self.__buf:
+                    return
+
+            if self.window:
+                time.sleep(self.window)
+
+            with self.__cond:
+                data, futs = bytes(self.__buf), self.__futs
+                self.__buf = bytearray()
+                self.__futs = []
+                self.transfers += 1
+                key = self.transfers
+                self.__in_flight[key] = futs
+
+            # The thread has to survive a failed submit, or every later
+            # write would wait forever
+            try:
+                err = self.dev.write_async(self.intf, data,
+                                           lambda status, key=key: self.__done(key, status))
+            except Exception as e:
+                self.__done(key, e)
+            else:
+                if err:
+                    self.__done(key, err)
+
+    def __done(self, key, status):
+        with self.__cond:
+            # Gone if close() gave up on it
+            futs = self.__in_flight.pop(key, None)
+            self.__cond.notify_all()
+
+        if futs is None:
+            return
+
+        if isinstance(status, Exception):
+            WriteQueue.__fail(futs, status)
+        elif status:
+            WriteQueue.__fail(futs, IOError("USB write failed: %d" % status))
+        else:
+            for fut in futs:
+                fut.set_result(None)
+
+    @staticmethod
+    def __fail(futs, e):
+        for fut in futs:
+            fut.set_exception(e)
+
+    def close(self, timeout=1.0):
+        """
+        Send what is queued and wait (up to timeout) for it to complete.
+        Transfers still in flight then fail with IOError, their completions
+        would need the reader thread, which is stopped next.
+        """
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify_all()
+        self.__thread.join()
+
+        with self.__cond:
+            self.__cond.wait_for(lambda: not self.__in_flight, timeout)
+            lost = list(self.__in_flight.values())
+            self.__in_flight = {}
+
+        for futs in lost:
+            WriteQueue.__fail(futs, IOError("USB write did not complete"))
 
 def hd(x):
     return " ".join("%02x" % i for i in x)
@@ -426,6 +1480,8 @@ HF0_TRUNC = 0x08
 HF0_FIRST = 0x10
 # Last packet of capture session; IE, when the cap hardware was disabled
 HF0_LAST = 0x20
+# Empty latency marker, injected on request of the host (CSTREAM_MARKER)
+HF0_MARKER = 0x40
 
 def decode_flags(flags):
     ret = ""
@@ -435,19 +1491,21 @@ def decode_flags(flags):
     ret += "Truncated " if flags & HF0_TRUNC else ""
     ret += "First " if flags & HF0_FIRST else ""
     ret += "Last " if flags & HF0_LAST else ""
+    ret += "Marker " if flags & HF0_MARKER else ""
     return ret.rstrip()
 
 class RXCSniff:
     class __RXCSniffService(baseService):
-        import crcmod
-        data_crc = staticmethod(crcmod.mkCrcFun(0x18005))
+        data_crc = staticmethod(data_crc)
 
         def getNeededSizeForMagic(self, b):
             if b in (0xA0, 0xA2):
                 return 4
             return 1
 
-        def __init__(self):
+        def __init__(self, stats=None):
+            self.stats = stats
+
             self.last_rxcmd = 0
 
             self.usbbuf = []
@@ -463,6 +1521,17 @@ class RXCSniff:
             self.cumulative_ts = 0
 
 
+        @property
+        def handlers(self):
+            return self.__handlers
+
+        @handlers.setter
+        def handlers(self, handlers):
+            if self.stats is not None:
+                handlers = [self.stats.wrap("handler " + handler_name(h), h)
+                            for h in handlers]
+            self.__handlers = handlers
+
         def matchMagic(self, byt):
             return byt in (0xAC, 0xAD, 0xA1, 0xA0, 0xA2)
 
@@ -493,7 +1562,7 @@ class RXCSniff:
                 offset += delta_ts_len
                 self.cumulative_ts += ts
 
-                if flags != 0 and flags != HF0_FIRST and flags != HF0_LAST:
+                if flags != 0 and flags != HF0_FIRST and flags != HF0_LAST and flags != HF0_MARKER:
                     print("PERR: %04X (%s)" % (flags, decode_flags(flags)))
 
                 if flags & HF0_FIRST:
@@ -519,8 +1588,8 @@ class RXCSniff:
                 self.ui.handlePacket(ts, buf, flags, orig_len)
 
             
-    def __init__(self):
-        self.service = RXCSniff.__RXCSniffService()
+    def __init__(self, stats=None):
+        self.service = RXCSniff.__RXCSniffService(stats)
 
 
 class SDRAMRead:
@@ -545,23 +1614,7 @@ class SDRAMRead:
             if self.__verbose and b:
                 print("SD> %s" % " ".join("%02x" % i for i in b))
 
-            self.__buf += b
-
-            incomplete = False
-
-            while self.__buf and not incomplete:
-                for service in self.__services:
-                    code = service.presentBytes(self.__buf)
-                    if code == INCOMPLETE:
-                        incomplete = True
-                        break
-                    elif code:
-                        self.__buf = self.__buf[code:]
-                        break
-                else:
-                    print("Unmatched byte %02x - discarding" % self.__buf[0])
-                    self.__buf = self.__buf[1:]
-            pass
+            self.__buf = dispatch(self.__buf + b, self.__services)
         
     def __init__(self, verbose, services):
         self.service = SDRAMRead.__SDRAMReadService(verbose, services)
@@ -582,41 +1635,105 @@ class Dummy:
     def __init__(self):
         self.service = Dummy.__DummyService()
 
+# Read queue of the streaming USB reader: 512 byte USB packets per bulk
+# transfer, and transfers kept submitted. See OVDevice.read_queue.
+DEFAULT_PACKETS_PER_TRANSFER = 8
+DEFAULT_NUM_TRANSFERS = 16
+
 class OVDevice:
-    def __init__(self, mapfile=None, verbose=False):
+    def __init__(self, mapfile=None, verbose=False, serial=None, dev=None, stats=None, io_timeout=None,
+                 regmap=None, read_queue=None, write_window=0.0):
         self.__is_open = False
 
-        self.dev = FTDIDevice()
+        # Register commands go through a WriteQueue coalescing them over
+        # this many seconds (0: only while earlier writes are in flight);
+        # None for a synchronous USB write per command. Needs a dev with
+        # write_async().
+        self.write_window = write_window
+        self.write_queue = None
+
+        # (packets per transfer, transfers) for the USB reader. Deeper
+        # queues ride out host scheduling hiccups, shallower ones have less
+        # data waiting in them; takes effect when the device is opened.
+        self.read_queue = read_queue or (DEFAULT_PACKETS_PER_TRANSFER, DEFAULT_NUM_TRANSFERS)
+
+        # Any object with the FTDIDevice interface can stand in for the
+        # hardware, see replay.ReplayDevice
+        self.dev = dev if dev is not None else FTDIDevice()
         self.verbose = verbose
+        self.serial = serial_string(serial)
 
         self.__addrmap = {}
+        self.__attrs = {}
 
         if mapfile:
             self.__parse_mapfile(mapfile)
 
+        # Already parsed map, e.g. from fwpkg.Package.regmap()
+        if regmap is not None:
+            self.__addrmap.update(regmap[0])
+            self.__attrs.update(regmap[1])
+
 
-        self.regs = self.__build_map(self.__addrmap, self.ioread, self.iowrite)
+        self.regs = self.__build_map(self.__addrmap, self.ioread, self.iowrite,
+                                     self.ioread_multi, self.iowrite_multi, self.__attrs)
         self.ulpiregs = self.__build_map({x: (y, 1) for x, y in SMSC_334x_MAP.items()}, self.ulpiread, self.ulpiwrite)
 
+        # Registers covering each address, for raw writes to invalidate
+        self.__regs_at = {}
+        for reg in self.regs:
+            for addr in range(reg.addr, reg.addr + reg.size):
+                self.__regs_at.setdefault(addr, []).append(reg)
+
 
         self.clkup = False
 
+        # Whether the gateware takes burst commands, see has_burst
+        self.__burst = None
+
+        # ULPI accesses are a sequence of register accesses on shared
+        # registers, one at a time
+        self.__ulpi_lock = threading.Lock()
 
-        self.io = IO()
+        self.io = IO(io_timeout)
 
         self.lfsrtest = LFSRTest()
-        self.rxcsniff = RXCSniff()
+        self.seqtest = SequenceTest()
+        self.rxcsniff = RXCSniff(stats)
+        self.status_records = StatusRecords()
+        self.ulpi_events = ULPIEvents()
         self.sdram_read = SDRAMRead(False, [self.rxcsniff.service])
         self.dummy = Dummy()
 
-        self.__services = [self.io.service, self.lfsrtest.service, self.rxcsniff.service, self.sdram_read.service, self.dummy.service]
+        # Optional per stage instrumentation, see StageStats
+        self.stats = stats
+        self.__dispatch = dispatch
+        if stats is not None:
+            self.__dispatch = stats.wrap("framing", dispatch)
+            stats.instrument(self.sdram_read.service, "consume", "sdram de-framing")
+            stats.instrument(self.rxcsniff.service, "consume", "packet parse")
 
-        # Inject a write function to the services
+        # Set to a cProfile.Profile to profile the USB reader thread
+        self.comm_profiler = None
+
+        # USB reader callbacks and bytes received, for telemetry
+        self.rx_callbacks = 0
+        self.rx_bytes = 0
+
+        self.__services = [self.io.service, self.lfsrtest.service, self.seqtest.service,
+                           self.status_records.service,
+                           self.ulpi_events.service,
+                           self.rxcsniff.service, self.sdram_read.service, self.dummy.service]
+
+        # Inject a write function to the services. With a write queue it
+        # returns a future for the write, see WriteQueue.
         for service in self.__services:
             def write(msg):
                 if self.verbose:
                     print("< %s" % " ".join("%02x" % i for i in msg))
 
+                if self.write_queue is not None:
+                    return self.write_queue.write(msg)
                 self.dev.write(FTDI_INTERFACE_A, msg, async_=False)
 
             service.write = write
@@ -629,22 +1746,10 @@ class OVDevice:
                 if self.verbose and b:
                     print("> %s" % " ".join("%02x" % i for i in b))
 
-                self.__buf += b
+                self.rx_callbacks += 1
+                self.rx_bytes += len(b)
 
-                incomplete = False
-
-                while self.__buf and not incomplete:
-                    for service in self.__services:
-                        code = service.presentBytes(self.__buf)
-                        if code == INCOMPLETE:
-                            incomplete = True
-                            break
-                        elif code:
-                            self.__buf = self.__buf[code:]
-                            break
-                    else:
-                        print("Unmatched byte %02x - discarding" % self.__buf[0])
-                        self.__buf = self.__buf[1:]
+                self.__buf = self.__dispatch(self.__buf + b, self.__services)
 
                 return int(self.__comm_term) 
             except Exception as e:
@@ -652,16 +1757,28 @@ class OVDevice:
                 self.__comm_exc = e
                 return 1
 
-        while not self.__comm_term:
-            self.dev.read_async(FTDI_INTERFACE_A, callback, 8, 16)
+        if self.stats is not None:
+            callback = self.stats.wrap("usb callback", callback)
+
+        if self.comm_profiler is not None:
+            self.comm_profiler.enable()
+
+        try:
+            while not self.__comm_term:
+                self.dev.read_async(FTDI_INTERFACE_A, callback, *self.read_queue)
+        finally:
+            if self.comm_profiler is not None:
+                self.comm_profiler.disable()
 
         if self.__comm_exc:
             raise self.__comm_exc
             
-    def __build_map(self, addrmap, readfn, writefn):
+    def __build_map(self, addrmap, readfn, writefn, readmultifn=None, writemultifn=None, attrs=None):
         d = {}
+        attrs = attrs or {}
         for name, (addr, size) in addrmap.items():
-            d[name] = _mapped_reg(readfn, writefn, name, addr, size)
+            d[name] = _mapped_reg(readfn, writefn, name, addr, size, readmultifn, writemultifn,
+                                  attrs.get(name))
 
         return _mapped_regs(d)
 
@@ -676,27 +1793,7 @@ class OVDevice:
 
 
     def __parse_mapfile(self, mapfile):
-
-        for line in mapfile.readlines():
-            line = line.strip().decode('utf-8')
-
-            line = re.sub('#.*', '', line)
-            if not line:
-                continue
-
-            m = re.match('\s*(\w+)\s*=\s*(\w+)(:\w+)?\s*', line)
-            if not m:
-                raise ValueError("Mapfile - could not parse %s" % line)
-
-            name = m.group(1)
-            value = int(m.group(2), 16)
-            if m.group(3) is None:
-                size = 1
-            else:
-                size = int(m.group(3)[1:], 16) + 1 - value
-                assert size > 1
-
-            self.__addrmap[name] = value, size
+        self.__addrmap.update(parse_mapfile(mapfile, self.__attrs))
 
 
     def resolve_addr(self, sym):
@@ -709,7 +1806,7 @@ class OVDevice:
             pass
 
         try:
-            return self.__addrmap[sym.upper()]
+            return self.__addrmap[sym.upper()][0]
         except KeyError:
             raise ValueError("No map for %s" % sym)
 
@@ -721,40 +1818,119 @@ class OVDevice:
         assert self.__is_open
         return self.loaded
 
-    def open(self, bitstream=None):
+    @property
+    def is_open(self):
+        return self.__is_open
+
+    @property
+    def build_id(self):
+        """
+        Build ID of the bitstream this register map belongs to, None if the
+        map doesn't record one
+        """
+        attrs = self.__attrs.get('IDENT_BUILD_ID')
+        if attrs is None or not attrs.reset:
+            return None
+        return attrs.reset
+
+    def running_build_id(self, timeout=1.0):
+        """
+        Build ID read back from the running gateware. Gateware from before
+        the ID register reads as 0; None if it didn't answer at all.
+        """
+        if 'IDENT_BUILD_ID' not in self.__addrmap:
+            return None
+
+        addr, size = self.__addrmap['IDENT_BUILD_ID']
+        try:
+            values = self.io.do_read_multi(range(addr, addr + size), timeout)
+        except TimeoutError:
+            # Whatever is loaded doesn't speak the protocol, its responses
+            # are not coming
+            self.io.reset()
+            return None
+
+        return int.from_bytes(bytes(values), 'big')
+
+    def gateware_matches(self):
+        """
+        Whether the running gateware is the build of this register map:
+        True or False, or None if the map has no build ID to compare with
+        """
+        if self.build_id is None:
+            return None
+        return self.running_build_id() == self.build_id
+
+    def __start_comms(self):
+        self.commthread = threading.Thread(target=self.__comms, daemon=True)
+        self.__comm_term = False
+        self.__comm_exc = None
+
+        self.commthread.start()
+
+        if self.write_window is not None and hasattr(self.dev, 'write_async'):
+            self.write_queue = WriteQueue(self.dev, FTDI_INTERFACE_A, self.write_window)
+
+    def __stop_comms(self):
+        # The reader thread handles the write completions, so it goes last
+        if self.write_queue is not None:
+            self.write_queue.close()
+            self.write_queue = None
+
+        self.__comm_term = True
+        self.commthread.join()
+
+    def open(self, bitstream=None, force=False):
+        """
+        Open the device, configuring the FPGA with bitstream if given: the
+        path of a .bit file (as bytes), a file-like .bit or ConfigData. Unless
+        force is set, configuration is skipped when the FPGA already runs the
+        same build (see build_id).
+        """
         if self.__is_open:
             raise ValueError("OVDevice doubly opened")
 
-        stat = self.dev.open()
+        stat = self.dev.open(self.serial)
         if stat:
             return stat
 
-        if not isinstance(bitstream, bytes) and hasattr(bitstream, 'read'):
+        if bitstream is not None and not force and self.build_id is not None \
+                and self.dev.config_status() == 0:
+            self.dev.hw_init(None)
 
-            # FIXME: Current bit_file code is heavily dependent on fstream ops
-            #  and isn't nice to call with a python file-like object
-            #
-            # Workaround this by emitting a tempfile
-            import tempfile
-            import os
+            self.__start_comms()
+            try:
+                running = self.running_build_id()
+            finally:
+                self.__stop_comms()
 
-            bitfile = tempfile.NamedTemporaryFile(delete=False)
+            if running == self.build_id:
+                if self.verbose:
+                    print("FPGA already runs build %#010x, not reloading" % running)
+                bitstream = None
 
-            try:
-                bitfile.write(bitstream.read())
-                bitfile.close()
+        if isinstance(bitstream, ConfigData):
+            err = self.dev.hw_init_config(bitstream)
+            if err:
+                self.dev.close()
+                return err
 
-                HW_Init(self.dev, bitfile.name.encode('ascii'))
-                self.loaded = True
-           
-            finally:
-                # Make sure we cleanup the tempfile
-                os.unlink(bitfile.name)
+            self.loaded = True
+
+        elif not isinstance(bitstream, bytes) and hasattr(bitstream, 'read'):
+            # Configured straight from memory, so a bitstream inside the
+            # fwpkg zip never touches the disk
+            err = self.dev.hw_init_buffer(bitstream.read())
+            if err:
+                self.dev.close()
+                return err
+
+            self.loaded = True
 
         elif isinstance(bitstream, bytes) or bitstream == None:
-            pre_load = FPGA_GetConfigStatus(self.dev) == 0
+            pre_load = self.dev.config_status() == 0
 
-            HW_Init(self.dev, bitstream)
+            self.dev.hw_init(bitstream)
             
             if bitstream:
                 self.loaded = True
@@ -762,55 +1938,285 @@ class OVDevice:
                 self.loaded = pre_load
 
         else:
-            raise TypeError("bitstream must be bytes or file-like")
-        
-    
-        self.commthread = threading.Thread(target=self.__comms, daemon=True)
-        self.__comm_term = False
-        self.__comm_exc = None
+            raise TypeError("bitstream must be bytes, file-like or ConfigData")
 
-        self.commthread.start()
+        # A freshly configured FPGA has every register at its reset value,
+        # otherwise nothing is known about them until read or written
+        if bitstream:
+            for reg in self.regs:
+                reg.load_reset()
+        else:
+            self.invalidate_cache()
 
-        self.__comm_term = False
+        self.__start_comms()
         self.__is_open = True
 
     def close(self):
         if not self.__is_open:
             raise ValueError("OVDevice doubly closed")
 
-        self.__comm_term = True
-        self.commthread.join()
+        self.__stop_comms()
 
         self.dev.close()
 
+        self.__burst = None
+        self.invalidate_cache()
         self.__is_open = False
 
 
     def ulpiread(self, addr):
-        assert self.__check_clkup()
+        return self.ulpi_batch([(addr, None)])[0]
 
-        self.regs.ucfg_rcmd.wr(UCFG_REG_GO | (addr & UCFG_REG_ADDRMASK))
-
-        while self.regs.ucfg_rcmd.rd() & UCFG_REG_GO:
-            pass
 
-        return self.regs.ucfg_rdata.rd()
+    def ulpiwrite(self, addr, value):
+        self.ulpi_batch([(addr, value)])
 
+    def ulpi_batch(self, ops, timeout=None):
+        """
+        ULPI register accesses, (addr, value) pairs with a value of None for
+        a read. Returns the values read (for writes, the value written).
 
-    def ulpiwrite(self, addr, value):
+        With the gateware access queue (UCFG_QCMD), up to ULPI_QUEUE_DEPTH
+        accesses go out in one USB write and complete on the events the
+        gateware pushes back, instead of polling each access to completion.
+        """
         assert self.__check_clkup()
 
+        if timeout is None:
+            timeout = self.io.timeout
+
+        with self.__ulpi_lock:
+            if 'UCFG_QCMD' not in self.regs:
+                return [self.__ulpi_polled(addr, value) for addr, value in ops]
+
+            values = []
+            for i in range(0, len(ops), ULPI_QUEUE_DEPTH):
+                values += self.__ulpi_queued(ops[i:i + ULPI_QUEUE_DEPTH], timeout)
+            return values
+
+    def ulpi_dump(self):
+        """
+        Every PHY register, read in one batch, as {name: value} in address
+        order. Leaves out the set/clear aliases and the interrupt latches,
+        which are cleared by reading them.
+        """
+        names = [name for name, addr in sorted(SMSC_334x_MAP.items(), key=lambda x: x[1])
+                 if not name.endswith(("_SET", "_CLR", "_LATCH"))]
+
+        values = self.ulpi_batch([(SMSC_334x_MAP[name], None) for name in names])
+        return dict(zip(names, values))
+
+    def ulpi_restore(self, values):
+        """
+        Write the registers of a ulpi_dump() back in one batch, except the
+        read-only ones. Returns the names of the registers written.
+        """
+        unknown = set(values) - set(SMSC_334x_MAP)
+        if unknown:
+            raise ValueError("Unknown ULPI registers: %s" % ", ".join(sorted(unknown)))
+
+        names = [name for name in values if name not in SMSC_334x_READONLY]
+        self.ulpi_batch([(SMSC_334x_MAP[name], values[name]) for name in names])
+        return names
+
+    def __ulpi_queued(self, ops, timeout):
+        events = self.ulpi_events.expect(addr for addr, _ in ops)
+
+        try:
+            with self.batch() as b:
+                for addr, value in ops:
+                    cmd = addr & UCFG_REG_ADDRMASK
+                    if value is not None:
+                        b.wr(self.regs.ucfg_wdata, value)
+                        cmd |= UCFG_QCMD_WRITE
+                    b.wr(self.regs.ucfg_qcmd, cmd)
+        except Exception:
+            # Some may have been queued; the cancelled futures absorb
+            # whatever events still arrive
+            for fut in events:
+                fut.cancel()
+            raise
+
+        return self.ulpi_events.wait(events, timeout)
+
+    def __ulpi_polled(self, addr, value):
+        if value is None:
+            self.regs.ucfg_rcmd.wr(UCFG_REG_GO | (addr & UCFG_REG_ADDRMASK))
+
+            while self.regs.ucfg_rcmd.rd() & UCFG_REG_GO:
+                pass
+
+            return self.regs.ucfg_rdata.rd()
+
         self.regs.ucfg_wdata.wr(value)
         self.regs.ucfg_wcmd.wr(UCFG_REG_GO | (addr & UCFG_REG_ADDRMASK))
-        
+
         while self.regs.ucfg_wcmd.rd() & UCFG_REG_GO:
             pass
 
+        return value
+
+    def drain(self):
+        """
+        Return once the reader thread is done with whatever it was handling
+        when this was called, e.g. so no packet handler is still running.
+        """
+        # The response is dispatched after everything received before it
+        self.io.do_read(0)
+
+    def capture_status(self):
+        """
+        Take a CaptureStatus snapshot. With the gateware status block this is
+        one latch and one burst read, see ovhw/capture_status.py; otherwise
+        the individual blocks are snapshotted and read in turn.
+        """
+        if 'CAPTURE_STATUS_LATCH' not in self.regs:
+            with self.batch() as b:
+                b.wr(self.regs.SDRAM_SINK_PTR_READ, 0)
+                b.wr(self.regs.OVF_INSERT_CTL, 0)
+
+                values = [b.rd(reg, cached=False) for reg in [
+                    self.regs.SDRAM_SINK_RPTR, self.regs.SDRAM_SINK_WPTR,
+                    self.regs.SDRAM_SINK_WRAP_COUNT, self.regs.OVF_INSERT_NUM_OVF,
+                    self.regs.OVF_INSERT_NUM_TOTAL]]
+
+            return CaptureStatus(*[v.result() for v in values], ts=None)
+
+        fields = [getattr(self.regs, 'capture_status_' + name) for name in CaptureStatus._fields]
+        start = min(reg.addr for reg in fields)
+        count = max(reg.addr + reg.size for reg in fields) - start
+
+        # Latch and read back in a single USB write
+        latch = [(self.regs.capture_status_latch.addr, 1)]
+        if self.has_burst:
+            txns = self.io.submit(latch, burst=(start, count))
+            data = sum(self.io.wait(txns)[1:], [])
+        else:
+            txns = self.io.submit(latch + [(addr, None) for addr in range(start, start + count)])
+            data = self.io.wait(txns)[1:]
+
+        values = []
+        for reg in fields:
+            offset = reg.addr - start
+            reg.shadow = int.from_bytes(bytes(data[offset:offset + reg.size]), 'big')
+            values.append(reg.shadow)
+
+        return CaptureStatus(*values)
+
+    def enable_status_records(self, interval):
+        """
+        Have the gateware push a CaptureStatus record into the stream every
+        interval seconds (rounded to microseconds); 0 or None stops them.
+        Records are handed to the status_records handlers. Returns False if
+        the gateware has no status records.
+        """
+        if 'CAPTURE_STATUS_INTERVAL' not in self.regs:
+            return False
+
+        reg = self.regs.capture_status_interval
+        us = int(round((interval or 0) * 1e6))
+        reg.wr(min(max(us, 0), (1 << (8 * reg.size)) - 1))
+        return True
+
+    def sample_clock(self):
+        """
+        Latch the gateware capture timestamp and pair it with the host clock.
+
+        Returns (ticks, monotonic, rtt) where ticks is relative to the start
+        of the current capture session, or None if the gateware has no
+        timestamp snapshot register.
+        """
+        if 'CSTREAM_TS_SNAPSHOT' not in self.regs:
+            return None
+
+        t0 = time.monotonic()
+        self.regs.cstream_ts_snapshot.wr(1)
+        t1 = time.monotonic()
+
+        ticks = self.regs.cstream_ts.rd() - self.regs.cstream_start_ts.rd()
+
+        return ticks & 0xFFFFFFFFFFFFFFFF, (t0 + t1) / 2, t1 - t0
+
     def ioread(self, addr):
         return self.io.do_read(self.resolve_addr(addr))
 
+    def forget_shadows(self, addrs):
+        """
+        Invalidate the registers covering addrs, after raw writes there.
+        _mapped_reg.wr sets the shadow again once its own write went
+        through.
+        """
+        for addr in addrs:
+            for reg in self.__regs_at.get(addr, ()):
+                reg.invalidate()
+
     def iowrite(self, addr, value):
-        return self.io.do_write(self.resolve_addr(addr), value)
+        addr = self.resolve_addr(addr)
+        try:
+            return self.io.do_write(addr, value)
+        finally:
+            self.forget_shadows([addr])
+
+    async def ioread_async(self, addr, timeout=None):
+        return await self.io.read_async(self.resolve_addr(addr), timeout)
+
+    async def iowrite_async(self, addr, value, timeout=None):
+        addr = self.resolve_addr(addr)
+        try:
+            return await self.io.write_async(addr, value, timeout)
+        finally:
+            self.forget_shadows([addr])
+
+    def batch(self):
+        return Batch(self)
+
+    def invalidate_cache(self):
+        """Forget the shadowed register values, e.g. after the FPGA was reset behind our back"""
+        for reg in self.regs:
+            reg.invalidate()
+
+    @property
+    def has_burst(self):
+        """True if the loaded gateware supports burst register commands"""
+        if self.__burst is None:
+            self.__burst = 'CMDPROC_FEATURES' in self.regs and \
+                bool(self.regs.cmdproc_features.rd() & CMDPROC_FEATURE_BURST)
+        return self.__burst
+
+    def ioread_burst(self, addr, count):
+        """Read count consecutive registers starting at addr"""
+        addr = self.resolve_addr(addr)
+        if self.has_burst:
+            return self.io.do_read_burst(addr, count)
+        return self.io.do_read_multi(range(addr, addr + count))
+
+    def iowrite_burst(self, addr, values):
+        """Write values to consecutive registers starting at addr, in address order"""
+        addr = self.resolve_addr(addr)
+        values = list(values)
+        try:
+            if self.has_burst:
+                return self.io.do_write_burst(addr, values)
+            return self.io.do_write_multi([(addr + i, v) for i, v in enumerate(values)])
+        finally:
+            self.forget_shadows(range(addr, addr + len(values)))
+
+    def ioread_multi(self, addrs):
+        addrs = [self.resolve_addr(addr) for addr in addrs]
+
+        # Consecutive addresses (multi-byte registers) take one burst command
+        if len(addrs) > 1 and addrs == list(range(addrs[0], addrs[0] + len(addrs))) \
+                and self.has_burst:
+            return self.io.do_read_burst(addrs[0], len(addrs))
+
+        return self.io.do_read_multi(addrs)
+
+    def iowrite_multi(self, writes):
+        writes = [(self.resolve_addr(addr), value) for addr, value in writes]
+        try:
+            return self.io.do_write_multi(writes)
+        finally:
+            self.forget_shadows([addr for addr, _ in writes])
 
 
 
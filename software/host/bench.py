@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+# Host pipeline benchmark
+#
+# Runs synthesised capture streams (see traffic.PROFILES) through the host
+# decoding stages and reports MB/sec and packets/sec for each, as JSON so
+# results can be tracked across commits.
+#
+# Stages build on each other: framing is the top level packet dispatch,
+# deframe adds the SDRAM burst de-framing, parse adds RXCSniff packet parsing,
+# and interp and the output-* stages add one packet handler on top of parse.
+# The "own" figures subtract the parent stage, giving the cost of a stage in
+# isolation. "realtime" is bus time covered per second of processing; below
+# 1.0 the host can not keep up with that traffic and captures will overflow.
+#
+# With --e2e the same profiles are also run through a complete OVDevice with a
+# replay device, as 'sniff --format pcap' would.
+
+import argparse
+import contextlib
+import json
+import os, os.path
+import platform
+import subprocess
+import sys
+import time
+
+import LibOV
+import fwpkg
+import ovctl
+import replay
+import traffic
+
+# OVDevice reads 8 FTDI packets per transfer
+CHUNK = 8 * 510
+
+MB = 1024 * 1024
+
+class _Bursts(LibOV.baseService):
+    """Sizes and drops SDRAM read bursts, leaving only the dispatch cost"""
+    MAGIC = 0xD0
+    NEEDED_FOR_SIZE = 2
+
+    def getPacketSize(self, buf):
+        return (buf[1] + 1) * 2 + 2
+
+    def consume(self, buf):
+        pass
+
+class _Discard:
+    def presentBytes(self, b):
+        return len(b)
+
+
+def make_stream(source, size):
+    data = bytearray(traffic.session_marker(LibOV.HF0_FIRST))
+    ticks = 0
+    for chunk, t in source:
+        data += chunk
+        ticks += t
+        if len(data) >= size:
+            break
+    return bytes(data), ticks
+
+def run(data, services):
+    buf = b""
+    start = time.perf_counter()
+    for i in range(0, len(data), CHUNK):
+        buf = LibOV.dispatch(buf + data[i:i + CHUNK], services)
+    return time.perf_counter() - start
+
+def sniff_services(highspeed, handlers):
+    rx = LibOV.RXCSniff()
+    rx.service.highspeed = highspeed
+    rx.service.handlers = handlers(rx.service)
+    return [LibOV.SDRAMRead(False, [rx.service]).service]
+
+def stages(highspeed, null, counter):
+    speed = "hs" if highspeed else "fs"
+
+    # name, parent, services
+    return [
+        ("framing", None, lambda: [_Bursts()]),
+        ("deframe", "framing", lambda: [LibOV.SDRAMRead(False, [_Discard()]).service]),
+        ("parse", "deframe", lambda: sniff_services(highspeed, lambda rx: [counter])),
+        ("interp", "parse", lambda: sniff_services(highspeed, lambda rx: [rx.handle_usb_verbose])),
+        ("output-pcap", "parse", lambda: sniff_services(highspeed,
+            lambda rx: [ovctl.OutputPcap(null).handle_usb])),
+        ("output-pcapng", "parse", lambda: sniff_services(highspeed,
+            lambda rx: [ovctl.OutputPcapng(null).handle_usb])),
+        ("output-raw", "parse", lambda: sniff_services(highspeed,
+            lambda rx: [ovctl.OutputRaw(null).handle_usb])),
+        ("output-custom", "parse", lambda: sniff_services(highspeed,
+            lambda rx: [ovctl.OutputCustom(null, speed).handle_usb])),
+        ("output-iti1480a", "parse", lambda: sniff_services(highspeed,
+            lambda rx: [ovctl.OutputITI1480A(null, speed).handle_usb])),
+    ]
+
+def rates(seconds, nbytes, packets, bus_seconds):
+    return {
+        "seconds": seconds,
+        "mb_per_sec": nbytes / MB / seconds if seconds > 0 else None,
+        "packets_per_sec": packets / seconds if seconds > 0 else None,
+        "realtime": bus_seconds / seconds if seconds > 0 else None,
+    }
+
+def bench_profile(name, size, repeat, only=None):
+    source = traffic.PROFILES[name]()
+    data, ticks = make_stream(source, size)
+    bus_seconds = ticks / 60e6
+
+    null = open(os.devnull, "wb")
+    packets = [0]
+    def counter(ts, pkt, flags, orig_len):
+        packets[0] += 1
+
+    result = {
+        "bytes": len(data),
+        "bus_seconds": bus_seconds,
+        "stages": {},
+    }
+
+    times = {}
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        for stage, parent, services in stages(source.highspeed, null, counter):
+            if only and stage not in only and stage != "parse":
+                continue
+
+            best = None
+            for i in range(repeat):
+                packets[0] = 0
+                t = run(data, services())
+                if best is None or t < best:
+                    best = t
+            times[stage] = best
+
+            if stage == "parse":
+                result["packets"] = packets[0]
+
+    for stage, parent, services in stages(source.highspeed, null, counter):
+        if stage not in times or (only and stage not in only):
+            continue
+        r = rates(times[stage], len(data), result["packets"], bus_seconds)
+        if parent in times:
+            r["own_seconds"] = times[stage] - times[parent]
+        result["stages"][stage] = r
+
+    null.close()
+    return result
+
+def bench_end_to_end(name, pkg, seconds):
+    source = traffic.PROFILES[name]()
+    rdev = replay.ReplayDevice(pkg.open('map.txt', 'r'), source)
+    dev = LibOV.OVDevice(mapfile=pkg.open('map.txt', 'r'), dev=rdev)
+
+    null = open(os.devnull, "wb")
+    packets = [0]
+    def counter(ts, pkt, flags, orig_len):
+        packets[0] += 1
+
+    dev.open()
+    try:
+        session = ovctl.SniffSession(dev, "hs" if source.highspeed else "fs")
+        session.setup()
+        dev.rxcsniff.service.handlers = [counter, ovctl.OutputPcap(null, session.clock).handle_usb]
+
+        session.start()
+        start = time.perf_counter()
+        time.sleep(seconds)
+        session.stop()
+        elapsed = time.perf_counter() - start
+        dev.rxcsniff.service.handlers = []
+    finally:
+        dev.close()
+        null.close()
+
+    r = rates(elapsed, rdev.streamed, packets[0], rdev.ts / 60e6)
+    r["bytes"] = rdev.streamed
+    r["packets"] = packets[0]
+    return r
+
+def git_commit():
+    try:
+        p = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                           cwd=os.path.dirname(os.path.realpath(__file__)))
+    except OSError:
+        return None
+    return p.stdout.decode().strip() or None
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark the host capture pipeline")
+    ap.add_argument("--profile", action="append", choices=list(traffic.PROFILES),
+                    help="Traffic profile to run, may be repeated (default: all)")
+    ap.add_argument("--stage", action="append",
+                    help="Only run this stage, may be repeated (default: all)")
+    ap.add_argument("--size", type=float, default=4,
+                    help="MB of capture stream per profile")
+    ap.add_argument("--repeat", type=int, default=3,
+                    help="Runs per stage, the fastest is reported")
+    ap.add_argument("--e2e", type=float, default=0, metavar="SECONDS",
+                    help="Also run each profile end to end through OVDevice for this long")
+    ap.add_argument("--pkg", "-p", type=fwpkg.Package,
+                    default=ovctl.default_package,
+                    help="Firmware package providing map.txt for --e2e")
+    ap.add_argument("--out", "-o", type=str,
+                    help="Write JSON results to this file instead of stdout")
+    args = ap.parse_args()
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "time": time.time(),
+        "profiles": {},
+    }
+
+    for name in args.profile or traffic.PROFILES:
+        r = bench_profile(name, int(args.size * MB), args.repeat, args.stage)
+        if args.e2e:
+            r["end_to_end"] = bench_end_to_end(name, args.pkg, args.e2e)
+        results["profiles"][name] = r
+
+        print("%s: %d kB, %d packets, %.3f s of bus time" % (
+            name, r["bytes"] / 1024, r["packets"], r["bus_seconds"]), file=sys.stderr)
+        for stage, s in r["stages"].items():
+            print("  %-16s %8.2f MB/sec %10.0f packets/sec %7.2fx realtime" % (
+                stage, s["mb_per_sec"], s["packets_per_sec"], s["realtime"]), file=sys.stderr)
+        if "end_to_end" in r:
+            s = r["end_to_end"]
+            print("  %-16s %8.2f MB/sec %10.0f packets/sec %7.2fx realtime" % (
+                "end-to-end", s["mb_per_sec"], s["packets_per_sec"], s["realtime"]), file=sys.stderr)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -48,9 +48,37 @@ static int           bitfile_read_int          (struct bitfile *self, int bytes)
  */
 static char*         bitfile_read_string       (struct bitfile *self);
 
+/* Byte and block reads from either the file or the buffer, with the
+ * semantics of fgetc() and of fread() with a count of 1.
+ */
+static int           bitfile_getc              (struct bitfile *self);
+static size_t        bitfile_fread             (struct bitfile *self, void *ptr, size_t size);
+
 /*********************************************************************/
 
 
+static int bitfile_getc(struct bitfile *self)
+{
+  if (self->file)
+    return fgetc(self->file);
+
+  if (self->buffer_pos >= self->buffer_length)
+    return EOF;
+  return self->buffer[self->buffer_pos++];
+}
+
+static size_t bitfile_fread(struct bitfile *self, void *ptr, size_t size)
+{
+  if (self->file)
+    return fread(ptr, size, 1, self->file);
+
+  if (self->buffer_length - self->buffer_pos < size)
+    return 0;
+  memcpy(ptr, self->buffer + self->buffer_pos, size);
+  self->buffer_pos += size;
+  return 1;
+}
+
 static int bitfile_read_header(struct bitfile *self)
 {
   static const unsigned char ref_magic[] = {0x00, 0x09, 0x0F, 0xF0,
@@ -62,14 +90,14 @@ static int bitfile_read_header(struct bitfile *self)
   int n_fields;
 
   /* The file begins with a 13-byte magic number identifying it as a BIT file */
-  if (fread(file_magic, sizeof(ref_magic), 1, self->file) < 1)
+  if (bitfile_fread(self, file_magic, sizeof(ref_magic)) < 1)
     return -1;
   if (memcmp(file_magic, ref_magic, sizeof(ref_magic)))
     return -1;
 
   /* Every other section is identified by a type character */
   n_fields = 0;
-  while ((code = fgetc(self->file)) != EOF) {
+  while ((code = bitfile_getc(self)) != EOF) {
     n_fields++;
     if (bitfile_handle_hdr_field(self, (unsigned char) code))
       break;
@@ -116,7 +144,7 @@ static int bitfile_read_int(struct bitfile *self, int bytes)
   word = 0;
   for (i=0; i<bytes; i++) {
     word <<= 8;
-    byte = fgetc(self->file);
+    byte = bitfile_getc(self);
     if (byte == EOF)
       return -1;
     word |= byte;
@@ -139,7 +167,7 @@ static char* bitfile_read_string(struct bitfile *self)
     return NULL;
   str[length] = '\0';
 
-  if (fread(str, length, 1, self->file) < 1) {
+  if (bitfile_fread(self, str, length) < 1) {
     free(str);
     return NULL;
   }
@@ -172,6 +200,24 @@ struct bitfile* bitfile_new_from_path(const char *path)
   return bitfile_new_from_file(f);
 }
 
+struct bitfile* bitfile_new_from_buffer(const unsigned char *buffer, size_t length)
+{
+  struct bitfile *self;
+
+  self = malloc(sizeof(struct bitfile));
+  if (!self)
+    return NULL;
+  memset(self, 0, sizeof(struct bitfile));
+
+  self->buffer = buffer;
+  self->buffer_length = length;
+  if (bitfile_read_header(self) < 0) {
+    bitfile_delete(self);
+    return NULL;
+  }
+  return self;
+}
+
 void bitfile_delete(struct bitfile *self)
 {
   if (self->file)
@@ -193,17 +239,21 @@ int bitfile_read_content(struct bitfile *self)
 {
   if (self->data)
     return -1;
-  if (!self->file)
+  if (!self->file && !self->buffer)
+    return -1;
+  if (self->length <= 0)
     return -1;
 
   self->data = malloc(self->length);
   if (!self->data)
     return -1;
-  if (fread(self->data, self->length, 1, self->file) < 1)
+  if (bitfile_fread(self, self->data, self->length) < 1)
     return -1;
 
-  fclose(self->file);
+  if (self->file)
+    fclose(self->file);
   self->file = NULL;
+  self->buffer = NULL;
 
   return self->length;
 }
@@ -36,6 +36,13 @@ struct bitfile {
   /* Only present if the file hasn't been read in completely yet */
   FILE *file;
 
+  /* Or, for a bit file parsed from memory, the caller's buffer
+   * and the read position in it, until the content is read.
+   */
+  const unsigned char *buffer;
+  size_t buffer_length;
+  size_t buffer_pos;
+
   /* Metadata */
   char *ncd_filename;
   char *part_number;
@@ -56,6 +63,13 @@ struct bitfile {
  */
 struct bitfile*      bitfile_new_from_file     (FILE* f);
 struct bitfile*      bitfile_new_from_path     (const char *path);
+
+/* Create a bitfile instance from a .bit file already in memory.
+ * The buffer is not copied and must outlive the bitfile instance,
+ * or at least the call to bitfile_read_content. Returns NULL on error.
+ */
+struct bitfile*      bitfile_new_from_buffer   (const unsigned char *buffer,
+                                                size_t length);
 void                 bitfile_delete            (struct bitfile *self);
 
 /* The bit file's header is read immediately, but content is not read
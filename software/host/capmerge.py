@@ -0,0 +1,84 @@
+import collections
+import heapq
+import threading
+import time
+
+class StreamMerger:
+    """
+    Merges the packet streams of several capture devices into one output,
+    ordered by host-corrected timestamp.
+
+    Each device gets a handler (see handler()) that converts its capture
+    timestamps with the device's clock correlator and queues the packet.
+    A merge thread keeps one head entry per device in a heap and writes the
+    oldest packet once every device has something queued, or once the
+    oldest packet is more than 'max_delay' seconds old, so a quiet bus on
+    one device does not stall the others indefinitely.
+    """
+
+    def __init__(self, count, write, max_delay=1.0):
+        self.write = write
+        self.max_delay = max_delay
+
+        self.__queues = [collections.deque() for i in range(count)]
+        self.__seq = 0
+        self.__heap = []
+        self.__in_heap = [False] * count
+
+        self.__term = False
+        self.__thread = None
+
+    def handler(self, index, clock):
+        queue = self.__queues[index]
+
+        def handle_usb(ts, pkt, flags, orig_len):
+            if len(pkt) == 0:
+                return
+            queue.append((clock.to_realtime_ns(ts), index, pkt, orig_len))
+
+        return handle_usb
+
+    def pending(self):
+        return sum(len(q) for q in self.__queues) + len(self.__heap)
+
+    def __refill(self):
+        for index, queue in enumerate(self.__queues):
+            if not self.__in_heap[index] and queue:
+                ts_ns, index, pkt, orig_len = queue.popleft()
+                # seq breaks ties between equal timestamps without comparing
+                # packet payloads
+                heapq.heappush(self.__heap, (ts_ns, self.__seq, index, pkt, orig_len))
+                self.__seq += 1
+                self.__in_heap[index] = True
+
+    def __drain(self, flush=False):
+        while True:
+            self.__refill()
+            if not self.__heap:
+                return
+
+            ts_ns = self.__heap[0][0]
+            if not (flush or all(self.__in_heap) or
+                    ts_ns < time.time_ns() - self.max_delay * 1e9):
+                return
+
+            ts_ns, _, index, pkt, orig_len = heapq.heappop(self.__heap)
+            self.__in_heap[index] = False
+            self.write(index, ts_ns, pkt, orig_len)
+
+    def __run(self):
+        while not self.__term:
+            self.__drain()
+            time.sleep(0.01)
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """Stop the merge thread and write out everything still queued."""
+        self.__term = True
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        self.__drain(flush=True)
@@ -0,0 +1,122 @@
+import time
+import collections
+
+# Capture timestamps count ULPI clocks; the PHY is clocked from its own
+# crystal so the real rate is only nominally 60 MHz.
+TS_RATE = 60e6
+
+class ClockCorrelator:
+    """
+    Maps capture timestamps (ULPI clocks since the start of capture) to host
+    wall-clock time.
+
+    Samples pair a gateware timestamp with the host monotonic and realtime
+    clocks taken around the register access that latched it. Offset and
+    drift are fitted incrementally with an exponentially weighted linear
+    regression so that the fit follows slow temperature-induced drift of the
+    PHY crystal. Until the first sample is added, timestamps are mapped using
+    the nominal rate from the time the correlator was created, which is what
+    the outputs used to do unconditionally.
+    """
+
+    def __init__(self, nominal_rate=TS_RATE, forget=0.99, rtt_factor=2.0,
+                 rtt_window=16):
+        self.nominal_rate = nominal_rate
+        self.forget = forget
+        self.rtt_factor = rtt_factor
+
+        # Fallback anchor: capture starts "now"
+        self.anchor_mono = time.monotonic()
+        self.__update_real_offset()
+
+        self.samples = 0
+        self.rejected = 0
+        self.best_rtt = None
+        # Round trips of the most recent samples, accepted or not. The
+        # reference is their minimum so that one lucky sample, or a bus that
+        # got busier since, can't have every later sample rejected.
+        self.__rtts = collections.deque(maxlen=rtt_window)
+
+        # Weighted running statistics, x in nominal seconds, y in host
+        # monotonic seconds, both relative to the first sample to keep the
+        # numbers small.
+        self.__x0 = None
+        self.__y0 = None
+        self.__w = 0.0
+        self.__mx = 0.0
+        self.__my = 0.0
+        self.__cxx = 0.0
+        self.__cxy = 0.0
+
+    def __update_real_offset(self):
+        # Kept in integer nanoseconds; a float epoch time cannot resolve a
+        # single 16.7 ns tick.
+        self.real_offset_ns = time.time_ns() - time.monotonic_ns()
+
+    def add_sample(self, ticks, mono, rtt=0.0):
+        """
+        Add a correlation sample. 'mono' is the host monotonic clock at the
+        moment the gateware latched 'ticks', 'rtt' is the width of the window
+        the latch happened in. Samples with an unusually long round trip are
+        dropped, they carry mostly USB jitter; "unusually" is relative to the
+        best round trip among the last rtt_window samples. The realtime clock
+        is paired with the monotonic clock at every sample so NTP adjustments
+        of the host clock are followed.
+
+        Returns False if the sample was rejected.
+        """
+        self.__rtts.append(rtt)
+        self.best_rtt = min(self.__rtts)
+        if rtt > self.best_rtt * self.rtt_factor + 1e-4:
+            self.rejected += 1
+            return False
+
+        x = ticks / self.nominal_rate
+
+        if self.__x0 is None:
+            self.__x0 = x
+            self.__y0 = mono
+
+        x -= self.__x0
+        y = mono - self.__y0
+
+        self.__w = self.__w * self.forget + 1.0
+        alpha = 1.0 / self.__w
+
+        dx = x - self.__mx
+        dy = y - self.__my
+        self.__mx += alpha * dx
+        self.__my += alpha * dy
+        self.__cxx = self.__cxx * self.forget + dx * (x - self.__mx)
+        self.__cxy = self.__cxy * self.forget + dx * (y - self.__my)
+
+        self.__update_real_offset()
+        self.samples += 1
+        return True
+
+    @property
+    def rate(self):
+        """Ratio of host seconds per nominal capture second."""
+        if self.samples < 2 or self.__cxx <= 0:
+            return 1.0
+        return self.__cxy / self.__cxx
+
+    @property
+    def drift_ppm(self):
+        """How fast the capture clock runs relative to the host, in ppm."""
+        return (1.0 / self.rate - 1.0) * 1e6
+
+    def to_monotonic(self, ticks):
+        x = ticks / self.nominal_rate
+
+        if not self.samples:
+            return self.anchor_mono + x
+
+        return self.__y0 + self.__my + self.rate * (x - self.__x0 - self.__mx)
+
+    def to_realtime_ns(self, ticks):
+        """Absolute time of 'ticks' in integer nanoseconds since the epoch."""
+        return self.real_offset_ns + int(self.to_monotonic(ticks) * 1e9)
+
+    def to_realtime(self, ticks):
+        return self.to_realtime_ns(ticks) / 1e9
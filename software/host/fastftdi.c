@@ -43,6 +43,16 @@ typedef struct {
    FTDIProgressInfo progress;
 } FTDIStreamState;
 
+typedef struct {
+   FTDIFillCallback *fill;
+   void *userdata;
+   const uint8_t *data;
+   size_t remaining;
+   size_t blockSize;
+   int inFlight;
+   int result;
+} FTDIWriteStreamState;
+
 static int
 DeviceInit(FTDIDevice *dev)
 {
@@ -86,8 +96,8 @@ DeviceRelease(FTDIDevice *dev)
   return 0;
 }
 
-int
-FTDIDevice_Open(FTDIDevice *dev)
+static int
+ContextInit(FTDIDevice *dev)
 {
   int err;
 
@@ -103,6 +113,25 @@ FTDIDevice_Open(FTDIDevice *dev)
 	libusb_set_debug(dev->libusb, 2);
 #endif
 
+  return 0;
+}
+
+static bool
+IsOurDevice(const struct libusb_device_descriptor *desc)
+{
+  return (desc->idVendor == OV_VENDOR && desc->idProduct == OV_PRODUCT) ||
+         (desc->idVendor == FTDI_VENDOR && desc->idProduct == FTDI_PRODUCT_FT2232H);
+}
+
+int
+FTDIDevice_Open(FTDIDevice *dev)
+{
+  int err;
+
+  if ((err = ContextInit(dev))) {
+    return err;
+  }
+
   dev->handle = libusb_open_device_with_vid_pid(dev->libusb,
 						OV_VENDOR,
 						OV_PRODUCT);
@@ -121,6 +150,70 @@ FTDIDevice_Open(FTDIDevice *dev)
 }
 
 
+/*
+ * Open the device whose USB serial number string (as programmed into
+ * the EEPROM, e.g. "OV000042") matches 'serial'. With a NULL serial
+ * this is the same as FTDIDevice_Open().
+ */
+
+int
+FTDIDevice_OpenBySerial(FTDIDevice *dev, const char *serial)
+{
+  libusb_device **list;
+  ssize_t count, i;
+  int err;
+
+  if (!serial) {
+    return FTDIDevice_Open(dev);
+  }
+
+  if ((err = ContextInit(dev))) {
+    return err;
+  }
+
+  count = libusb_get_device_list(dev->libusb, &list);
+  if (count < 0) {
+    libusb_exit(dev->libusb);
+    return (int) count;
+  }
+
+  for (i = 0; i < count && !dev->handle; i++) {
+    struct libusb_device_descriptor desc;
+    libusb_device_handle *handle;
+    unsigned char str[64];
+
+    if (libusb_get_device_descriptor(list[i], &desc) || !IsOurDevice(&desc))
+      continue;
+
+    if (!desc.iSerialNumber || libusb_open(list[i], &handle))
+      continue;
+
+    if (libusb_get_string_descriptor_ascii(handle, desc.iSerialNumber,
+                                           str, sizeof str) > 0 &&
+        !strcmp((const char *) str, serial)) {
+      dev->handle = handle;
+    } else {
+      libusb_close(handle);
+    }
+  }
+
+  libusb_free_device_list(list, 1);
+
+  if (!dev->handle) {
+    libusb_exit(dev->libusb);
+    return LIBUSB_ERROR_NO_DEVICE;
+  }
+
+  if ((err = DeviceInit(dev))) {
+    libusb_close(dev->handle);
+    libusb_exit(dev->libusb);
+    return err;
+  }
+
+  return 0;
+}
+
+
 void
 FTDIDevice_Close(FTDIDevice *dev)
 {
@@ -250,6 +343,101 @@ FTDIDevice_Write(FTDIDevice *dev, FTDIInterface interface,
 }
 
 
+/*
+ * Per transfer state of FTDIDevice_WriteAsync.
+ */
+
+typedef struct {
+   FTDIWriteCallback *callback;
+   void *userdata;
+} FTDIWriteAsyncState;
+
+
+static void LIBUSB_CALL
+WriteAsyncCompleteCallback(struct libusb_transfer *transfer)
+{
+   FTDIWriteAsyncState *state = transfer->user_data;
+   int status;
+
+   switch (transfer->status) {
+   case LIBUSB_TRANSFER_COMPLETED:
+      status = transfer->actual_length == transfer->length ? 0 : LIBUSB_ERROR_IO;
+      break;
+   case LIBUSB_TRANSFER_TIMED_OUT:
+      status = LIBUSB_ERROR_TIMEOUT;
+      break;
+   case LIBUSB_TRANSFER_NO_DEVICE:
+      status = LIBUSB_ERROR_NO_DEVICE;
+      break;
+   case LIBUSB_TRANSFER_CANCELLED:
+      status = LIBUSB_ERROR_INTERRUPTED;
+      break;
+   default:
+      status = LIBUSB_ERROR_IO;
+      break;
+   }
+
+   if (state->callback) {
+      state->callback(status, state->userdata);
+   }
+
+   free(state);
+   free(transfer->buffer);
+   libusb_free_transfer(transfer);
+}
+
+
+/*
+ * Asynchronous write with a completion callback, which gets 0 or a libusb
+ * error code. Like all transfer completions it is called from whichever
+ * thread handles libusb events, normally the one in
+ * FTDIDevice_ReadStream(), so the stream has to be running. The data is
+ * copied, the caller's buffer can be reused straight away. Returns an
+ * error if the transfer could not be submitted, the callback is not
+ * called then.
+ */
+
+int
+FTDIDevice_WriteAsync(FTDIDevice *dev, FTDIInterface interface,
+                      const uint8_t *data, size_t length,
+                      FTDIWriteCallback *callback, void *userdata)
+{
+   struct libusb_transfer *transfer;
+   FTDIWriteAsyncState *state;
+   uint8_t *buffer;
+   int err;
+
+   transfer = libusb_alloc_transfer(0);
+   state = malloc(sizeof *state);
+   buffer = malloc(length ? length : 1);
+
+   if (!transfer || !state || !buffer) {
+      libusb_free_transfer(transfer);
+      free(state);
+      free(buffer);
+      return LIBUSB_ERROR_NO_MEM;
+   }
+
+   state->callback = callback;
+   state->userdata = userdata;
+   memcpy(buffer, data, length);
+
+   libusb_fill_bulk_transfer(transfer, dev->handle, FTDI_EP_OUT(interface),
+                             buffer, length, WriteAsyncCompleteCallback, state,
+                             FTDI_COMMAND_TIMEOUT);
+
+   err = libusb_submit_transfer(transfer);
+   if (err) {
+      libusb_free_transfer(transfer);
+      free(state);
+      free(buffer);
+      return err;
+   }
+
+   return 0;
+}
+
+
 int
 FTDIDevice_WriteByteSync(FTDIDevice *dev, FTDIInterface interface, uint8_t byte)
 {
@@ -489,6 +677,140 @@ FTDIDevice_ReadStream(FTDIDevice *dev, FTDIInterface interface,
       return state.result;
 }
 
+/*
+ * Queue the next block of a write stream on 'transfer'. With a fill
+ * callback the block is produced in the transfer's own buffer, otherwise
+ * the transfer points straight at the caller's data.
+ */
+
+static int
+WriteStreamSubmit(FTDIWriteStreamState *state, struct libusb_transfer *transfer)
+{
+   size_t chunk = state->remaining;
+   int err;
+
+   if (chunk > state->blockSize)
+      chunk = state->blockSize;
+
+   if (state->fill)
+      state->fill(transfer->buffer, state->data, chunk, state->userdata);
+   else
+      transfer->buffer = (uint8_t *) state->data;
+
+   transfer->length = chunk;
+   state->data += chunk;
+   state->remaining -= chunk;
+
+   transfer->status = -1;
+   err = libusb_submit_transfer(transfer);
+   if (!err)
+      state->inFlight++;
+   return err;
+}
+
+
+static void LIBUSB_CALL
+WriteStreamCallback(struct libusb_transfer *transfer)
+{
+   FTDIWriteStreamState *state = transfer->user_data;
+
+   state->inFlight--;
+
+   if (transfer->status != LIBUSB_TRANSFER_COMPLETED ||
+       transfer->actual_length != transfer->length) {
+      if (!state->result)
+         state->result = LIBUSB_ERROR_IO;
+      return;
+   }
+
+   if (state->result == 0 && state->remaining)
+      state->result = WriteStreamSubmit(state, transfer);
+}
+
+
+/*
+ * Write 'length' bytes with up to numTransfers asynchronous transfers of
+ * blockSize bytes in flight, so the device never waits for the host
+ * between blocks. If 'fill' is given, each block is produced by it from
+ * the corresponding part of 'data' just before it is queued (e.g. to
+ * transform the data while earlier blocks are on the wire); otherwise
+ * 'data' is sent as is, without copying. Blocks arrive in order.
+ *
+ * Returns 0 once everything is written, or a libusb error code.
+ */
+
+int
+FTDIDevice_WriteStream(FTDIDevice *dev, FTDIInterface interface,
+                       const uint8_t *data, size_t length,
+                       FTDIFillCallback *fill, void *userdata,
+                       int blockSize, int numTransfers)
+{
+   struct libusb_transfer **transfers;
+   FTDIWriteStreamState state = { fill, userdata, data, length, blockSize };
+   int xferIndex;
+
+   transfers = calloc(numTransfers, sizeof *transfers);
+   if (!transfers)
+      return LIBUSB_ERROR_NO_MEM;
+
+   for (xferIndex = 0; xferIndex < numTransfers && state.remaining; xferIndex++) {
+      struct libusb_transfer *transfer;
+
+      transfer = libusb_alloc_transfer(0);
+      transfers[xferIndex] = transfer;
+      if (!transfer) {
+         state.result = LIBUSB_ERROR_NO_MEM;
+         break;
+      }
+
+      libusb_fill_bulk_transfer(transfer, dev->handle, FTDI_EP_OUT(interface),
+                                fill ? malloc(blockSize) : NULL, 0, WriteStreamCallback,
+                                &state, FTDI_COMMAND_TIMEOUT);
+
+      if (fill && !transfer->buffer) {
+         state.result = LIBUSB_ERROR_NO_MEM;
+         break;
+      }
+
+      state.result = WriteStreamSubmit(&state, transfer);
+      if (state.result)
+         break;
+   }
+
+   /*
+    * Run until every queued block is done. On error, cancel whatever
+    * is still queued and wait for the cancellations.
+    */
+
+   while (state.inFlight) {
+      struct timeval timeout = { 0, 10000 };
+
+      if (state.result) {
+         for (xferIndex = 0; xferIndex < numTransfers; xferIndex++) {
+            struct libusb_transfer *transfer = transfers[xferIndex];
+
+            if (transfer && transfer->status == -1)
+               libusb_cancel_transfer(transfer);
+         }
+      }
+
+      libusb_handle_events_timeout(dev->libusb, &timeout);
+   }
+
+   for (xferIndex = 0; xferIndex < numTransfers; xferIndex++) {
+      struct libusb_transfer *transfer = transfers[xferIndex];
+
+      if (transfer) {
+         if (fill)
+            free(transfer->buffer);
+         libusb_free_transfer(transfer);
+      }
+   }
+   free(transfers);
+
+   return state.result;
+}
+
 /* MPSSE mode support -- see
  * http://www.ftdichip.com/Support/Documents/AppNotes/AN_108_Command_Processor_for_MPSSE_and_MCU_Host_Bus_Emulation_Modes.pdf
  */
@@ -113,12 +113,18 @@ typedef struct {
 typedef int (FTDIStreamCallback)(uint8_t *buffer, int length,
                                  FTDIProgressInfo *progress, void *userdata);
 
+typedef void (FTDIFillCallback)(uint8_t *buffer, const uint8_t *data, size_t length,
+                                void *userdata);
+
+typedef void (FTDIWriteCallback)(int status, void *userdata);
+
 
 /*
  * Public Functions
  */
 
 OV_API int FTDIDevice_Open(FTDIDevice *dev);
+OV_API int FTDIDevice_OpenBySerial(FTDIDevice *dev, const char *serial);
 OV_API void FTDIDevice_Close(FTDIDevice *dev);
 OV_API int FTDIDevice_Reset(FTDIDevice *dev);
 
@@ -129,6 +135,15 @@ OV_API int FTDIDevice_SetMode(FTDIDevice *dev, FTDIInterface interface,
 OV_API int FTDIDevice_Write(FTDIDevice *dev, FTDIInterface interface,
                      uint8_t *data, size_t length, bool async);
 
+OV_API int FTDIDevice_WriteAsync(FTDIDevice *dev, FTDIInterface interface,
+                          const uint8_t *data, size_t length,
+                          FTDIWriteCallback *callback, void *userdata);
+
+OV_API int FTDIDevice_WriteStream(FTDIDevice *dev, FTDIInterface interface,
+                           const uint8_t *data, size_t length,
+                           FTDIFillCallback *fill, void *userdata,
+                           int blockSize, int numTransfers);
+
 OV_API int FTDIDevice_WriteByteSync(FTDIDevice *dev, FTDIInterface interface, uint8_t byte);
 OV_API int FTDIDevice_ReadByteSync(FTDIDevice *dev, FTDIInterface interface, uint8_t *byte);
 
@@ -95,20 +95,19 @@
 
 
 #define NUM_EXTRA_CLOCKS   512
-#define BLOCK_SIZE         (16 * 1024)
 
+/*
+ * Configuration data goes out in large blocks with several USB transfers
+ * queued, bit-reversing each block just before it is queued while the
+ * previous ones are on the wire.
+ */
+#define BLOCK_SIZE         (64 * 1024)
+#define NUM_TRANSFERS      4
 
-static int
-ConfigSendBuffer(FTDIDevice *dev, uint8_t *data, size_t length)
-{
-  /*
-   * Send raw configuration data.
-   *
-   * We're using the slave parallel (SelectMAP) interface, which requires
-   * all bits to be swapped. (Why don't they just label the data pins in
-   * the opposite order? Beats me...)
-   */
 
+static void
+ConfigReverseBits(uint8_t *buffer, const uint8_t *data, size_t length, void *userdata)
+{
   /*
    * This is a clever macro-generated table for reversing bits in a byte,
    * contributed to http://graphics.stanford.edu/~seander/bithacks.html
@@ -121,27 +120,30 @@ ConfigSendBuffer(FTDIDevice *dev, uint8_t *data, size_t length)
 #define R6(n) R4(n), R4(n + 2*4 ), R4(n + 1*4 ), R4(n + 3*4 )
       R6(0), R6(2), R6(1), R6(3)
     };
+  size_t i;
 
-  while (length) {
-    uint8_t buffer[BLOCK_SIZE];
-    size_t chunk = length;
-    int i, err;
-
-    if (chunk > BLOCK_SIZE)
-      chunk = BLOCK_SIZE;
-
-    for (i = 0; i < chunk; i++)
-      buffer[i] = bitReverse[data[i]];
+  for (i = 0; i < length; i++)
+    buffer[i] = bitReverse[data[i]];
+}
 
-    data += chunk;
-    length -= chunk;
 
-    err = FTDIDevice_Write(dev, FTDI_INTERFACE_A, buffer, chunk, false);
-    if (err)
-      return err;
-  }
+static int
+ConfigSendBuffer(FTDIDevice *dev, const uint8_t *data, size_t length, bool reversed)
+{
+  /*
+   * Send raw configuration data.
+   *
+   * We're using the slave parallel (SelectMAP) interface, which requires
+   * all bits to be swapped. (Why don't they just label the data pins in
+   * the opposite order? Beats me...)
+   *
+   * 'reversed' data has been swapped already (see FPGAConfig_LoadConfigData)
+   * and is sent as is.
+   */
 
-  return 0;
+  return FTDIDevice_WriteStream(dev, FTDI_INTERFACE_A, data, length,
+                                reversed ? NULL : ConfigReverseBits, NULL,
+                                BLOCK_SIZE, NUM_TRANSFERS);
 }
 
 
@@ -340,17 +342,14 @@ int FPGA_GetConfigStatus(FTDIDevice * dev)
   }
 }
 
-int
-FPGAConfig_LoadFile(FTDIDevice *dev, const char *filename)
+/*
+ * Configure the FPGA from a bit file whose header has been read; takes
+ * ownership of bf.
+ */
+static int
+ConfigLoadBitfile(FTDIDevice *dev, struct bitfile *bf)
 {
   int err = 0;
-  struct bitfile *bf;
-
-  bf = bitfile_new_from_path(filename);
-  if (!bf) {
-     perror(filename);
-    return -1;
-  }
 
   if (strcmp(bf->part_number, FPGA_PART)) {
     fprintf(stderr, "FPGA: Bitstream has incorrect part number '%s'."
@@ -369,7 +368,7 @@ FPGAConfig_LoadFile(FTDIDevice *dev, const char *filename)
   if (err)
     goto done;
 
-  err = ConfigSendBuffer(dev, bf->data, bf->length);
+  err = ConfigSendBuffer(dev, bf->data, bf->length, false);
   if (err)
     goto done;
 
@@ -381,3 +380,47 @@ FPGAConfig_LoadFile(FTDIDevice *dev, const char *filename)
   bitfile_delete(bf);
   return err;
 }
+
+int
+FPGAConfig_LoadFile(FTDIDevice *dev, const char *filename)
+{
+  struct bitfile *bf;
+
+  bf = bitfile_new_from_path(filename);
+  if (!bf) {
+     perror(filename);
+    return -1;
+  }
+
+  return ConfigLoadBitfile(dev, bf);
+}
+
+int
+FPGAConfig_LoadBuffer(FTDIDevice *dev, const uint8_t *buffer, size_t length)
+{
+  struct bitfile *bf;
+
+  bf = bitfile_new_from_buffer(buffer, length);
+  if (!bf) {
+    fprintf(stderr, "FPGA: Bitstream buffer is not a valid .bit file\n");
+    return -1;
+  }
+
+  return ConfigLoadBitfile(dev, bf);
+}
+
+int
+FPGAConfig_LoadConfigData(FTDIDevice *dev, const uint8_t *data, size_t length)
+{
+  int err;
+
+  err = ConfigBegin(dev);
+  if (err)
+    return err;
+
+  err = ConfigSendBuffer(dev, data, length, true);
+  if (err)
+    return err;
+
+  return ConfigEnd(dev);
+}
@@ -39,6 +39,11 @@
 #endif
 
 int FPGAConfig_LoadFile(FTDIDevice *dev, const char *filename);
+int FPGAConfig_LoadBuffer(FTDIDevice *dev, const uint8_t *buffer, size_t length);
+
+/* Configuration data with the .bit header stripped and the bits of each
+ * byte already reversed for the SelectMAP port, e.g. cached by the host. */
+int FPGAConfig_LoadConfigData(FTDIDevice *dev, const uint8_t *data, size_t length);
 
 /*
  * Public
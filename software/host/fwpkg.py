@@ -0,0 +1,183 @@
+import marshal
+import os
+import os.path
+import zlib
+
+# Bump when the cached data changes shape
+CACHE_VERSION = 2
+
+# Must match FPGA_PART in fpgaconfig.c
+FPGA_PART = "6slx9tqg144"
+
+# The SelectMAP port takes configuration bytes with their bits reversed
+_BIT_REVERSE = bytes(int("{:08b}".format(i)[::-1], 2) for i in range(256))
+
+def cache_dir():
+    base = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "openvizsla")
+
+def bitstream_info(bit):
+    """
+    Header fields of a Xilinx .bit file: design, part, date, time and the
+    offset and length of the configuration data.
+    """
+    info = {}
+
+    # Fixed preamble, then key/length/value fields; 'e' has a 32-bit length
+    # and is followed by the configuration data itself
+    offset = 13
+    while offset < len(bit):
+        key = chr(bit[offset])
+        if key == 'e':
+            info["length"] = int.from_bytes(bit[offset + 1:offset + 5], 'big')
+            info["offset"] = offset + 5
+            break
+        n = int.from_bytes(bit[offset + 1:offset + 3], 'big')
+        value = bit[offset + 3:offset + 3 + n].rstrip(b"\x00").decode("ascii", "replace")
+        offset += 3 + n
+        if key in "abcd":
+            info[{"a": "design", "b": "part", "c": "date", "d": "time"}[key]] = value
+
+    return info
+
+def config_data(bit):
+    """
+    The configuration data of a .bit file the way the FPGA takes it: header
+    stripped, part checked and bits reversed, see LibOV.ConfigData
+    """
+    import LibOV
+
+    info = bitstream_info(bit)
+    if info.get("part") != FPGA_PART:
+        raise ValueError("Bitstream is for part %r, the hardware is %r" % (info.get("part"), FPGA_PART))
+
+    data = bit[info["offset"]:info["offset"] + info["length"]]
+    if len(data) != info["length"]:
+        raise ValueError("Bitstream is truncated")
+
+    return LibOV.ConfigData(data.translate(_BIT_REVERSE))
+
+class Package:
+    """
+    A firmware package, a zip file with map.txt and ov3.bit.
+
+    The parsed register map and the bitstream header are cached in a small
+    marshal file keyed by a hash of the package, so the zip is only opened
+    when the bitstream itself is needed or the package changed. The
+    prepared configuration data (see config_data()) is cached next to it.
+    """
+
+    def __init__(self, path, cache=True):
+        self.path = path
+        self.cache = cache
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.hash = "%08x-%d" % (zlib.crc32(data), len(data))
+
+        self.__zip = None
+        self.__meta = None
+        self.__config = None
+
+    def __str__(self):
+        return self.path
+
+    def open(self, name, mode='r'):
+        if self.__zip is None:
+            import zipfile
+            self.__zip = zipfile.ZipFile(self.path, 'r')
+        return self.__zip.open(name, mode)
+
+    def __cache_path(self, suffix=".cache"):
+        return os.path.join(cache_dir(), self.hash + suffix)
+
+    def __cache_write(self, path, write):
+        # Best effort, a read-only home just means no caching
+        try:
+            os.makedirs(cache_dir(), exist_ok=True)
+            tmp = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp, 'wb') as f:
+                write(f)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+    def __load(self):
+        import LibOV
+
+        attrs = {}
+        addrmap = LibOV.parse_mapfile(self.open('map.txt'), attrs)
+
+        with self.open('ov3.bit') as f:
+            bit = bitstream_info(f.read(256))
+
+        return {
+            "version": CACHE_VERSION,
+            "map": addrmap,
+            "attrs": {name: tuple(a) for name, a in attrs.items()},
+            "bit": bit,
+        }
+
+    def __metadata(self):
+        if self.__meta is not None:
+            return self.__meta
+
+        if self.cache:
+            try:
+                with open(self.__cache_path(), 'rb') as f:
+                    meta = marshal.load(f)
+                if meta.get("version") == CACHE_VERSION:
+                    self.__meta = meta
+                    return meta
+            except (OSError, ValueError, EOFError, TypeError, AttributeError):
+                pass
+
+        self.__meta = self.__load()
+
+        if self.cache:
+            self.__cache_write(self.__cache_path(), lambda f: marshal.dump(self.__meta, f))
+
+        return self.__meta
+
+    def regmap(self):
+        """
+        The parsed map.txt as (addrmap, attrs), see LibOV.parse_mapfile
+        """
+        import LibOV
+
+        meta = self.__metadata()
+        return meta["map"], {name: LibOV.RegAttrs(*a) for name, a in meta["attrs"].items()}
+
+    def bitstream_info(self):
+        """Header fields of ov3.bit, see bitstream_info()"""
+        return self.__metadata()["bit"]
+
+    def config_data(self):
+        """
+        ov3.bit prepared for loading (see config_data()), as a
+        LibOV.ConfigData for OVDevice.open()
+        """
+        import LibOV
+
+        if self.__config is not None:
+            return self.__config
+
+        path = self.__cache_path(".cfg")
+        if self.cache:
+            try:
+                with open(path, 'rb') as f:
+                    self.__config = LibOV.ConfigData(f.read())
+            except OSError:
+                pass
+
+            # The cache is only ever written whole, but check anyway
+            if self.__config is not None and len(self.__config) == self.bitstream_info().get("length"):
+                return self.__config
+
+        with self.open('ov3.bit') as f:
+            self.__config = config_data(f.read())
+
+        if self.cache:
+            self.__cache_write(path, lambda f: f.write(self.__config))
+
+        return self.__config
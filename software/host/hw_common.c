@@ -54,6 +54,54 @@ HW_Init(FTDIDevice *dev, const char *bitstream)
 }
 
 
+/*
+ * HW_InitBuffer --
+ *
+ *    HW_Init with the bitstream (the contents of a .bit file) in memory
+ *    instead of in a file. 'bitstream' is optional. Returns 0 on success,
+ *    or an error code rather than exiting.
+ */
+
+int
+HW_InitBuffer(FTDIDevice *dev, const uint8_t *bitstream, size_t length)
+{
+   int err;
+
+   if (bitstream) {
+      err = FPGAConfig_LoadBuffer(dev, bitstream, length);
+      if (err)
+         return err;
+   }
+
+   return FTDIDevice_SetMode(dev, FTDI_INTERFACE_A,
+                             FTDI_BITMODE_SYNC_FIFO, 0xFF, 0);
+}
+
+
+/*
+ * HW_InitConfigData --
+ *
+ *    HW_InitBuffer with configuration data that is already prepared for
+ *    the FPGA: header stripped and bits reversed (see
+ *    FPGAConfig_LoadConfigData). Returns 0 on success or an error code.
+ */
+
+int
+HW_InitConfigData(FTDIDevice *dev, const uint8_t *data, size_t length)
+{
+   int err;
+
+   if (data) {
+      err = FPGAConfig_LoadConfigData(dev, data, length);
+      if (err)
+         return err;
+   }
+
+   return FTDIDevice_SetMode(dev, FTDI_INTERFACE_A,
+                             FTDI_BITMODE_SYNC_FIFO, 0xFF, 0);
+}
+
+
 #if 0
 /*
  * HW_SetSystemClock --
@@ -65,6 +65,8 @@
  */
 
 OV_API void HW_Init(FTDIDevice *dev, const char *bitstream);
+OV_API int HW_InitBuffer(FTDIDevice *dev, const uint8_t *bitstream, size_t length);
+OV_API int HW_InitConfigData(FTDIDevice *dev, const uint8_t *data, size_t length);
 OV_API void HW_SetSystemClock(FTDIDevice *dev, float mhz);
 
 OV_API void HW_ConfigWriteMultiple(FTDIDevice *dev, uint16_t *addrArray,
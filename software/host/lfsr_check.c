@@ -0,0 +1,92 @@
+/*
+ * lfsr_check.c - Verification of the LFSR test stream from the gateware's
+ *                FTDI_randtest module (see ovctl.py lb-test).
+ *
+ * The generator is a 17 bit Fibonacci LFSR with taps 17, 15, 14 and 12,
+ * stepped once per byte sent, and each byte is the low 8 bits of the
+ * state. So the stream is fully predictable from the state, and the state
+ * is the low bit of each of the last 17 bytes, which is how the checker
+ * picks the stream up again after bytes were lost or inserted.
+ */
+
+#include <string.h>
+
+#include "lfsr_check.h"
+
+#define LFSR_BITS    17
+#define LFSR_MASK    ((1 << LFSR_BITS) - 1)
+
+static inline uint32_t
+LFSRNext(uint32_t state)
+{
+  uint32_t feedback = ((state >> 16) ^ (state >> 14) ^ (state >> 13) ^ (state >> 11)) & 1;
+
+  return ((state << 1) | feedback) & LFSR_MASK;
+}
+
+void
+LFSRCheck_Init(LFSRCheck *check, uint32_t state)
+{
+  memset(check, 0, sizeof *check);
+  check->state = state & LFSR_MASK;
+}
+
+/*
+ * Check the next 'length' payload bytes of the stream (packet headers
+ * stripped). Stream offsets of mismatching bytes are stored in
+ * errorOffsets, up to maxErrorOffsets of them; returns how many were
+ * stored.
+ *
+ * A wrong byte on its own is counted as an error and the check carries on
+ * with the expected sequence. Two wrong bytes in a row mean the stream
+ * slipped (lost or extra data), the checker then resynchronizes from the
+ * next 17 bytes, which are not checked themselves.
+ */
+
+size_t
+LFSRCheck_Feed(LFSRCheck *check, const uint8_t *data, size_t length,
+               uint64_t *errorOffsets, size_t maxErrorOffsets)
+{
+  uint32_t state = check->state;
+  uint32_t history = check->history;
+  size_t stored = 0;
+  size_t i;
+
+  for (i = 0; i < length; i++) {
+    uint8_t byte = data[i];
+
+    history = ((history << 1) | (byte & 1)) & LFSR_MASK;
+
+    if (check->resync) {
+      if (--check->resync == 0) {
+        state = LFSRNext(history);
+      }
+      continue;
+    }
+
+    if (byte != (state & 0xFF)) {
+      check->errors++;
+      if (stored < maxErrorOffsets) {
+        errorOffsets[stored++] = check->offset + i;
+      }
+
+      if (check->lastError) {
+        check->resyncs++;
+        check->resync = LFSR_BITS;
+        check->lastError = 0;
+        continue;
+      }
+      check->lastError = 1;
+    } else {
+      check->lastError = 0;
+    }
+
+    state = LFSRNext(state);
+  }
+
+  check->state = state;
+  check->history = history;
+  check->offset += length;
+
+  return stored;
+}
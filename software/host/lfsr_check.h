@@ -0,0 +1,47 @@
+/*
+ * lfsr_check.h - Verification of the LFSR test stream from the gateware's
+ *                FTDI_randtest module (see ovctl.py lb-test).
+ */
+
+#ifndef __LFSR_CHECK_H
+#define __LFSR_CHECK_H
+
+#include <stdint.h>
+#include <stddef.h>
+
+#ifdef _WIN32
+  #ifdef OV_API_EXPORT
+    #define OV_API __declspec(dllexport)
+  #else
+    #define OV_API __declspec(dllimport)
+  #endif
+#else
+  #define OV_API
+#endif
+
+/*
+ * The generator state after it is stopped, the first byte it sends when
+ * restarted is the low byte of this.
+ */
+#define LFSR_RESET_STATE  1
+
+typedef struct LFSRCheck {
+  uint32_t state;       // Expected generator state for the next byte
+  uint32_t history;     // Low bits of the bytes received, newest in bit 0
+  int resync;           // Bytes still needed to resynchronize, 0 when in sync
+  int lastError;        // The previous byte was wrong
+
+  uint64_t offset;      // Payload bytes seen
+  uint64_t errors;      // Bytes that didn't match
+  uint64_t resyncs;     // Times the stream was lost and picked up again
+} LFSRCheck;
+
+/*
+ * Public
+ */
+
+OV_API void LFSRCheck_Init(LFSRCheck *check, uint32_t state);
+OV_API size_t LFSRCheck_Feed(LFSRCheck *check, const uint8_t *data, size_t length,
+                             uint64_t *errorOffsets, size_t maxErrorOffsets);
+
+#endif /* __LFSR_CHECK_H */
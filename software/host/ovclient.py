@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# Lightweight client for 'ovctl.py daemon': runs ovctl subcommands on the
+# device the daemon holds open, without the startup cost of ovctl itself.
+#
+#   ./ovctl.py daemon &
+#   ./ovclient.py uread 0x16
+#
+# Only the standard library is imported here, on purpose.
+
+import json
+import os
+import socket
+import sys
+
+def default_socket():
+    runtime = os.getenv('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, "ovctl.sock")
+    return "/tmp/ovctl-%d.sock" % os.getuid()
+
+def connect(path=None):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path or default_socket())
+    return sock
+
+def run(argv, path=None, stdout=sys.stdout, stderr=sys.stderr):
+    """
+    Run the ovctl subcommand argv on the daemon, copying its output to
+    stdout/stderr as it arrives. Returns the exit status.
+    """
+    with connect(path) as sock:
+        sock.sendall(json.dumps({"argv": argv, "cwd": os.getcwd()}).encode("utf-8") + b"\n")
+
+        for line in sock.makefile("r", encoding="utf-8"):
+            msg = json.loads(line)
+            if "out" in msg:
+                stdout.write(msg["out"])
+                stdout.flush()
+            elif "err" in msg:
+                stderr.write(msg["err"])
+                stderr.flush()
+            elif "exit" in msg:
+                return msg["exit"]
+
+    print("Daemon closed the connection", file = stderr)
+    return 1
+
+def main():
+    argv = sys.argv[1:]
+    path = None
+    if argv[:1] == ["--socket"] and len(argv) > 1:
+        path, argv = argv[1], argv[2:]
+
+    if not argv or argv[0] in ("-h", "--help"):
+        print("usage: ovclient.py [--socket PATH] SUBCOMMAND [ARGS...]", file = sys.stderr)
+        print("Runs an ovctl.py subcommand on a running 'ovctl.py daemon' (socket: %s)"
+              % default_socket(), file = sys.stderr)
+        return 2
+
+    try:
+        return run(argv, path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print("No ovctl daemon at %s, start one with 'ovctl.py daemon'" % (path or default_socket()),
+              file = sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        # Closing the connection stops the command on the daemon
+        return 130
+
+if __name__ == "__main__":
+    sys.exit(main())
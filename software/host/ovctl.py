@@ -1,23 +1,32 @@
 #!/usr/bin/env python3
 
-# This needs python3.3 or greater - argparse changes behavior
+# This needs python3.7 or greater - argparse changes behavior, time_ns()
 # TODO - workaround
 
-import LibOV
-import argparse
 import time
+_import_start = time.perf_counter()
 
-import zipfile
+# Keep the imports here light, ovctl is run in tight loops by test
+# benches; anything only some commands need is imported where it is used
+# (try --timing, and python -X importtime).
+import LibOV
+import argparse
+from clocksync import ClockCorrelator, TS_RATE
+from capmerge import StreamMerger
+import fwpkg
+import telemetry
+import traffic
 
 import sys
 import os, os.path
 import struct
-#import yappi
+import threading
+import json
 
 # We check the Python version in __main__ so we don't
 #   rudely bail if someone imports this module.
 MIN_MAJOR = 3
-MIN_MINOR = 3
+MIN_MINOR = 7
 
 default_package = os.getenv('OV_PKG')
 if default_package is None:
@@ -29,6 +38,10 @@ def as_ascii(arg):
     return arg.encode('ascii')
 
 class Command:
+    # Commands with multi_device set get a list of all devices selected
+    # with --serial instead of a single device
+    multi_device = False
+
     def __subclasshook__(self):
         pass
 
@@ -92,6 +105,77 @@ def uread(dev, addr):
 
     print ("ULPI %02x: %02x" % (addr, dev.ulpiread(addr)))
 
+# PHY identification, most significant first
+ULPI_ID_REGS = ["VIDH", "VIDL", "PIDH", "PIDL"]
+
+def ulpi_phy_id(registers):
+    return int.from_bytes(bytes(registers[name] for name in ULPI_ID_REGS), 'big')
+
+def load_ulpi_config(path):
+    """A PHY register set saved by ulpi-dump"""
+    with open(path) as f:
+        config = json.load(f)
+
+    if not isinstance(config.get("registers"), dict):
+        raise ValueError("%s: not a ulpi-dump file" % path)
+    return config
+
+def apply_ulpi_config(dev, config):
+    """
+    Write a register set saved by ulpi-dump to the PHY. Refuses (returning
+    False) if it was saved from a different PHY.
+    """
+    if check_ulpi_clk(dev):
+        return False
+
+    saved = config.get("phy_id")
+    if saved is not None:
+        current = ulpi_phy_id(dict(zip(ULPI_ID_REGS, dev.ulpi_batch(
+            [(LibOV.SMSC_334x_MAP[name], None) for name in ULPI_ID_REGS]))))
+        if current != saved:
+            print("ULPI configuration is for PHY %08x, this one is %08x" % (saved, current))
+            return False
+
+    dev.ulpi_restore(config["registers"])
+    return True
+
+class ULPIDump(Command):
+    name = "ulpi-dump"
+    help = 'Save all ULPI PHY registers as JSON'
+
+    @staticmethod
+    def setup_args(sp):
+        sp.add_argument('--out', type=str,
+                        help='Output file name (default: stdout)')
+
+    @staticmethod
+    def go(dev, args):
+        if check_ulpi_clk(dev):
+            return
+
+        registers = dev.ulpi_dump()
+        text = json.dumps({"phy_id": ulpi_phy_id(registers), "registers": registers}, indent=2) + "\n"
+
+        if args.out:
+            with open(args.out, "w") as f:
+                f.write(text)
+        else:
+            sys.stdout.write(text)
+
+class ULPIRestore(Command):
+    name = "ulpi-restore"
+    help = 'Write ULPI PHY registers saved by ulpi-dump'
+
+    @staticmethod
+    def setup_args(sp):
+        sp.add_argument('file', type=str,
+                        help='JSON file from ulpi-dump')
+
+    @staticmethod
+    def go(dev, args):
+        if apply_ulpi_config(dev, load_ulpi_config(args.file)):
+            print("Restored ULPI registers from %s" % args.file)
+
 @command('report', 'Hardware Health Report')
 def report(dev):
 
@@ -101,12 +185,12 @@ def report(dev):
     else:
         # display the ULPI identifier
         ident = 0
-        for x in [dev.ulpiregs.vidh,
+        for x in dev.ulpi_batch([(x.addr, None) for x in [dev.ulpiregs.vidh,
                 dev.ulpiregs.vidl,
                 dev.ulpiregs.pidh,
-                dev.ulpiregs.pidl]:
+                dev.ulpiregs.pidl]]):
             ident <<= 8
-            ident |= x.rd()
+            ident |= x
 
         name = 'unknown'
         if ident == LibOV.SMSC_334x_MAGIC:
@@ -115,15 +199,19 @@ def report(dev):
 
         # do in depth phy tests
         if ident == LibOV.SMSC_334x_MAGIC:
-            dev.ulpiregs.scratch.wr(0)
-            dev.ulpiregs.scratch_set.wr(0xCF)
-            dev.ulpiregs.scratch_clr.wr(0x3C)
+            scratch, func_ctl, intf_ctl = dev.ulpi_batch([
+                (dev.ulpiregs.scratch.addr, 0),
+                (dev.ulpiregs.scratch_set.addr, 0xCF),
+                (dev.ulpiregs.scratch_clr.addr, 0x3C),
+                (dev.ulpiregs.scratch.addr, None),
+                (dev.ulpiregs.func_ctl.addr, None),
+                (dev.ulpiregs.intf_ctl.addr, None)])[3:]
 
-            stat = "OK" if dev.ulpiregs.scratch.rd() == 0xC3 else "FAIL"
+            stat = "OK" if scratch == 0xC3 else "FAIL"
 
             print("\tULPI Scratch register IO test: %s" % stat)
-            print("\tPHY Function Control Reg:  %02x" % dev.ulpiregs.func_ctl.rd())
-            print("\tPHY Interface Control Reg: %02x" % dev.ulpiregs.intf_ctl.rd())
+            print("\tPHY Function Control Reg:  %02x" % func_ctl)
+            print("\tPHY Interface Control Reg: %02x" % intf_ctl)
         else:
             print("\tUnknown PHY - skipping phy tests")
 
@@ -200,32 +288,88 @@ class OutputITI1480A:
 class OutputPcap:
     LINKTYPE_USB_2_0 = 288
 
-    def __init__(self, output):
+    def __init__(self, output, clock=None):
         self.output = output
         self.output.write(struct.pack("IHHIIII", 0xa1b23c4d, 2, 4, 0, 0, 65535, self.LINKTYPE_USB_2_0))
-        # Assume that capture started at the same time this object was created. This is not a proper time
-        # synchronization but should be good enough. Record time is advanced based on the FPGA clock.
-        self.utc_ts = int(time.time())
-        self.last_ts = 0
-        self.ts_offset = 0
+        # Without a correlator, assume that capture started at the same time
+        # this object was created and advance record time based on the
+        # nominal FPGA clock.
+        self.clock = clock if clock is not None else ClockCorrelator()
 
     def handle_usb(self, ts, pkt, flags, orig_len):
-        # Increment timestamp based on the 60 MHz 24-bit counter value.
-        # Convert remaining clocks to nanoseconds: 1 clk = 1 / 60 MHz = 16.(6) ns
-        diff_ts = ts - self.last_ts
-        self.last_ts = ts
-        seconds, clks = divmod(self.ts_offset + diff_ts, 60e6)
-        self.utc_ts = int(self.utc_ts + seconds) & 0xffffffff
-        self.ts_offset = clks
-        nanosec = int((clks * 17) - (clks // 3))
         if len(pkt) == 0:
             return
+        seconds, nanosec = divmod(self.clock.to_realtime_ns(ts), 1000000000)
         # Write pcap record header in host endian
-        self.output.write(struct.pack("IIII", self.utc_ts, nanosec, len(pkt), orig_len))
+        self.output.write(struct.pack("IIII", seconds & 0xffffffff, nanosec, len(pkt), orig_len))
         # Write USB packet, beginning with a PID as it appeared on the bus
         self.output.write(pkt)
 
 
+class OutputPcapng:
+    LINKTYPE_USB_2_0 = 288
+
+    def __init__(self, output, interfaces=("openvizsla",), clocks=None):
+        self.output = output
+        self.clocks = clocks if clocks is not None else [ClockCorrelator() for i in interfaces]
+
+        # Section header block, byte order magic written in host endian
+        self.__block(0x0a0d0d0a, struct.pack("IHHq", 0x1a2b3c4d, 1, 0, -1))
+
+        # One interface description per capture device, nanosecond
+        # timestamp resolution
+        for name in interfaces:
+            opts = self.__option(2, name.encode("utf-8"))
+            opts += self.__option(9, b"\x09")
+            opts += self.__option(0, b"")
+            self.__block(1, struct.pack("HHI", self.LINKTYPE_USB_2_0, 0, 65535) + opts)
+
+    @staticmethod
+    def __option(code, value):
+        return struct.pack("HH", code, len(value)) + value + b"\x00" * (-len(value) % 4)
+
+    def __block(self, block_type, body):
+        body += b"\x00" * (-len(body) % 4)
+        length = len(body) + 12
+        self.output.write(struct.pack("II", block_type, length) + body + struct.pack("I", length))
+
+    def write_packet(self, interface, ts_ns, pkt, orig_len):
+        # Enhanced packet block
+        self.__block(6, struct.pack("IIIII", interface,
+                                    ts_ns >> 32, ts_ns & 0xffffffff,
+                                    len(pkt), orig_len) + bytes(pkt))
+
+    def handle_usb(self, ts, pkt, flags, orig_len):
+        if len(pkt) == 0:
+            return
+        self.write_packet(0, self.clocks[0].to_realtime_ns(ts), pkt, orig_len)
+
+    def write_statistics(self, interface, status):
+        """
+        Interface statistics block from a LibOV.CaptureStatus. The gateware
+        counts bytes, not packets, so the counters go in a comment rather
+        than isb_ifrecv/isb_ifdrop.
+        """
+        ts_ns = time.time_ns()
+        comment = "overflow %d bytes, total %d bytes, %d ring wraps" % (
+            status.num_ovf, status.num_total, status.wrap_count)
+        opts = self.__option(1, comment.encode("utf-8"))
+        opts += self.__option(0, b"")
+        self.__block(5, struct.pack("III", interface, ts_ns >> 32, ts_ns & 0xffffffff) + opts)
+
+
+class OutputRaw:
+    """Packets re-encoded as the device sends them, for use with --replay"""
+
+    def __init__(self, output):
+        self.output = output
+        self.ts_last = 0
+
+    def handle_usb(self, ts, pkt, flags, orig_len):
+        self.output.write(traffic.encode_packet(max(0, ts - self.ts_last), pkt, flags, orig_len))
+        self.ts_last = ts
+
+
 def do_sdramtests(dev, cb=None, tests = range(0, 6)):
 
     for i in tests:
@@ -246,7 +390,8 @@ def do_sdramtests(dev, cb=None, tests = range(0, 6)):
 
 @command('sdramtest', 'Perform SDRAM Test')
 def sdramtest(dev):
-    # LEDS select
+    # LEDS select, restored afterwards
+    mux = dev.regs.LEDS_MUX_0.rd()
     dev.regs.LEDS_MUX_0.wr(1)
 
     stat = do_sdramtests(dev, tests = [3])
@@ -255,147 +400,392 @@ def sdramtest(dev):
     else:
         print("SDRAM test passed")
 
-    dev.regs.LEDS_MUX_0.wr(0)
+    dev.regs.LEDS_MUX_0.wr(mux)
 
 sniff_speeds = ["hs", "fs", "ls"]
-sniff_formats = ["verbose", "custom", "pcap", "iti1480a"]
-
-def do_sniff(dev, speed, format, out, timeout, debug_filter, filter_nak, filter_sof):
-    # LEDs off
-    dev.regs.LEDS_MUX_2.wr(0)
-    dev.regs.LEDS_OUT.wr(0)
-
-    # LEDS 0/1 to FTDI TX/RX
-    dev.regs.LEDS_MUX_0.wr(2)
-    dev.regs.LEDS_MUX_1.wr(2)
-
-    # enable SDRAM buffering
-    ring_base = 0
-    ring_size = 16 * 1024 * 1024
-    ring_end = ring_base + ring_size
-    dev.regs.SDRAM_SINK_GO.wr(0)
-    dev.regs.SDRAM_HOST_READ_GO.wr(0)
-    dev.regs.SDRAM_SINK_RING_BASE.wr(ring_base)
-    dev.regs.SDRAM_SINK_RING_END.wr(ring_end)
-    dev.regs.SDRAM_HOST_READ_RING_BASE.wr(ring_base)
-    dev.regs.SDRAM_HOST_READ_RING_END.wr(ring_end)
-    dev.regs.SDRAM_SINK_GO.wr(1)
-    dev.regs.SDRAM_HOST_READ_GO.wr(1)
-
-    # clear perfcounters
-    dev.regs.OVF_INSERT_CTL.wr(1)
-    dev.regs.OVF_INSERT_CTL.wr(0)
-
-    assert speed in sniff_speeds
+sniff_formats = ["verbose", "custom", "pcap", "pcapng", "iti1480a", "raw"]
 
-    if check_ulpi_clk(dev):
-        return
+class SniffSession:
+    """
+    Capture setup, status polling and teardown for a single device. Split
+    out of do_sniff so that several devices can be driven side by side.
+    """
 
-    # set to non-drive; set FS or HS as requested
-    if speed == "hs":
-            dev.ulpiregs.func_ctl.wr(0x48)
-            dev.rxcsniff.service.highspeed = True
-    elif speed == "fs":
-            dev.ulpiregs.func_ctl.wr(0x49)
-            dev.rxcsniff.service.highspeed = False
-    elif speed == "ls":
-            dev.ulpiregs.func_ctl.wr(0x4a)
-            dev.rxcsniff.service.highspeed = False
-    else:
-        assert 0,"Invalid Speed"
+    def __init__(self, dev, speed, debug_filter=False, filter_nak=False, filter_sof=False, name=None,
+                 status_interval=None, ulpi_config=None):
+        assert speed in sniff_speeds
+
+        self.dev = dev
+        self.speed = speed
+        self.name = name
+
+        self.cfg = 1
+        if debug_filter:
+            self.cfg |= (1 << 1)
+        if filter_nak:
+            self.cfg |= (1 << 2)
+        if filter_sof:
+            self.cfg |= (1 << 3)
+
+        self.ring_base = 0
+        self.ring_size = 16 * 1024 * 1024
+
+        # Correlates capture timestamps with host time; fed from the status poll
+        self.clock = ClockCorrelator()
+
+        # poll() may run much faster than this, the log and clock samples
+        # are only taken once per interval
+        self.log_interval = 1.0
+        self.last_log = None
+
+        self.status = None
+        self.peak_fill = 0
+
+        # With gateware status records, the status arrives in the stream
+        # every status_interval seconds and poll() needs no register reads
+        self.status_interval = status_interval
+        self.pushed = False
+
+        # PHY registers from ulpi-dump to apply before the speed is set
+        self.ulpi_config = ulpi_config
+
+        # Peak fill since the last metrics() call, and the capture start
+        # timestamp for the decode lag
+        self.metrics_peak_fill = 0
+        self.start_ts = None
+
+    def log(self, msg):
+        if self.name is not None:
+            msg = "[%s] %s" % (self.name, msg)
+        print(msg, file = sys.stderr)
+
+    def setup(self):
+        dev = self.dev
+
+        with dev.batch() as b:
+            # LEDs off
+            b.wr(dev.regs.LEDS_MUX_2, 0)
+            b.wr(dev.regs.LEDS_OUT, 0)
+
+            # LEDS 0/1 to FTDI TX/RX
+            b.wr(dev.regs.LEDS_MUX_0, 2)
+            b.wr(dev.regs.LEDS_MUX_1, 2)
+
+            # enable SDRAM buffering
+            ring_end = self.ring_base + self.ring_size
+            b.wr(dev.regs.SDRAM_SINK_GO, 0)
+            b.wr(dev.regs.SDRAM_HOST_READ_GO, 0)
+            b.wr(dev.regs.SDRAM_SINK_RING_BASE, self.ring_base)
+            b.wr(dev.regs.SDRAM_SINK_RING_END, ring_end)
+            b.wr(dev.regs.SDRAM_HOST_READ_RING_BASE, self.ring_base)
+            b.wr(dev.regs.SDRAM_HOST_READ_RING_END, ring_end)
+            b.wr(dev.regs.SDRAM_SINK_GO, 1)
+            b.wr(dev.regs.SDRAM_HOST_READ_GO, 1)
+
+            # clear perfcounters
+            b.wr(dev.regs.OVF_INSERT_CTL, 1)
+            b.wr(dev.regs.OVF_INSERT_CTL, 0)
+
+        if check_ulpi_clk(dev):
+            return False
+
+        if self.ulpi_config is not None and not apply_ulpi_config(dev, self.ulpi_config):
+            return False
+
+        # set to non-drive; set FS or HS as requested
+        if self.speed == "hs":
+                dev.ulpiregs.func_ctl.wr(0x48)
+                dev.rxcsniff.service.highspeed = True
+        elif self.speed == "fs":
+                dev.ulpiregs.func_ctl.wr(0x49)
+                dev.rxcsniff.service.highspeed = False
+        elif self.speed == "ls":
+                dev.ulpiregs.func_ctl.wr(0x4a)
+                dev.rxcsniff.service.highspeed = False
+        else:
+            assert 0,"Invalid Speed"
+
+        return True
+
+    def start(self):
+        dev = self.dev
+
+        if self.status_interval:
+            dev.status_records.handlers = [self.handle_status]
+            self.pushed = dev.enable_status_records(self.status_interval)
+
+        dev.regs.CSTREAM_CFG.wr(self.cfg)
+
+    def handle_status(self, status):
+        # Called from the USB reader thread for every status record
+        self.status = status
+        fill = status.fill(self.ring_size)
+        self.peak_fill = max(self.peak_fill, fill)
+        self.metrics_peak_fill = max(self.metrics_peak_fill, fill)
+
+    def poll(self):
+        """
+        Take a capture status snapshot, tracking the peak ring fill level
+        between log lines. Returns the LibOV.CaptureStatus.
+
+        With status records the latest record is used instead, and the peak
+        covers every record, not just the polls.
+        """
+        dev = self.dev
+
+        if self.pushed and self.status is not None:
+            status = self.status
+        else:
+            status = dev.capture_status()
+            self.handle_status(status)
+
+        rptr = status.rptr - self.ring_base
+        wptr = status.wptr - self.ring_base
+
+        assert 0 <= rptr <= self.ring_size
+        assert 0 <= wptr <= self.ring_size
+
+        delta = status.fill(self.ring_size)
+
+        now = time.monotonic()
+        if self.last_log is not None and now - self.last_log < self.log_interval:
+            return status
+        self.last_log = now
+
+        total = status.total(self.ring_base, self.ring_size)
+        utilization = delta * 100 / self.ring_size
+        peak = self.peak_fill * 100 / self.ring_size
+        self.peak_fill = 0
+
+        self.log("%d / %d (%3.2f %% utilization, %3.2f %% peak) %d kB | %d overflow, %08x total | R%08x W%08x" %
+            (delta, self.ring_size, utilization, peak, total / 1024,
+            status.num_ovf, status.num_total,
+            rptr, wptr
+            ))
+
+        sample = dev.sample_clock()
+        if sample is not None:
+            if not self.clock.add_sample(*sample):
+                self.log("clock sample rejected, round trip %.3f ms, best %.3f ms (%d rejected)" %
+                    (sample[2] * 1e3, self.clock.best_rtt * 1e3, self.clock.rejected))
+            elif self.clock.samples > 1:
+                self.log("clock drift %+.3f ppm" % self.clock.drift_ppm)
+
+        if False:
+            dev.regs.SDRAM_SINK_DEBUG_CTL.wr(0)
+            print("rptr = %08x i_stb=%08x i_ack=%08x d_stb=%08x d_term=%08x s0=%08x s1=%08x s2=%08x | wptr = %08x i_stb=%08x i_ack=%08x d_stb=%08x d_term=%08x s0=%08x s1=%08x s2=%08x wrap=%x" % (
+                dev.regs.SDRAM_HOST_READ_RPTR_STATUS.rd(),
+                dev.regs.SDRAM_HOST_READ_DEBUG_I_STB.rd(),
+                dev.regs.SDRAM_HOST_READ_DEBUG_I_ACK.rd(),
+                dev.regs.SDRAM_HOST_READ_DEBUG_D_STB.rd(),
+                dev.regs.SDRAM_HOST_READ_DEBUG_D_TERM.rd(),
+                dev.regs.SDRAM_HOST_READ_DEBUG_S0.rd(),
+                dev.regs.SDRAM_HOST_READ_DEBUG_S1.rd(),
+                dev.regs.SDRAM_HOST_READ_DEBUG_S2.rd(),
+                dev.regs.SDRAM_SINK_WPTR.rd(),
+                dev.regs.SDRAM_SINK_DEBUG_I_STB.rd(),
+                dev.regs.SDRAM_SINK_DEBUG_I_ACK.rd(),
+                dev.regs.SDRAM_SINK_DEBUG_D_STB.rd(),
+                dev.regs.SDRAM_SINK_DEBUG_D_TERM.rd(),
+                dev.regs.SDRAM_SINK_DEBUG_S0.rd(),
+                dev.regs.SDRAM_SINK_DEBUG_S1.rd(),
+                dev.regs.SDRAM_SINK_DEBUG_S2.rd(),
+                dev.regs.SDRAM_SINK_WRAP_COUNT.rd(),
+                ), file = sys.stderr)
+
+        return status
+
+    def metrics(self):
+        """
+        Telemetry source: ring and capture counters from the latest status,
+        and the host side of this device.
+
+        decode_lag_seconds is how far the last decoded packet is behind the
+        capture timestamp of the latest status; it also grows while the bus
+        is idle (with SOFs filtered).
+        """
+        dev = self.dev
+        metrics = {
+            "usb_callbacks_total": dev.rx_callbacks,
+            "usb_bytes_total": dev.rx_bytes,
+        }
+
+        status = self.status
+        if status is None:
+            return metrics
+
+        peak = self.metrics_peak_fill
+        self.metrics_peak_fill = 0
+
+        metrics.update({
+            "ring_utilization": status.fill(self.ring_size) / self.ring_size,
+            "ring_peak_utilization": peak / self.ring_size,
+            "ring_bytes_written_total": status.total(self.ring_base, self.ring_size) * LibOV.RING_WORD_BYTES,
+            "overflow_total": status.num_ovf,
+            "received_total": status.num_total,
+        })
+
+        if status.ts is not None:
+            if self.start_ts is None:
+                self.start_ts = dev.regs.CSTREAM_START_TS.rd() if 'CSTREAM_START_TS' in dev.regs else 0
+            ticks = (status.ts - self.start_ts) & 0xFFFFFFFFFFFFFFFF
+            lag = ticks - dev.rxcsniff.service.cumulative_ts
+            metrics["decode_lag_seconds"] = max(0, lag) / TS_RATE
+
+        return metrics
+
+    def stop(self):
+        self.dev.regs.SDRAM_SINK_GO.wr(0)
+        self.dev.regs.SDRAM_HOST_READ_GO.wr(0)
+        self.dev.regs.CSTREAM_CFG.wr(0)
+
+        if self.pushed:
+            self.dev.enable_status_records(0)
+            self.pushed = False
+
+
+def do_sniff(dev, speed, format, out, timeout, debug_filter, filter_nak, filter_sof, poll_interval=1.0,
+             status_interval=None, monitor=None, ulpi_config=None):
+    session = SniffSession(dev, speed, debug_filter, filter_nak, filter_sof,
+                           status_interval=status_interval, ulpi_config=ulpi_config)
+
+    if not session.setup():
+        return
 
     assert format in sniff_formats
 
     output_handler = None
-    out = out and open(out, "wb")
+    out = out and telemetry.CountingFile(open(out, "wb"))
+    if out and dev.stats is not None:
+        out = dev.stats.wrap_file(out)
 
     if format == "custom":
         output_handler = OutputCustom(out or sys.stdout, speed)
     elif format == "pcap":
         assert out, "can't output pcap to stdout, use --out"
-        output_handler = OutputPcap(out)
+        output_handler = OutputPcap(out, session.clock)
+    elif format == "pcapng":
+        assert out, "can't output pcapng to stdout, use --out"
+        output_handler = OutputPcapng(out, [dev.serial or "openvizsla"], [session.clock])
     elif format == "iti1480a":
         output_handler = OutputITI1480A(out, speed)
+    elif format == "raw":
+        assert out, "can't output raw to stdout, use --out"
+        output_handler = OutputRaw(out)
 
     if output_handler is not None:
       dev.rxcsniff.service.handlers = [output_handler.handle_usb]
 
-    cfg = 1
-    if debug_filter:
-        cfg |= (1 << 1)
-    if filter_nak:
-        cfg |= (1 << 2)
-    if filter_sof:
-        cfg |= (1 << 3)
+    if monitor is not None:
+        def metrics():
+            m = session.metrics()
+            if out:
+                m["bytes_written_total"] = out.written
+            return m
+        monitor.add_source(metrics, device=dev.serial or "openvizsla")
 
-    elapsed_time = 0
+    start_time = time.monotonic()
     try:
-        dev.regs.CSTREAM_CFG.wr(cfg)
+        session.start()
+        if monitor is not None:
+            monitor.start()
         while 1:
-            dev.regs.SDRAM_SINK_PTR_READ.wr(0)
-            dev.regs.OVF_INSERT_CTL.wr(0)
+            session.poll()
+            if timeout and time.monotonic() - start_time > timeout:
+                break
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        session.stop()
 
-            rptr = dev.regs.SDRAM_SINK_RPTR.rd()
-            wptr = dev.regs.SDRAM_SINK_WPTR.rd()
-            wrap_count = dev.regs.SDRAM_SINK_WRAP_COUNT.rd()
+    # Packets still in flight must not reach a closed file
+    dev.rxcsniff.service.handlers = []
+    dev.status_records.handlers = []
+    dev.drain()
 
-            rptr -= ring_base
-            wptr -= ring_base
+    if monitor is not None:
+        monitor.stop()
 
-            assert 0 <= rptr <= ring_size
-            assert 0 <= wptr <= ring_size
+    if format == "pcapng" and session.status is not None:
+        output_handler.write_statistics(0, session.status)
 
-            delta = wptr - rptr
-            if delta < 0:
-                delta += ring_size
+    if out is not None:
+        out.close()
 
-            total = wrap_count * ring_size + wptr
-            utilization = delta * 100 / ring_size
+def do_sniff_multi(devs, speed, out, timeout, debug_filter, filter_nak, filter_sof, merge_delay,
+                   poll_interval=1.0, status_interval=None, monitor=None, ulpi_config=None):
+    # Every OVDevice already runs its own USB reader thread, so the devices
+    # capture concurrently; this thread only does setup and status polling.
+    sessions = [SniffSession(dev, speed, debug_filter, filter_nak, filter_sof,
+                             name=dev.serial or str(i), status_interval=status_interval,
+                             ulpi_config=ulpi_config)
+                for i, dev in enumerate(devs)]
+
+    for i, session in enumerate(sessions):
+        if not session.setup():
+            # Including the failed one, setup() starts SDRAM buffering
+            # before it checks the PHY
+            for s in sessions[:i + 1]:
+                s.stop()
+            return
 
-            print("%d / %d (%3.2f %% utilization) %d kB | %d overflow, %08x total | R%08x W%08x" %
-                (delta, ring_size, utilization, total / 1024,
-                dev.regs.OVF_INSERT_NUM_OVF.rd(), dev.regs.OVF_INSERT_NUM_TOTAL.rd(),
-                rptr, wptr
-                ), file = sys.stderr)
+    out = telemetry.CountingFile(open(out, "wb"))
+    if devs[0].stats is not None:
+        out = devs[0].stats.wrap_file(out)
+    output = OutputPcapng(out, [session.name for session in sessions],
+                          [session.clock for session in sessions])
+
+    merger = StreamMerger(len(sessions), output.write_packet, merge_delay)
+    for i, session in enumerate(sessions):
+        session.dev.rxcsniff.service.handlers = [merger.handler(i, session.clock)]
+
+    if monitor is not None:
+        for session in sessions:
+            monitor.add_source(session.metrics, device=session.name)
+        monitor.add_source(lambda: {"writer_queue_depth": merger.pending(),
+                                    "bytes_written_total": out.written})
+
+    merger.start()
 
-            dev.regs.OVF_INSERT_CTL.wr(0)
-            print("%d overflow, %08x total" % (dev.regs.OVF_INSERT_NUM_OVF.rd(), dev.regs.OVF_INSERT_NUM_TOTAL.rd()), file = sys.stderr)
-
-            if False:
-                dev.regs.SDRAM_SINK_DEBUG_CTL.wr(0)
-                print("rptr = %08x i_stb=%08x i_ack=%08x d_stb=%08x d_term=%08x s0=%08x s1=%08x s2=%08x | wptr = %08x i_stb=%08x i_ack=%08x d_stb=%08x d_term=%08x s0=%08x s1=%08x s2=%08x wrap=%x" % (
-                    dev.regs.SDRAM_HOST_READ_RPTR_STATUS.rd(),
-                    dev.regs.SDRAM_HOST_READ_DEBUG_I_STB.rd(),
-                    dev.regs.SDRAM_HOST_READ_DEBUG_I_ACK.rd(),
-                    dev.regs.SDRAM_HOST_READ_DEBUG_D_STB.rd(),
-                    dev.regs.SDRAM_HOST_READ_DEBUG_D_TERM.rd(),
-                    dev.regs.SDRAM_HOST_READ_DEBUG_S0.rd(),
-                    dev.regs.SDRAM_HOST_READ_DEBUG_S1.rd(),
-                    dev.regs.SDRAM_HOST_READ_DEBUG_S2.rd(),
-                    dev.regs.SDRAM_SINK_WPTR.rd(),
-                    dev.regs.SDRAM_SINK_DEBUG_I_STB.rd(),
-                    dev.regs.SDRAM_SINK_DEBUG_I_ACK.rd(),
-                    dev.regs.SDRAM_SINK_DEBUG_D_STB.rd(),
-                    dev.regs.SDRAM_SINK_DEBUG_D_TERM.rd(),
-                    dev.regs.SDRAM_SINK_DEBUG_S0.rd(),
-                    dev.regs.SDRAM_SINK_DEBUG_S1.rd(),
-                    dev.regs.SDRAM_SINK_DEBUG_S2.rd(),
-                    dev.regs.SDRAM_SINK_WRAP_COUNT.rd(),
-                    ), file = sys.stderr)
-            if timeout and elapsed_time > timeout:
+    start_time = time.monotonic()
+    try:
+        for session in sessions:
+            session.start()
+        if monitor is not None:
+            monitor.start()
+        while 1:
+            for session in sessions:
+                session.poll()
+            if timeout and time.monotonic() - start_time > timeout:
                 break
-            time.sleep(1)
-            elapsed_time = elapsed_time + 1
+            time.sleep(poll_interval)
     except KeyboardInterrupt:
         pass
     finally:
-        dev.regs.SDRAM_SINK_GO.wr(0)
-        dev.regs.SDRAM_HOST_READ_GO.wr(0)
-        dev.regs.CSTREAM_CFG.wr(0)
-
-    if out is not None:
+        for session in sessions:
+            session.stop()
+        merger.stop()
+        if monitor is not None:
+            monitor.stop()
+        for i, session in enumerate(sessions):
+            session.dev.status_records.handlers = []
+            if session.status is not None:
+                output.write_statistics(i, session.status)
         out.close()
 
+def add_telemetry_args(sp):
+    sp.add_argument('--telemetry', type=telemetry.exporter, action='append', metavar='TARGET',
+                    help='Export capture and host metrics: json:FILE, json:tcp:HOST:PORT, '
+                         'json:unix:PATH (JSON lines) or prom:FILE (Prometheus textfile); repeatable')
+    sp.add_argument('--telemetry-interval', type=float, default=10.0, metavar='SECONDS',
+                    help='Telemetry export interval')
+
+def make_monitor(args):
+    if not args.telemetry:
+        return None
+    return telemetry.Telemetry(args.telemetry_interval, args.telemetry)
+
 class Sniff(Command):
     name = "sniff"
     help = 'Perform USB trace / sniffing'
@@ -416,11 +806,177 @@ class Sniff(Command):
                         help='Filter SOF packets in gateware')
         sp.add_argument('--debug-filter', action='store_true',
                         help='Report filtered packets instead of discarding')
+        sp.add_argument('--poll-interval', type=float, default=1.0, metavar='SECONDS',
+                        help='Capture status polling interval; status is still logged once a second')
+        sp.add_argument('--status-interval', type=float, default=0.01, metavar='SECONDS',
+                        help='Interval of the status records pushed by the gateware, where supported; '
+                             '0 to poll registers instead')
+        sp.add_argument('--ulpi-config', type=str, metavar='FILE',
+                        help='Apply PHY registers saved by ulpi-dump before capturing')
+        add_telemetry_args(sp)
 
     @staticmethod
     def go(dev, args):
         do_sniff(dev, args.speed, args.format, args.out, args.timeout,
-                 args.debug_filter, args.filter_nak, args.filter_sof)
+                 args.debug_filter, args.filter_nak, args.filter_sof, args.poll_interval,
+                 args.status_interval, make_monitor(args),
+                 args.ulpi_config and load_ulpi_config(args.ulpi_config))
+
+
+class SniffMulti(Command):
+    name = "sniff-multi"
+    help = 'Sniff on several devices (select with --serial) into one pcapng file'
+    multi_device = True
+
+    @staticmethod
+    def setup_args(sp):
+        sp.add_argument('speed', type=str, choices=sniff_speeds,
+                        help='USB Speed (High Speed, Full Speed, Low Speed)')
+        sp.add_argument('--out', type=str, required=True,
+                        help='Output pcapng file name')
+        sp.add_argument('--timeout', type=int, help='Timeout in seconds')
+        sp.add_argument('--filter-nak', action='store_true',
+                        help='Filter NAKed transactions in gateware')
+        sp.add_argument('--filter-sof', action='store_true',
+                        help='Filter SOF packets in gateware')
+        sp.add_argument('--debug-filter', action='store_true',
+                        help='Report filtered packets instead of discarding')
+        sp.add_argument('--poll-interval', type=float, default=1.0, metavar='SECONDS',
+                        help='Capture status polling interval; status is still logged once a second')
+        sp.add_argument('--status-interval', type=float, default=0.01, metavar='SECONDS',
+                        help='Interval of the status records pushed by the gateware, where supported; '
+                             '0 to poll registers instead')
+        sp.add_argument('--ulpi-config', type=str, metavar='FILE',
+                        help='Apply PHY registers saved by ulpi-dump before capturing')
+        add_telemetry_args(sp)
+        sp.add_argument('--merge-delay', type=float, default=1.0,
+                        help='Seconds to hold packets back while waiting for the other devices')
+
+    @staticmethod
+    def go(devs, args):
+        do_sniff_multi(devs, args.speed, args.out, args.timeout,
+                       args.debug_filter, args.filter_nak, args.filter_sof,
+                       args.merge_delay, args.poll_interval, args.status_interval,
+                       make_monitor(args),
+                       args.ulpi_config and load_ulpi_config(args.ulpi_config))
+
+
+def percentile(values, p):
+    """Nearest rank percentile of sorted values"""
+    return values[max(0, min(len(values) - 1, int(round(p / 100.0 * len(values))) - 1))]
+
+def do_latency(dev, speed, count, interval, timeout=2.0, filter_nak=False, filter_sof=False,
+               status_interval=None):
+    """
+    Capture as sniff does, but instead of decoding ask the gateware for
+    marker packets. Markers are stuffed into the capture stream behind
+    whatever was captured before, so the time from the request to the
+    marker arriving here is the capture latency under the current bus
+    load: SDRAM ring, USB link and host decoding.
+
+    Markers carry no ID, so only one is in flight at a time: the next is
+    requested 'interval' seconds after the previous one arrived. One that
+    does not arrive within 'timeout' seconds ends the run, it could still
+    turn up later and be taken for the next.
+    """
+    session = SniffSession(dev, speed, filter_nak=filter_nak, filter_sof=filter_sof,
+                           status_interval=status_interval)
+
+    if not session.setup():
+        return
+
+    arrived = threading.Event()
+    arrival = [None]
+    captured = [0, 0]
+
+    def handle_usb(ts, pkt, flags, orig_len):
+        if flags & LibOV.HF0_MARKER:
+            arrival[0] = time.monotonic()
+            arrived.set()
+        elif pkt:
+            # Not the empty start/end of capture packets
+            captured[0] += 1
+            captured[1] += orig_len
+
+    dev.rxcsniff.service.handlers = [handle_usb]
+
+    latencies = []
+    round_trips = []
+    lost = False
+    try:
+        session.start()
+        for i in range(count):
+            time.sleep(interval)
+            session.poll()
+
+            arrived.clear()
+            t = time.monotonic()
+            dev.regs.CSTREAM_MARKER.wr(1)
+            round_trips.append(time.monotonic() - t)
+
+            if not arrived.wait(timeout):
+                lost = True
+                break
+            latencies.append(arrival[0] - t)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        session.stop()
+
+    dev.drain()
+    dev.rxcsniff.service.handlers = []
+    dev.status_records.handlers = []
+
+    print()
+    print("%d markers requested, %d received, %d packets (%d bytes) captured meanwhile" % (
+        len(round_trips), len(latencies), captured[0], captured[1]))
+    if lost:
+        print("Marker %d did not arrive within %.1f s, stopped" % (len(round_trips), timeout))
+    if session.status is not None and session.status.num_ovf:
+        print("%d bytes lost to ring overflow" % session.status.num_ovf)
+
+    for name, values in [("Marker latency", latencies), ("Register write", round_trips)]:
+        if not values:
+            continue
+        values = sorted(values)
+        print("%-15s min %8.3f  p50 %8.3f  p90 %8.3f  p99 %8.3f  max %8.3f ms" % (
+            name + ":", values[0] * 1e3, percentile(values, 50) * 1e3, percentile(values, 90) * 1e3,
+            percentile(values, 99) * 1e3, values[-1] * 1e3))
+
+
+class Latency(Command):
+    name = "latency"
+    help = 'Measure capture latency with markers injected into the capture stream'
+
+    @staticmethod
+    def setup_args(sp):
+        sp.add_argument('speed', type=str, choices=sniff_speeds,
+                        help='USB Speed (High Speed, Full Speed, Low Speed)')
+        sp.add_argument('--count', type=int, default=100,
+                        help='Number of markers')
+        sp.add_argument('--interval', type=float, default=0.1, metavar='SECONDS',
+                        help='Time from a marker arriving to requesting the next')
+        sp.add_argument('--timeout', type=float, default=2.0, metavar='SECONDS',
+                        help='Give up when a marker takes longer than this')
+        sp.add_argument('--filter-nak', action='store_true',
+                        help='Filter NAKed transactions in gateware')
+        sp.add_argument('--filter-sof', action='store_true',
+                        help='Filter SOF packets in gateware')
+        sp.add_argument('--status-interval', type=float, default=0.01, metavar='SECONDS',
+                        help='Interval of the status records pushed by the gateware, where supported; '
+                             '0 to poll registers instead')
+
+    @staticmethod
+    def go(dev, args):
+        if 'CSTREAM_MARKER' not in dev.regs:
+            print("Gateware has no capture latency markers")
+            return
+        if args.count < 1:
+            print("Count must be at least 1")
+            return
+
+        do_latency(dev, args.speed, args.count, args.interval, args.timeout,
+                   args.filter_nak, args.filter_sof, args.status_interval)
 
 
 @command('debug-stream', 'Debug Stream')
@@ -465,11 +1021,31 @@ def sdram_host_read_test(dev):
     ring_base = 0x10000
     ring_end = ring_base + 1024*1024
 
-    dev.regs.SDRAM_SINK_RING_BASE.wr(ring_base)
-    dev.regs.SDRAM_SINK_RING_END.wr(ring_end)
-
-    dev.regs.SDRAM_HOST_READ_RING_BASE.wr(ring_base)
-    dev.regs.SDRAM_HOST_READ_RING_END.wr(ring_end)
+    with dev.batch() as b:
+        b.wr(dev.regs.SDRAM_SINK_RING_BASE, ring_base)
+        b.wr(dev.regs.SDRAM_SINK_RING_END, ring_end)
+
+        b.wr(dev.regs.SDRAM_HOST_READ_RING_BASE, ring_base)
+        b.wr(dev.regs.SDRAM_HOST_READ_RING_END, ring_end)
+
+    debug_regs = [
+        "SDRAM_HOST_READ_DEBUG_I_STB",
+        "SDRAM_HOST_READ_DEBUG_I_ACK",
+        "SDRAM_HOST_READ_DEBUG_D_STB",
+        "SDRAM_HOST_READ_DEBUG_D_TERM",
+        "SDRAM_HOST_READ_DEBUG_S0",
+        "SDRAM_HOST_READ_DEBUG_S1",
+        "SDRAM_HOST_READ_DEBUG_S2",
+        "SDRAM_SINK_WPTR",
+        "SDRAM_SINK_DEBUG_I_STB",
+        "SDRAM_SINK_DEBUG_I_ACK",
+        "SDRAM_SINK_DEBUG_D_STB",
+        "SDRAM_SINK_DEBUG_D_TERM",
+        "SDRAM_SINK_DEBUG_S0",
+        "SDRAM_SINK_DEBUG_S1",
+        "SDRAM_SINK_DEBUG_S2",
+        "SDRAM_SINK_WRAP_COUNT",
+    ]
 
     cnt = 0
     while True:
@@ -482,24 +1058,13 @@ def sdram_host_read_test(dev):
             print("GO SOURCE")
             dev.regs.SDRAM_HOST_READ_GO.wr(1)
 
+        # One round trip for the whole set, so the values are a consistent
+        # snapshot rather than spread over 16 USB transactions
+        with dev.batch() as b:
+            values = [b.rd(name) for name in debug_regs]
+
         print("rptr = %08x i_stb=%08x i_ack=%08x d_stb=%08x d_term=%08x s0=%08x s1=%08x s2=%08x | wptr = %08x i_stb=%08x i_ack=%08x d_stb=%08x d_term=%08x s0=%08x s1=%08x s2=%08x wrap=%x" % (
-            rptr,
-            dev.regs.SDRAM_HOST_READ_DEBUG_I_STB.rd(),
-            dev.regs.SDRAM_HOST_READ_DEBUG_I_ACK.rd(),
-            dev.regs.SDRAM_HOST_READ_DEBUG_D_STB.rd(),
-            dev.regs.SDRAM_HOST_READ_DEBUG_D_TERM.rd(),
-            dev.regs.SDRAM_HOST_READ_DEBUG_S0.rd(),
-            dev.regs.SDRAM_HOST_READ_DEBUG_S1.rd(),
-            dev.regs.SDRAM_HOST_READ_DEBUG_S2.rd(),
-            dev.regs.SDRAM_SINK_WPTR.rd(),
-            dev.regs.SDRAM_SINK_DEBUG_I_STB.rd(),
-            dev.regs.SDRAM_SINK_DEBUG_I_ACK.rd(),
-            dev.regs.SDRAM_SINK_DEBUG_D_STB.rd(),
-            dev.regs.SDRAM_SINK_DEBUG_D_TERM.rd(),
-            dev.regs.SDRAM_SINK_DEBUG_S0.rd(),
-            dev.regs.SDRAM_SINK_DEBUG_S1.rd(),
-            dev.regs.SDRAM_SINK_DEBUG_S2.rd(),
-            dev.regs.SDRAM_SINK_WRAP_COUNT.rd(),
+            (rptr,) + tuple(v.result() for v in values)
             ), file = sys.stderr)
 
         if cnt == 20:
@@ -508,20 +1073,82 @@ def sdram_host_read_test(dev):
 #            print("STOP: %d" % dev.regs.SDRAM_HOST_READ_GO.rd())
 
 
+def rate_histogram(rates, buckets=10, width=40):
+    """Text histogram of per-second rates in MB/s, one line per bucket"""
+    lo, hi = min(rates), max(rates)
+    step = (hi - lo) / buckets or 1.0
+
+    counts = [0] * buckets
+    for rate in rates:
+        counts[min(int((rate - lo) / step), buckets - 1)] += 1
+
+    peak = max(counts)
+    return ["%8.3f - %8.3f MB/s %6d %s" % (lo + i * step, lo + (i + 1) * step, n,
+                                          "#" * (n * width // peak))
+            for i, n in enumerate(counts)]
+
+# RANDTEST_CFG bits, see ovhw/ftdi_lfsr_test.py
+RANDTEST_ENABLE = 0x01
+RANDTEST_SEQUENCE = 0x02
+
+def randtest_stop(dev):
+    # Stop the generator - do twice to make sure
+    # theres no hanging packet 
+    dev.regs.RANDTEST_CFG.wr(0)
+    dev.regs.RANDTEST_CFG.wr(0)
+
+def randtest_start(dev, test, size, sequence=False, rate_div=0):
+    """Start the test generator, with fresh statistics in test"""
+    # Set test packet size
+    if sequence:
+        dev.regs.RANDTEST_SEQ_SIZE.wr(size)
+        dev.regs.RANDTEST_SEQ_DIV.wr(rate_div)
+    else:
+        dev.regs.RANDTEST_SIZE.wr(size)
+
+    # Reset the statistics counters, the generator restarts from its
+    # reset state so the checker knows what to expect from the first byte
+    test.reset()
+
+    # Start the test (and reinit the generator)
+    dev.regs.RANDTEST_CFG.wr(RANDTEST_ENABLE | (RANDTEST_SEQUENCE if sequence else 0))
+
 class LB_Test(Command):
     name = "lb-test"
-    help = ''
+    help = 'Verify the USB link with an LFSR test stream and measure its throughput'
 
     @staticmethod
     def setup_args(sp):
-        sp.add_argument("size", type=int, default=64, nargs='?')
+        sp.add_argument("size", type=int, nargs='?',
+                        help='Payload bytes per test packet (default: 64, 4096 with --sequence)')
+        sp.add_argument("--duration", type=float, metavar='SECONDS',
+                        help='Stop after this long (default: run until interrupted)')
+        sp.add_argument("--sequence", action='store_true',
+                        help='Sequence numbered packets instead: only headers are checked, '
+                             'reports bytes dropped by the gateware and lost on the way')
+        sp.add_argument("--rate-div", type=int, default=0, metavar='N',
+                        help='With --sequence, produce one payload byte every N+1 gateware clocks; '
+                             'packets the link has no room for are dropped')
 
     @staticmethod
     def go(dev, args):
-        # Stop the generator - do twice to make sure
-        # theres no hanging packet 
-        dev.regs.RANDTEST_CFG.wr(0)
-        dev.regs.RANDTEST_CFG.wr(0)
+        if args.sequence:
+            size = args.size or 4096
+            if 'RANDTEST_SEQ_SIZE' not in dev.regs:
+                print("Gateware has no sequence numbered test mode")
+                return
+            if not 1 <= size <= 0xFFFF or not 0 <= args.rate_div <= 0xFF:
+                print("Sequence mode size must be 1..65535, rate divider 0..255")
+                return
+            test = dev.seqtest
+        else:
+            size = args.size or 64
+            if not 1 <= size <= 0xFF:
+                print("Size must be 1..255")
+                return
+            test = dev.lfsrtest
+
+        randtest_stop(dev)
 
         # LEDs off
         dev.regs.LEDS_MUX_2.wr(0)
@@ -531,27 +1158,329 @@ class LB_Test(Command):
         dev.regs.LEDS_MUX_0.wr(2)
         dev.regs.LEDS_MUX_1.wr(2)
 
-        # Set test packet size
-        dev.regs.RANDTEST_SIZE.wr(args.size)
-
-        # Reset the statistics counters
-        dev.lfsrtest.reset()
-
-        # Start the test (and reinit the generator)
-        dev.regs.RANDTEST_CFG.wr(1)
+        randtest_start(dev, test, size, args.sequence, args.rate_div)
 
-        st = time.time()
+        st = last_time = time.time()
+        last_total = 0
+        rates = []
         try:
-            while 1:
+            while args.duration is None or time.time() - st < args.duration:
                 time.sleep(1)
-                b = dev.lfsrtest.stats()
-                print("%4s %20d bytes %f MB/sec average" % (
-                    "ERR" if b.error else "OK", 
-                    b.total, b.total/float(time.time() - st)/1024/1024))
+                b = test.stats()
+                now = time.time()
+
+                rates.append((b.total - last_total) / (now - last_time) / 1024 / 1024)
+                last_total, last_time = b.total, now
+
+                # Gateware drops only mean the link is slower than the
+                # generator, not that it is broken
+                if args.sequence:
+                    bad = b.lost_bytes
+                    detail = "%d dropped %d lost" % (b.dropped_bytes, b.lost_bytes)
+                else:
+                    bad = b.errors
+                    detail = "%d errors" % b.errors
+                print("%4s %20d bytes %10.3f MB/sec %10.3f MB/sec average %s" % (
+                    "ERR" if bad else "OK", 
+                    b.total, rates[-1], b.total/float(now - st)/1024/1024, detail))
 
         except KeyboardInterrupt:
+            pass
+        finally:
             dev.regs.randtest_cfg.wr(0)
 
+        # Count what was still in flight
+        dev.drain()
+        b = test.stats()
+        elapsed = time.time() - st
+
+        print()
+        print("%d bytes in %.1f s, %.3f MB/sec average" % (b.total, elapsed, b.total/elapsed/1024/1024))
+        if rates:
+            print("Per-second throughput:")
+            for line in rate_histogram(rates):
+                print("  " + line)
+
+        if args.sequence:
+            produced = b.total + b.dropped_bytes
+            print("%d packets received, %d dropped by the gateware (%d bytes, %.2f%% of %d produced)" % (
+                b.packets, b.dropped, b.dropped_bytes,
+                100.0 * b.dropped_bytes / produced if produced else 0, produced))
+            print("%d bytes lost between the FTDI and the host" % b.lost_bytes)
+            for kind, offset, seq, n in b.events:
+                print("  %d %s %s before packet %d, stream offset %d" % (
+                    n, "packets" if kind == "dropped" else "bytes", kind, seq, offset))
+            if b.errors > len(b.events):
+                print("  ...")
+            print("PASS" if not b.lost_bytes and b.packets else "FAIL")
+            return
+
+        print("%d byte errors, %d resyncs" % (b.errors, b.resyncs))
+        if b.error_offsets:
+            more = " ..." if b.errors > len(b.error_offsets) else ""
+            print("Error offsets: %s%s" % (" ".join(str(o) for o in b.error_offsets), more))
+        print("PASS" if not b.errors and b.total else "FAIL")
+
+
+# Where usb-tune --save keeps its result
+READ_QUEUE_FILE = "read-queue.json"
+
+def saved_read_queue():
+    """(packets per transfer, transfers) saved by usb-tune, or None"""
+    try:
+        with open(os.path.join(fwpkg.cache_dir(), READ_QUEUE_FILE)) as f:
+            saved = json.load(f)
+        return int(saved["packets_per_transfer"]), int(saved["num_transfers"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def read_queue(args):
+    """The USB read queue from the command line, else as tuned, else the default"""
+    default = saved_read_queue() or (LibOV.DEFAULT_PACKETS_PER_TRANSFER, LibOV.DEFAULT_NUM_TRANSFERS)
+    return (args.usb_packets or default[0], args.usb_transfers or default[1])
+
+class USBTune(Command):
+    name = "usb-tune"
+    help = 'Find the smallest USB read queue that sustains full throughput on this host'
+
+    # Candidate packets per transfer and transfer counts
+    PACKETS = (1, 2, 4, 8, 16, 32, 64)
+    TRANSFERS = (2, 4, 8, 16, 32)
+
+    @staticmethod
+    def setup_args(sp):
+        sp.add_argument('--trial-time', type=float, default=1.0, metavar='SECONDS',
+                        help='Streaming time per queue setting')
+        sp.add_argument('--margin', type=float, default=0.95,
+                        help='Fraction of the peak throughput a setting has to reach')
+        sp.add_argument('--save', action='store_true',
+                        help='Use the result from now on, unless overridden by --usb-packets '
+                             'and --usb-transfers (kept in %s)'
+                             % os.path.join(fwpkg.cache_dir(), READ_QUEUE_FILE))
+
+    @staticmethod
+    def measure(dev, queue, trial_time):
+        """MB/s streamed with the read queue 'queue', None if data went missing"""
+        # The queue is set up when the device is opened
+        dev.close()
+        dev.read_queue = queue
+        err = dev.open()
+        if err:
+            raise IOError("USB: Error reopening device: %d" % err)
+
+        # The sequence mode needs next to no CPU, so it measures the link
+        # rather than the packet checking
+        sequence = 'RANDTEST_SEQ_SIZE' in dev.regs
+        test = dev.seqtest if sequence else dev.lfsrtest
+
+        randtest_stop(dev)
+        randtest_start(dev, test, 4096 if sequence else 255, sequence)
+        try:
+            # Let the queue fill up first
+            time.sleep(0.2)
+            start, st = test.stats().total, time.time()
+            time.sleep(trial_time)
+            b = test.stats()
+            elapsed = time.time() - st
+        finally:
+            randtest_stop(dev)
+
+        if (b.lost_bytes if sequence else b.errors):
+            return None
+        return (b.total - start) / elapsed / 1024 / 1024
+
+    @staticmethod
+    def go(dev, args):
+        initial = dev.read_queue
+
+        candidates = sorted(((p, t) for p in USBTune.PACKETS for t in USBTune.TRANSFERS),
+                            key=lambda q: (q[0] * q[1], q[0]))
+
+        chosen = None
+        try:
+            peak = USBTune.measure(dev, candidates[-1], args.trial_time)
+            if peak is None:
+                print("Data lost even with the deepest queue, check the link with lb-test")
+                return
+            print("Peak %.3f MB/sec with %d packets x %d transfers" % ((peak,) + candidates[-1]))
+
+            for queue in candidates:
+                rate = USBTune.measure(dev, queue, args.trial_time)
+                print("%3d packets x %2d transfers: %s" % (queue + (
+                    "data lost" if rate is None else "%.3f MB/sec" % rate,)))
+
+                if rate is not None and rate >= args.margin * peak:
+                    chosen = queue
+                    break
+        finally:
+            # Closed already if a reopen in measure() failed
+            if dev.is_open:
+                dev.close()
+            dev.read_queue = chosen or initial
+            err = dev.open()
+            if err:
+                raise IOError("USB: Error reopening device: %d" % err)
+
+        if chosen is None:
+            print("No setting reached %d%% of the peak, throughput is too erratic to tune"
+                  % (args.margin * 100))
+            return
+
+        print("Use --usb-packets %d --usb-transfers %d" % chosen)
+
+        if args.save:
+            os.makedirs(fwpkg.cache_dir(), exist_ok=True)
+            with open(os.path.join(fwpkg.cache_dir(), READ_QUEUE_FILE), "w") as f:
+                json.dump({"packets_per_transfer": chosen[0], "num_transfers": chosen[1]}, f)
+            print("Saved, used from now on")
+
+
+class _DaemonStream:
+    """
+    Text stream sending everything written to it to a daemon client, see
+    ovclient.py. Once the client has gone, output is dropped; the command's
+    own thread gets a KeyboardInterrupt, so it stops just like after Ctrl-C.
+    """
+
+    def __init__(self, conn, key, lock, thread):
+        self.conn = conn
+        self.key = key
+        self.lock = lock
+        self.thread = thread
+        self.closed = False
+
+    def write(self, s):
+        if not s or self.closed:
+            return len(s)
+        try:
+            with self.lock:
+                self.conn.sendall(json.dumps({self.key: s}).encode("utf-8") + b"\n")
+        except OSError:
+            self.closed = True
+            if threading.current_thread() is self.thread:
+                raise KeyboardInterrupt
+        return len(s)
+
+    def flush(self):
+        pass
+
+def daemon_parser():
+    ap = argparse.ArgumentParser(prog="ovclient.py")
+    add_commands(ap, [i for i in Command.__subclasses__()
+                      if not i.multi_device and i is not Daemon])
+    return ap
+
+def daemon_run(dev, ap, conn):
+    req = json.loads(conn.makefile("r", encoding="utf-8").readline())
+
+    lock = threading.Lock()
+    out = _DaemonStream(conn, "out", lock, threading.current_thread())
+    err = _DaemonStream(conn, "err", lock, threading.current_thread())
+
+    status = 0
+    cwd = os.getcwd()
+    import contextlib
+    import traceback
+
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        try:
+            # Relative paths are the client's
+            os.chdir(req.get("cwd", cwd))
+
+            args = ap.parse_args(req["argv"])
+            if not hasattr(args, 'hdlr'):
+                ap.print_usage()
+                status = 2
+            else:
+                args.hdlr.go(dev, args)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except KeyboardInterrupt:
+            status = 130
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os.chdir(cwd)
+
+    if not out.closed:
+        with lock:
+            conn.sendall(json.dumps({"exit": status}).encode("utf-8") + b"\n")
+
+def daemon_serve(dev, path):
+    import ovclient
+    import socket
+    import stat
+
+    path = path or ovclient.default_socket()
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        mode = None
+
+    if mode is not None:
+        # Connecting to a regular file is refused too, never delete one
+        if not stat.S_ISSOCK(mode):
+            print("%s exists and is not a socket" % path)
+            return 1
+
+        try:
+            ovclient.connect(path).close()
+            print("An ovctl daemon is already listening on %s" % path)
+            return 1
+        except ConnectionRefusedError:
+            # Left behind by a daemon that was killed
+            os.unlink(path)
+        except OSError as e:
+            print("Can't check for a daemon on %s: %s" % (path, e))
+            return 1
+
+    ap = daemon_parser()
+
+    # Commands change the packet handlers, each one starts from the defaults
+    handlers = list(dev.rxcsniff.service.handlers)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        # Created owner only from the start, a chmod afterwards would leave
+        # a window where others can connect
+        umask = os.umask(0o177)
+        try:
+            sock.bind(path)
+        finally:
+            os.umask(umask)
+        sock.listen(4)
+        print("Listening on %s" % path, file = sys.stderr)
+
+        while True:
+            conn, _ = sock.accept()
+            with conn:
+                dev.rxcsniff.service.handlers = handlers
+                dev.status_records.handlers = []
+                try:
+                    daemon_run(dev, ap, conn)
+                except (OSError, ValueError, KeyError) as e:
+                    print("Bad request: %s" % e, file = sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+class Daemon(Command):
+    name = "daemon"
+    help = 'Keep the device open and run commands sent with ovclient.py'
+
+    @staticmethod
+    def setup_args(sp):
+        sp.add_argument('--socket', type=str,
+                        help='Unix socket to listen on (default: see ovclient.py --help)')
+
+    @staticmethod
+    def go(dev, args):
+        return daemon_serve(dev, args.socket)
+
 
 def min_version_check(major, minor):
     error_msg = 'ERROR: I depend on behavior in Python {0}.{1} or greater'
@@ -559,51 +1488,64 @@ def min_version_check(major, minor):
         sys.exit(error_msg.format(major, minor))
 
 
-def main():
-
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--pkg", "-p", type=lambda x: zipfile.ZipFile(x, 'r'), 
-            default=default_package)
-    ap.add_argument("-l", "--load", action="store_true")
-    ap.add_argument("--verbose", "-v", action="store_true")
-    ap.add_argument("--config-only", "-C", action="store_true")
-    ap.add_argument("--force-load-bitstream", "-f", action="store_true")
-
-    # Bind commands
-    subparsers = ap.add_subparsers(title='subcommands',
-                                   description='Supported Sub-commands, each has their own --help')
-    for i in Command.__subclasses__():
-        sp = subparsers.add_parser(i.name, help=i.help)
-        i.setup_args(sp)
-        sp.set_defaults(hdlr=i)
+def replay_device(args):
+    if args.replay == "synth":
+        source = traffic.hs_bulk()
+    elif args.replay in traffic.PROFILES:
+        source = traffic.PROFILES[args.replay]()
+    else:
+        source = traffic.RecordedTraffic(args.replay, loop=args.replay_loop)
 
-    args = ap.parse_args()
+    import replay
+    return replay.ReplayDevice(None, source, args.replay_rate, regmap=args.pkg.regmap())
 
+def open_device(args, serial=None, stats=None):
+    dev = LibOV.OVDevice(regmap=args.pkg.regmap(), verbose=args.verbose,
+                         serial=serial, dev=replay_device(args) if args.replay else None,
+                         stats=stats, io_timeout=args.io_timeout, read_queue=read_queue(args),
+                         write_window=None if args.sync_writes else args.write_window)
 
-    dev = LibOV.OVDevice(mapfile=args.pkg.open('map.txt', 'r'), verbose=args.verbose)
+    if args.profile:
+        import cProfile
+        dev.comm_profiler = cProfile.Profile()
 
-    err = dev.open(bitstream=args.pkg.open('ov3.bit', 'r') if args.load else None)
+    # With a bitstream, open() itself skips the reload if the FPGA already
+    # runs this build
+    load = args.load or args.force_load_bitstream
+    err = dev.open(bitstream=args.pkg.config_data() if load else None,
+                   force=args.force_load_bitstream)
 
     if err:
         if err == -4:
             print("USB: Unable to find device")
-            return 1
+            return None
         print("USB: Error opening device (1)\n")
         print(err)
 
-    if args.force_load_bitstream or not dev.isLoaded():
-        print("FPGA not loaded, forcing reload")
+    reload = None
+    if not err and not dev.isLoaded():
+        reload = "FPGA not loaded, forcing reload"
+    elif not err and not load and dev.gateware_matches() is False:
+        reload = "FPGA runs a different build than %s, reloading" % args.pkg
+
+    if reload:
+        print(reload)
+        if args.verbose:
+            bit = args.pkg.bitstream_info()
+            print("Bitstream %s for %s, built %s %s" % (bit.get("design"), bit.get("part"),
+                                                        bit.get("date"), bit.get("time")))
         dev.close()
 
-        err = dev.open(bitstream=args.pkg.open('ov3.bit','r'))
+        # We already know it has to be configured, don't let open() second
+        # guess that from the build ID
+        err = dev.open(bitstream=args.pkg.config_data(), force=True)
 
     if err:
         print("USB: Error opening device (2)\n")
-        return 1
-
+        return None
 
     if args.config_only:
-        return
+        return dev
 
     if not (hasattr(args, 'hdlr') and args.hdlr.name.startswith("eep-")):
         ret = dev.dev.eeprom_sanitycheck()
@@ -611,22 +1553,178 @@ def main():
             print("\nPlease run this tool with the subcommand 'eep-program <serial number>'")
             print("to program your EEPROM. The FT2232H FIFO will not work correctly with")
             print("default settings.")
-            return 1
+            dev.close()
+            return None
         elif ret < 0:
             print("USB: Error checking EEPROM\n")
-            return 1
+            dev.close()
+            return None
 
     dev.dev.write(LibOV.FTDI_INTERFACE_A, b'\x00' * 512, async_=False)
 
+    return dev
+
+def report_stats(stats, interval, stop):
+    while not stop.wait(interval):
+        stats.report()
+        print(file = sys.stderr)
+
+def dump_profile(path, profiler, devs):
+    import pstats
+
+    ps = pstats.Stats(profiler, stream = sys.stderr)
+    for dev in devs:
+        try:
+            ps.add(dev.comm_profiler)
+        except TypeError:
+            # USB thread never ran
+            pass
+
+    ps.dump_stats(path)
+    ps.sort_stats("cumulative").print_stats(30)
+
+
+def add_commands(ap, commands):
+    subparsers = ap.add_subparsers(title='subcommands',
+                                   description='Supported Sub-commands, each has their own --help')
+    for i in commands:
+        sp = subparsers.add_parser(i.name, help=i.help)
+        i.setup_args(sp)
+        sp.set_defaults(hdlr=i)
+
+class StartupTiming:
+    """Time taken by each step up to running the command, see --timing"""
+
+    def __init__(self, start):
+        self.start = start
+        self.last = start
+        self.steps = []
+
+    def mark(self, step, now=None):
+        now = now if now is not None else time.perf_counter()
+        self.steps.append((step, now - self.last))
+        self.last = now
+
+    def report(self, file=sys.stderr):
+        for step, seconds in self.steps:
+            print("%-16s %8.1f ms" % (step, seconds * 1000), file=file)
+        print("%-16s %8.1f ms" % ("total", (self.last - self.start) * 1000), file=file)
+
+def main():
+    main_start = time.perf_counter()
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pkg", "-p", type=fwpkg.Package,
+            default=default_package)
+    ap.add_argument("--no-pkg-cache", action="store_true",
+            help="Parse the package every time instead of using the cache in %s" % fwpkg.cache_dir())
+    ap.add_argument("-l", "--load", action="store_true")
+    ap.add_argument("--verbose", "-v", action="store_true")
+    ap.add_argument("--config-only", "-C", action="store_true")
+    ap.add_argument("--force-load-bitstream", "-f", action="store_true")
+    ap.add_argument("--serial", "-s", action="append",
+            help="Device serial number or string; repeat for multi-device commands")
+    ap.add_argument("--replay", "-R", metavar="SOURCE",
+            help="Run without hardware: replay a capture recorded with 'sniff --format raw', "
+                 "'synth' for synthesised high speed bulk traffic, or one of the "
+                 "traffic profiles: %s" % ", ".join(traffic.PROFILES))
+    ap.add_argument("--replay-rate", type=float,
+            help="Limit the replayed stream to this many MB/sec")
+    ap.add_argument("--replay-loop", action="store_true",
+            help="Repeat the replayed recording")
+    ap.add_argument("--io-timeout", type=float, metavar="SECONDS",
+            help="Fail register accesses that take longer than this (default: wait forever)")
+    ap.add_argument("--usb-packets", type=int, metavar="N",
+            help="512 byte USB packets per read transfer (default %d, or as saved by usb-tune)"
+                 % LibOV.DEFAULT_PACKETS_PER_TRANSFER)
+    ap.add_argument("--usb-transfers", type=int, metavar="N",
+            help="USB read transfers kept queued (default %d, or as saved by usb-tune)"
+                 % LibOV.DEFAULT_NUM_TRANSFERS)
+    ap.add_argument("--write-window", type=float, default=0.0, metavar="SECONDS",
+            help="Hold register commands back this long to send more of them per USB write "
+                 "(default: only while earlier writes are in flight)")
+    ap.add_argument("--sync-writes", action="store_true",
+            help="One synchronous USB write per register command")
+    ap.add_argument("--stats", action="store_true",
+            help="Report calls and time per host pipeline stage at exit")
+    ap.add_argument("--stats-interval", type=float, metavar="SECONDS",
+            help="Also report pipeline stage stats periodically")
+    ap.add_argument("--profile", nargs="?", const="ovctl.prof", metavar="FILE",
+            help="Run under cProfile and dump the stats to FILE (default %(const)s)")
+    ap.add_argument("--timing", action="store_true",
+            help="Report where startup time goes")
+
+    add_commands(ap, Command.__subclasses__())
+
+    args = ap.parse_args()
+
+    timing = StartupTiming(_import_start)
+    timing.mark("imports", main_start)
+    timing.mark("arguments")
+
+    args.pkg.cache = not args.no_pkg_cache
+
+
+    serials = args.serial or [None]
+    multi = hasattr(args, 'hdlr') and args.hdlr.multi_device
+    if len(serials) > 1 and not multi:
+        print("Only one device can be selected for this command")
+        return 1
+
+    stats = None
+    stats_stop = threading.Event()
+    if args.stats or args.stats_interval:
+        stats = LibOV.StageStats()
+        if args.stats_interval:
+            threading.Thread(target=report_stats, daemon=True,
+                    args=(stats, args.stats_interval, stats_stop)).start()
+
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+
+    # Parsed map and bitstream header, from the cache if possible
+    args.pkg.regmap()
+    timing.mark("package")
+
+    devs = []
     try:
+        for serial in serials:
+            dev = open_device(args, serial, stats)
+            if dev is None:
+                return 1
+            devs.append(dev)
+        timing.mark("device open")
+
+        if args.config_only:
+            return
+
         if hasattr(args, 'hdlr'):
-            args.hdlr.go(dev, args)
+            if profiler is not None:
+                profiler.enable()
+            try:
+                args.hdlr.go(devs if multi else devs[0], args)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                timing.mark("command")
     finally:
-        dev.close()
+        if args.timing:
+            timing.report()
+
+        for dev in devs:
+            if dev.is_open:
+                dev.close()
+
+        stats_stop.set()
+        if stats is not None:
+            stats.report()
+
+        if profiler is not None and hasattr(args, 'hdlr'):
+            dump_profile(args.profile, profiler, devs)
 
 if  __name__ == "__main__":
     min_version_check(MIN_MAJOR, MIN_MINOR)
-#    yappi.start()
     main()
-#    yappi.print_stats()
 
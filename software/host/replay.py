@@ -0,0 +1,366 @@
+import threading
+import time
+
+from LibOV import parse_mapfile, HF0_FIRST, HF0_LAST, HF0_MARKER, UCFG_REG_GO, UCFG_REG_ADDRMASK, SMSC_334x_MAP, \
+    CMDPROC_FEATURE_BURST, STATUS_MAGIC, UCFG_QCMD_WRITE, ULPI_EVENT_MAGIC, RING_WORD_BYTES
+import traffic
+
+# Bytes of payload per FT2232H USB packet (512 less two modem status bytes)
+_FTDI_PACKET_PAYLOAD = 510
+
+class ReplayDevice:
+    """
+    Software stand-in for FTDIDevice, for running the host side without
+    hardware.
+
+    Register accesses (the 0x55 protocol) are answered from an in-memory
+    model of the registers in the map file. Enough behaviour is modelled for
+    the normal ovctl flows: the ULPI clock is up, ULPI register accesses go
+    to an SMSC 334x register file, SDRAM tests pass, and enabling capture in
+    CSTREAM_CFG streams 'source' (see traffic.SynthTraffic and
+    traffic.RecordedTraffic) through read_async() just like the FPGA would,
+    limited to 'rate' MB/sec if given.
+    """
+
+    def __init__(self, mapfile, source=None, rate=None, regmap=None):
+        self.source = source
+        self.rate = rate
+
+        attrs = regmap[1] if regmap is not None else {}
+        self.__regs = regmap[0] if regmap is not None else parse_mapfile(mapfile, attrs)
+        self.__mem = bytearray(0x4000)
+
+        self.__ulpi = bytearray(0x40)
+        self.__ulpi[SMSC_334x_MAP["VIDL"]] = 0x24
+        self.__ulpi[SMSC_334x_MAP["VIDH"]] = 0x04
+        self.__ulpi[SMSC_334x_MAP["PIDL"]] = 0x09
+        self.__ulpi[SMSC_334x_MAP["PIDH"]] = 0x00
+        self.__ulpi[SMSC_334x_MAP["FUNC_CTL"]] = 0x41
+
+        # Set and clear aliases of ULPI registers
+        self.__ulpi_alias = {}
+        for name, addr in SMSC_334x_MAP.items():
+            if name.endswith("_SET"):
+                self.__ulpi_alias[addr] = (SMSC_334x_MAP[name[:-4]], True)
+            elif name.endswith("_CLR"):
+                self.__ulpi_alias[addr] = (SMSC_334x_MAP[name[:-4]], False)
+
+        self.__set("UCFG_STAT", 1)
+        self.__set("CMDPROC_FEATURES", CMDPROC_FEATURE_BURST)
+
+        # The replayed FPGA always runs the packaged build
+        if 'IDENT_BUILD_ID' in attrs:
+            self.__set("IDENT_BUILD_ID", attrs['IDENT_BUILD_ID'].reset)
+
+        self.__on_write = {}
+        for name, fn in [
+                ("UCFG_RCMD", self.__ulpi_read),
+                ("UCFG_WCMD", self.__ulpi_write),
+                ("UCFG_QCMD", self.__ulpi_queue),
+                ("SDRAM_TEST_CMD", self.__sdram_test),
+                ("CSTREAM_CFG", self.__cstream_cfg),
+                ("CSTREAM_TS_SNAPSHOT", self.__ts_snapshot),
+                ("CSTREAM_MARKER", self.__marker),
+                ("SDRAM_SINK_PTR_READ", self.__sink_ptr_read),
+                ("CAPTURE_STATUS_LATCH", self.__capture_status_latch),
+                ("CAPTURE_STATUS_INTERVAL", self.__status_interval),
+                ]:
+            if name in self.__regs:
+                # Multi-byte registers are written LSB first, so the base
+                # address is the last one written
+                self.__on_write[self.__regs[name][0]] = fn
+
+        self.__lock = threading.Lock()
+        self.__cmd = bytearray()
+        self.__responses = bytearray()
+
+        self.__stream = None
+        self.__pending = bytearray()
+        self.__sent = 0
+        self.__ts = 0
+        self.__start_time = None
+
+        self.__status_period = 0
+        self.__next_status = None
+
+        self.__is_open = False
+
+    # FTDIDevice interface
+
+    def open(self, serial=None):
+        self.__is_open = True
+        return 0
+
+    def close(self):
+        self.__is_open = False
+
+    def config_status(self):
+        return 0
+
+    def hw_init(self, bitstream):
+        return 0
+
+    def hw_init_buffer(self, bitstream):
+        return 0
+
+    def hw_init_config(self, data):
+        return 0
+
+    def eeprom_erase(self):
+        return 0
+
+    def eeprom_program(self, serialno):
+        return 0
+
+    def eeprom_sanitycheck(self, verbose=False):
+        return 0
+
+    def write(self, intf, buf, async_=False):
+        if not isinstance(buf, bytes):
+            raise TypeError("buf must be bytes")
+
+        with self.__lock:
+            for b in buf:
+                # Like BusDecode, skip anything until a command magic, then
+                # take address, data and (unchecked) checksum
+                if not self.__cmd and b not in (0x55, 0x56):
+                    continue
+                self.__cmd.append(b)
+                if len(self.__cmd) == self.__command_size(self.__cmd):
+                    if self.__cmd[0] == 0x56:
+                        self.__burst(self.__cmd)
+                    else:
+                        self.__command(self.__cmd)
+                    self.__cmd = bytearray()
+
+        return len(buf)
+
+    def write_async(self, intf, buf, callback):
+        # Commands are executed as they are written, so this completes
+        # straight away
+        self.write(intf, buf)
+        callback(0)
+        return 0
+
+    def read(self, intf, n, packetsPerTransfer=4, numTransfers=4):
+        buf = []
+
+        def callback(b, prog):
+            buf.extend(b)
+            return int(len(buf) >= n)
+
+        self.read_async(intf, callback, packetsPerTransfer, numTransfers)
+
+        return buf
+
+    def read_async(self, intf, callback, packetsPerTransfer, numTransfers):
+        size = packetsPerTransfer * _FTDI_PACKET_PAYLOAD
+
+        while True:
+            with self.__lock:
+                self.__status_record()
+                b = bytes(self.__responses[:size])
+                del self.__responses[:size]
+                b += self.__stream_bytes(size - len(b))
+
+            if not b:
+                # Idle; the FTDI chip would send bare status packets
+                time.sleep(0.001)
+
+            if callback(b, None):
+                return 0
+
+    @property
+    def streamed(self):
+        """Capture stream bytes handed out since capture was enabled"""
+        return self.__sent
+
+    @property
+    def ts(self):
+        """Capture time covered by the stream so far, in ULPI clocks"""
+        return self.__ts
+
+    # Register model
+
+    def __get(self, name):
+        addr, size = self.__regs[name]
+        return int.from_bytes(self.__mem[addr:addr + size], 'big')
+
+    def __set(self, name, value):
+        if name not in self.__regs:
+            return
+        addr, size = self.__regs[name]
+        value &= (1 << (8 * size)) - 1
+        self.__mem[addr:addr + size] = value.to_bytes(size, 'big')
+
+    @staticmethod
+    def __command_size(cmd):
+        if cmd[0] == 0x55 or len(cmd) < 4:
+            return 5
+        # Burst: header, data bytes for writes only, checksum
+        return 4 + (cmd[3] + 1 if cmd[1] & 0x80 else 0) + 1
+
+    def __access(self, wr, addr, value):
+        addr &= 0x3FFF
+        if wr:
+            self.__mem[addr] = value
+            if addr in self.__on_write:
+                self.__on_write[addr](value)
+            return value
+        return self.__mem[addr]
+
+    def __command(self, cmd):
+        wr = cmd[1] & 0x80
+        addr = (cmd[1] & 0x3F) << 8 | cmd[2]
+
+        value = self.__access(wr, addr, cmd[3])
+
+        resp = [0x55, cmd[1] & 0xBF, cmd[2], value]
+        resp.append(sum(resp) & 0xFF)
+        self.__responses += bytes(resp)
+
+    def __burst(self, cmd):
+        wr = cmd[1] & 0x80
+        addr = (cmd[1] & 0x3F) << 8 | cmd[2]
+        count = cmd[3] + 1
+
+        values = [self.__access(wr, addr + i, cmd[4 + i] if wr else 0)
+                  for i in range(count)]
+
+        resp = [0x56, cmd[1] & 0xBF, cmd[2], cmd[3]] + values
+        resp.append(sum(resp) & 0xFF)
+        self.__responses += bytes(resp)
+
+    def __ulpi_read(self, value):
+        if value & UCFG_REG_GO:
+            self.__set("UCFG_RDATA", self.__ulpi[value & UCFG_REG_ADDRMASK])
+            self.__set("UCFG_RCMD", value & ~UCFG_REG_GO)
+
+    def __ulpi_store(self, addr, data):
+        if addr in self.__ulpi_alias:
+            reg, setbits = self.__ulpi_alias[addr]
+            if setbits:
+                self.__ulpi[reg] |= data
+            else:
+                self.__ulpi[reg] &= ~data & 0xFF
+        else:
+            self.__ulpi[addr] = data
+
+    def __ulpi_write(self, value):
+        if value & UCFG_REG_GO:
+            self.__ulpi_store(value & UCFG_REG_ADDRMASK, self.__get("UCFG_WDATA"))
+            self.__set("UCFG_WCMD", value & ~UCFG_REG_GO)
+
+    def __ulpi_queue(self, value):
+        # Done straight away, so the queue always reads back empty; the
+        # completion event goes out with the command's response
+        addr = value & UCFG_REG_ADDRMASK
+        if value & UCFG_QCMD_WRITE:
+            data = self.__get("UCFG_WDATA")
+            self.__ulpi_store(addr, data)
+        else:
+            data = self.__ulpi[addr]
+
+        self.__set("UCFG_QCMD", 0)
+        self.__responses += bytes([ULPI_EVENT_MAGIC, value & (UCFG_QCMD_WRITE | UCFG_REG_ADDRMASK), data])
+
+    def __sdram_test(self, value):
+        # Test done and passed
+        if value & 0x80:
+            self.__set("SDRAM_TEST_CMD", (value & 0x1F) | 0x20)
+
+    def __cstream_cfg(self, value):
+        if value & 1 and self.__stream is None:
+            self.__stream = iter(self.source) if self.source is not None else iter(())
+            self.__pending = bytearray(traffic.session_marker(HF0_FIRST))
+            self.__sent = 0
+            self.__ts = 0
+            self.__start_time = time.monotonic()
+            self.__set("CSTREAM_START_TS", 0)
+        elif not value & 1 and self.__stream is not None:
+            self.__stream = None
+            self.__pending += traffic.session_marker(HF0_LAST)
+
+    def __ts_snapshot(self, value):
+        self.__set("CSTREAM_TS", self.__ts)
+
+    def __marker(self, value):
+        # Queued behind the traffic already produced, like in the FPGA
+        if value & 1 and self.__stream is not None:
+            self.__pending += traffic.session_marker(HF0_MARKER)
+
+    def __ring(self):
+        # Everything is handed to the host as soon as it is produced, so the
+        # read pointer always follows the write pointer
+        base = self.__get("SDRAM_SINK_RING_BASE") if "SDRAM_SINK_RING_BASE" in self.__regs else 0
+        end = self.__get("SDRAM_SINK_RING_END") if "SDRAM_SINK_RING_END" in self.__regs else 0
+        size = end - base
+        if size <= 0:
+            return None
+
+        # The ring counts SDRAM words
+        words = self.__sent // RING_WORD_BYTES
+        ptr = base + words % size
+        return ptr, ptr, words // size
+
+    def __sink_ptr_read(self, value):
+        ring = self.__ring()
+        if ring is None:
+            return
+
+        wptr, rptr, wraps = ring
+        self.__set("SDRAM_SINK_WPTR", wptr)
+        self.__set("SDRAM_SINK_RPTR", rptr)
+        self.__set("SDRAM_SINK_WRAP_COUNT", wraps)
+
+    def __capture_status_latch(self, value):
+        wptr, rptr, wraps = self.__ring() or (0, 0, 0)
+        self.__set("CAPTURE_STATUS_WPTR", wptr)
+        self.__set("CAPTURE_STATUS_RPTR", rptr)
+        self.__set("CAPTURE_STATUS_WRAP_COUNT", wraps)
+        self.__set("CAPTURE_STATUS_TS", self.__ts)
+
+    def __status_interval(self, value):
+        self.__status_period = self.__get("CAPTURE_STATUS_INTERVAL") / 1e6
+        self.__next_status = time.monotonic() + self.__status_period
+
+    def __status_record(self):
+        # Periodic records, see StatusRecords in LibOV
+        if not self.__status_period or time.monotonic() < self.__next_status:
+            return
+        self.__next_status += self.__status_period
+
+        wptr, rptr, wraps = self.__ring() or (0, 0, 0)
+        record = b"".join(v.to_bytes(4, 'big') for v in (wptr, rptr, wraps, 0, 0))
+        record += self.__ts.to_bytes(8, 'big')
+        self.__responses += bytes([STATUS_MAGIC, len(record)]) + record
+
+    def __stream_bytes(self, n):
+        if n <= 0:
+            return b""
+
+        if self.rate and self.__start_time is not None:
+            allowed = self.rate * 1024 * 1024 * (time.monotonic() - self.__start_time) - self.__sent
+            n = min(n, max(0, int(allowed)))
+
+        while len(self.__pending) < n and self.__stream is not None:
+            try:
+                data, ticks = next(self.__stream)
+            except StopIteration:
+                break
+            self.__pending += data
+            self.__ts += ticks
+
+        # The FPGA only interleaves register responses between SDRAM read
+        # bursts, so hand out whole bursts only
+        end = 0
+        while end + 2 <= len(self.__pending):
+            burst = (self.__pending[end + 1] + 1) * 2 + 2
+            if end + burst > n:
+                break
+            end += burst
+
+        b = bytes(self.__pending[:end])
+        del self.__pending[:end]
+        self.__sent += len(b)
+        return b
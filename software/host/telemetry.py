@@ -0,0 +1,216 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+class Telemetry:
+    """
+    Periodic metric export for long unattended captures.
+
+    Sources are callables returning a dict of metric name to number; each
+    is registered with labels (e.g. the device) that tell its samples apart.
+    Every 'interval' seconds all sources are sampled and the samples are
+    handed to the exporters. Metrics named *_total are counters; for those
+    a *_per_second rate over the last interval is added as well.
+    """
+
+    def __init__(self, interval=10.0, exporters=()):
+        self.interval = interval
+        self.exporters = list(exporters)
+
+        self.__sources = []
+        self.__last = {}
+        self.__last_time = None
+
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def add_source(self, fn, **labels):
+        self.__sources.append((labels, fn))
+
+    def sample(self):
+        """Returns (time, [(labels, metrics), ...])"""
+        now = time.time()
+        elapsed = now - self.__last_time if self.__last_time is not None else None
+        self.__last_time = now
+
+        samples = []
+        for i, (labels, fn) in enumerate(self.__sources):
+            metrics = dict(fn())
+
+            last = self.__last.get(i, {})
+            self.__last[i] = metrics
+            for name, value in list(metrics.items()):
+                if name.endswith("_total") and elapsed and name in last:
+                    metrics[name[:-len("_total")] + "_per_second"] = (value - last[name]) / elapsed
+
+            samples.append((labels, metrics))
+
+        return now, samples
+
+    def export(self):
+        now, samples = self.sample()
+        for exporter in self.exporters:
+            try:
+                exporter.export(now, samples)
+            except OSError as e:
+                print("telemetry: %s: %s" % (exporter, e), file = sys.stderr)
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            self.export()
+
+    def start(self):
+        # First sample straight away so the rates are available on the next
+        self.export()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """Stop the export thread after one last export."""
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        self.export()
+
+        for exporter in self.exporters:
+            exporter.close()
+
+
+class JSONLinesExporter:
+    """
+    One JSON object per source and sample, with the labels and a "time" key
+    next to the metrics. 'target' is a file name (appended to),
+    tcp:HOST:PORT or unix:PATH; sockets are reconnected on the next sample
+    after an error.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.__out = None
+        self.__sock = None
+
+    def __str__(self):
+        return self.target
+
+    def __connect(self):
+        import socket
+
+        if self.target.startswith("tcp:"):
+            host, port = self.target[4:].rsplit(":", 1)
+            return socket.create_connection((host, int(port)), timeout=5)
+        elif self.target.startswith("unix:"):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(5)
+            try:
+                sock.connect(self.target[5:])
+            except OSError:
+                sock.close()
+                raise
+            return sock
+        return None
+
+    def export(self, now, samples):
+        lines = "".join(json.dumps(dict(labels, time=now, **metrics), sort_keys=True) + "\n"
+                        for labels, metrics in samples)
+
+        if self.__out is None and self.__sock is None:
+            self.__sock = self.__connect()
+            if self.__sock is None:
+                self.__out = open(self.target, "a")
+
+        if self.__out is not None:
+            self.__out.write(lines)
+            self.__out.flush()
+            return
+
+        try:
+            self.__sock.sendall(lines.encode("utf-8"))
+        except OSError:
+            self.__sock.close()
+            self.__sock = None
+            raise
+
+    def close(self):
+        if self.__out is not None:
+            self.__out.close()
+            self.__out = None
+        if self.__sock is not None:
+            self.__sock.close()
+            self.__sock = None
+
+
+class PrometheusExporter:
+    """
+    Prometheus text format file for the node exporter textfile collector.
+    The file is replaced atomically on every sample, metric names get a
+    'prefix'.
+    """
+
+    def __init__(self, path, prefix="openvizsla_"):
+        self.path = path
+        self.prefix = prefix
+
+    def __str__(self):
+        return self.path
+
+    @staticmethod
+    def __labels(labels):
+        if not labels:
+            return ""
+        return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                                 for k, v in sorted(labels.items()))
+
+    def export(self, now, samples):
+        metrics = {}
+        for labels, values in samples:
+            for name, value in values.items():
+                metrics.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name in sorted(metrics):
+            kind = "counter" if name.endswith("_total") else "gauge"
+            lines.append("# TYPE %s%s %s" % (self.prefix, name, kind))
+            for labels, value in metrics[name]:
+                lines.append("%s%s%s %s" % (self.prefix, name, self.__labels(labels), repr(float(value))))
+
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.path)
+
+    def close(self):
+        pass
+
+
+def exporter(spec):
+    """
+    Exporter from a command line spec: json:TARGET (see JSONLinesExporter)
+    or prom:PATH. Meant as an argparse type, a bad spec raises
+    ArgumentTypeError so argparse shows the message.
+    """
+    kind, _, target = spec.partition(":")
+    if kind == "json" and target:
+        return JSONLinesExporter(target)
+    elif kind == "prom" and target:
+        return PrometheusExporter(target)
+    raise argparse.ArgumentTypeError("telemetry target must be json:FILE, json:tcp:HOST:PORT, "
+                     "json:unix:PATH or prom:FILE")
+
+
+class CountingFile:
+    """File wrapper counting the bytes written through it"""
+
+    def __init__(self, f):
+        self.__f = f
+        self.written = 0
+
+    def write(self, b):
+        self.written += len(b)
+        return self.__f.write(b)
+
+    def __getattr__(self, attr):
+        return getattr(self.__f, attr)
@@ -0,0 +1,114 @@
+import threading
+import time
+import unittest
+
+from LibOV import WriteQueue, FTDI_INTERFACE_A
+
+
+class FakeDevice:
+    """FTDIDevice.write_async stand-in, transfers complete when told to"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.transfers = []
+        self.fail_submit = None
+
+    def write_async(self, intf, buf, callback):
+        if self.fail_submit is not None:
+            e, self.fail_submit = self.fail_submit, None
+            raise e
+
+        with self.cond:
+            self.transfers.append((buf, callback))
+            self.cond.notify_all()
+        return 0
+
+    def wait_transfers(self, n, timeout=2.0):
+        with self.cond:
+            assert self.cond.wait_for(lambda: len(self.transfers) >= n, timeout), \
+                "%d transfers, expected %d" % (len(self.transfers), n)
+        return self.transfers[:n]
+
+    def complete(self, i, status=0):
+        self.transfers[i][1](status)
+
+
+class WriteQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.dev = FakeDevice()
+
+    def queue(self, depth=1):
+        q = WriteQueue(self.dev, FTDI_INTERFACE_A, depth=depth)
+        self.addCleanup(q.close, 0)
+        return q
+
+    def test_coalesce(self):
+        q = self.queue()
+
+        first = q.write(b"\x01")
+        self.dev.wait_transfers(1)
+
+        # Queued behind the transfer in flight
+        rest = [q.write(bytes([i])) for i in range(2, 6)]
+        time.sleep(0.05)
+        self.assertEqual(len(self.dev.transfers), 1)
+
+        self.dev.complete(0)
+        self.assertIsNone(first.result(1))
+
+        (buf0, _), (buf1, _) = self.dev.wait_transfers(2)
+        self.assertEqual(buf0, b"\x01")
+        self.assertEqual(buf1, b"\x02\x03\x04\x05")
+        self.assertFalse(any(f.done() for f in rest))
+
+        self.dev.complete(1)
+        for f in rest:
+            self.assertIsNone(f.result(1))
+        self.assertEqual((q.writes, q.transfers), (5, 2))
+
+    def test_failed_transfer(self):
+        q = self.queue()
+
+        q.write(b"\x01")
+        self.dev.wait_transfers(1)
+        futs = [q.write(b"\x02"), q.write(b"\x03")]
+        self.dev.complete(0)
+
+        self.dev.wait_transfers(2)
+        self.dev.complete(1, -1)
+        for f in futs:
+            self.assertRaises(IOError, f.result, 1)
+
+        # The queue keeps going
+        f = q.write(b"\x04")
+        self.dev.wait_transfers(3)
+        self.dev.complete(2)
+        self.assertIsNone(f.result(1))
+
+    def test_failed_submit(self):
+        q = self.queue()
+
+        self.dev.fail_submit = TypeError("buf must be bytes")
+        f = q.write(b"\x01")
+        self.assertRaises(TypeError, f.result, 1)
+
+        f = q.write(b"\x02")
+        self.dev.wait_transfers(1)
+        self.dev.complete(0)
+        self.assertIsNone(f.result(1))
+
+    def test_close_in_flight(self):
+        q = self.queue()
+
+        f = q.write(b"\x01")
+        self.dev.wait_transfers(1)
+        q.close(0.05)
+        self.assertRaises(IOError, f.result, 1)
+
+        # A late completion is ignored
+        self.dev.complete(0)
+        self.assertRaises(ValueError, q.write, b"\x02")
+
+
+if __name__ == '__main__':
+    unittest.main()
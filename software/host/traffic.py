@@ -0,0 +1,283 @@
+import itertools
+
+from LibOV import HF0_FIRST, HF0_LAST, HF0_MARKER, HF0_TRUNC, MAX_PACKET_SIZE
+from usb_interp import data_crc
+
+# Capture stream encoding, as produced by the gateware (see
+# ovhw/whacker/consumer.py and ovhw/sdram_host_read.py)
+
+# Single byte filler sent to pad the stream to whole SDRAM words
+FILLER_MAGIC = 0xA1
+
+# SDRAM host read burst length in 16 bit words
+HOST_BURST_WORDS = 0x20
+
+def encode_packet(delta_ts, pkt, flags=0, orig_len=None, magic=0xA0):
+    """Encode one captured packet with its delta timestamp"""
+    if orig_len is None:
+        orig_len = len(pkt)
+
+    if orig_len > MAX_PACKET_SIZE:
+        flags |= HF0_TRUNC
+        pkt = pkt[:MAX_PACKET_SIZE]
+
+    ts_len = max(1, (delta_ts.bit_length() + 7) // 8)
+
+    return bytes([magic, flags, orig_len & 0xFF,
+                  (ts_len - 1) << 5 | (orig_len >> 8) & 0x1F]) + \
+           delta_ts.to_bytes(ts_len, 'little') + bytes(pkt)
+
+def decode_packets(data):
+    """
+    Inverse of encode_packet over a whole stream; yields
+    (delta_ts, flags, pkt, orig_len). Filler bytes are skipped.
+    """
+    i = 0
+    while i < len(data):
+        if data[i] == FILLER_MAGIC:
+            i += 1
+            continue
+
+        if data[i] not in (0xA0, 0xA2):
+            raise ValueError("Unexpected byte %02x at offset %d" % (data[i], i))
+
+        flags = data[i + 1]
+        orig_len = (data[i + 3] & 0x1F) << 8 | data[i + 2]
+        start = i + 4 + (data[i + 3] >> 5) + 1
+        size = MAX_PACKET_SIZE if flags & HF0_TRUNC else orig_len
+
+        yield int.from_bytes(data[i + 4:start], 'little'), flags, data[start:start + size], orig_len
+
+        i = start + size
+
+def frame(data):
+    """Wrap stream bytes into SDRAM host read bursts (0xD0, words - 1, data)"""
+    if len(data) & 1:
+        data += bytes([FILLER_MAGIC])
+
+    out = bytearray()
+    step = HOST_BURST_WORDS * 2
+    for i in range(0, len(data), step):
+        chunk = data[i:i + step]
+        out.append(0xD0)
+        out.append(len(chunk) // 2 - 1)
+        out += chunk
+
+    return bytes(out)
+
+def session_marker(flags):
+    """
+    Framed stuff packet the gateware sends when capture starts or stops, or
+    when the host asks for a latency marker
+    """
+    assert flags in (HF0_FIRST, HF0_LAST, HF0_MARKER)
+    return frame(encode_packet(0, b"", flags))
+
+
+# USB packet construction
+
+PID_OUT = 0x1
+PID_ACK = 0x2
+PID_DATA0 = 0x3
+PID_SOF = 0x5
+PID_IN = 0x9
+PID_NAK = 0xA
+PID_DATA1 = 0xB
+PID_DATA2 = 0x7
+PID_SETUP = 0xD
+
+
+def pid_byte(pid):
+    return pid | (pid ^ 0xF) << 4
+
+def crc5(value, bits=11):
+    crc = 0x1F
+    for i in range(bits):
+        if (crc ^ (value >> i)) & 1:
+            crc = (crc >> 1) ^ 0x14
+        else:
+            crc >>= 1
+    return crc ^ 0x1F
+
+def token(pid, addr, endp):
+    v = addr & 0x7F | (endp & 0xF) << 7
+    return bytes([pid_byte(pid), v & 0xFF, v >> 8 | crc5(v) << 3])
+
+def sof(frameno):
+    v = frameno & 0x7FF
+    return bytes([pid_byte(PID_SOF), v & 0xFF, v >> 8 | crc5(v) << 3])
+
+def data_packet(pid, payload):
+    crc = data_crc(bytes(payload)) ^ 0xFFFF
+    return bytes([pid_byte(pid)]) + bytes(payload) + bytes([crc & 0xFF, crc >> 8])
+
+def handshake(pid):
+    return bytes([pid_byte(pid)])
+
+
+class SynthTraffic:
+    """
+    Periodic synthetic bus traffic: a SOF at the start of every (micro)frame
+    followed by one of 'bodies', used round robin so data toggles stay
+    consistent across periods.
+
+    Iterating yields (data, ticks): framed stream bytes for one period and
+    the capture time it covers. Bodies are encoded once up front, only the
+    SOF is built per period.
+    """
+
+    def __init__(self, highspeed, bodies):
+        self.highspeed = highspeed
+
+        # Capture clock ticks (60 MHz) per byte on the bus, and per packet
+        # overhead (SYNC, EOP, inter-packet gap) in bytes
+        if highspeed:
+            self.period = 7500
+            self.byte_ticks = 1
+            self.overhead = 16
+        else:
+            self.period = 60000
+            self.byte_ticks = 40
+            self.overhead = 4
+
+        self.bodies = []
+        for body in bodies:
+            # First packet goes right after the SOF
+            delta = self.__ticks(sof(0))
+            offset = 0
+            data = b""
+            for pkt in body:
+                data += encode_packet(delta, pkt)
+                offset += delta
+                delta = self.__ticks(pkt)
+            assert offset < self.period, "Transactions do not fit in a frame"
+
+            # Pad body to whole words so it can be framed on its own
+            self.bodies.append((frame(data), offset))
+
+    def __ticks(self, pkt):
+        return (len(pkt) + self.overhead) * self.byte_ticks
+
+    def __iter__(self):
+        last_offset = 0
+        for n in itertools.count():
+            data, offset = self.bodies[n % len(self.bodies)] if self.bodies else (b"", 0)
+
+            # HS frame number increments every 8 microframes
+            frameno = n // 8 if self.highspeed else n
+            head = frame(encode_packet(self.period - last_offset, sof(frameno)))
+            last_offset = offset
+
+            yield head + data, self.period
+
+
+def _payload(size):
+    return bytes((i * 7 + 3) & 0xFF for i in range(size))
+
+def _toggle(n):
+    return PID_DATA1 if n & 1 else PID_DATA0
+
+def hs_bulk(addr=1, endp=1, size=512, per_uframe=13):
+    """High speed bulk IN, as many max size transactions as fit in a microframe"""
+    bodies = []
+    payload = _payload(size)
+    # Two bodies so the data toggle keeps alternating with an odd count
+    for start in range(2 if per_uframe & 1 else 1):
+        body = []
+        for i in range(per_uframe):
+            body += [token(PID_IN, addr, endp), data_packet(_toggle(start + i), payload), handshake(PID_ACK)]
+        bodies.append(body)
+
+    return SynthTraffic(True, bodies)
+
+def hs_mass_storage(addr=1, endp_out=2, endp_in=1, blocks=12):
+    """
+    High speed mass storage reads: per microframe a command block on the
+    bulk OUT endpoint, 'blocks' 512 byte data packets and the status on the
+    bulk IN endpoint.
+    """
+    cbw = b"USBC" + bytes(27)
+    csw = b"USBS" + bytes(9)
+    payload = _payload(512)
+
+    bodies = []
+    for start in range(2):
+        body = [token(PID_OUT, addr, endp_out), data_packet(_toggle(start), cbw), handshake(PID_ACK)]
+        toggle = start * (blocks + 1)
+        for i in range(blocks):
+            body += [token(PID_IN, addr, endp_in), data_packet(_toggle(toggle), payload), handshake(PID_ACK)]
+            toggle += 1
+        body += [token(PID_IN, addr, endp_in), data_packet(_toggle(toggle), csw), handshake(PID_ACK)]
+        bodies.append(body)
+
+    return SynthTraffic(True, bodies)
+
+def hs_isoc(addr=1, endp=1, size=1024, per_uframe=3):
+    """High speed high bandwidth isochronous IN, no handshakes"""
+    payload = _payload(size)
+    pids = {1: [PID_DATA0], 2: [PID_DATA1, PID_DATA0], 3: [PID_DATA2, PID_DATA1, PID_DATA0]}[per_uframe]
+
+    body = []
+    for pid in pids:
+        body += [token(PID_IN, addr, endp), data_packet(pid, payload)]
+
+    return SynthTraffic(True, [body])
+
+def fs_hid(addr=2, endp=1, size=8):
+    """Full speed interrupt IN polling every frame, with data every other frame"""
+    payload = _payload(size)
+    nak = [token(PID_IN, addr, endp), handshake(PID_NAK)]
+
+    return SynthTraffic(False, [
+        [token(PID_IN, addr, endp), data_packet(PID_DATA0, payload), handshake(PID_ACK)], nak,
+        [token(PID_IN, addr, endp), data_packet(PID_DATA1, payload), handshake(PID_ACK)], nak,
+        ])
+
+def sof_idle(highspeed=True):
+    """Nothing but SOFs"""
+    return SynthTraffic(highspeed, [])
+
+PROFILES = {
+    "fs-hid": fs_hid,
+    "hs-bulk": hs_mass_storage,
+    "hs-isoc": hs_isoc,
+    "sof-idle": sof_idle,
+}
+
+
+class RecordedTraffic:
+    """
+    Replays a capture recorded with 'sniff --format raw'. The session and
+    latency markers in the recording are dropped, the replaying device sends
+    its own.
+    Like SynthTraffic, iterating yields (data, ticks) blocks.
+    """
+
+    def __init__(self, path, loop=False, block_size=65536):
+        self.loop = loop
+        self.blocks = []
+
+        with open(path, "rb") as f:
+            recording = f.read()
+
+        data = bytearray()
+        ticks = 0
+        for delta_ts, flags, pkt, orig_len in decode_packets(recording):
+            if flags & (HF0_FIRST | HF0_LAST | HF0_MARKER) and not pkt:
+                continue
+
+            data += encode_packet(delta_ts, pkt, flags & ~(HF0_FIRST | HF0_LAST | HF0_MARKER), orig_len)
+            ticks += delta_ts
+
+            if len(data) >= block_size:
+                self.blocks.append((frame(bytes(data)), ticks))
+                data = bytearray()
+                ticks = 0
+
+        if data:
+            self.blocks.append((frame(bytes(data)), ticks))
+
+    def __iter__(self):
+        if self.loop:
+            return itertools.cycle(self.blocks)
+        return iter(self.blocks)
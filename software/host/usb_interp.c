@@ -15,6 +15,7 @@ enum {
   HF0_TRUNC = 0x08, // Clipped due to packet length (> 800 bytes)
   HF0_FIRST = 0x10, // First packet of capture session; IE, when the cap hardware was enabled
   HF0_LAST = 0x20, // Last packet of capture session; IE, when the cap hardware was disabled
+  HF0_MARKER = 0x40, // Latency marker requested by the host
 };
 
 
@@ -275,6 +276,17 @@ int CStreamCallback (uint8_t *buffer, int length,
       packet_buf_len -= 5;
       p+=5;
       break;
+    case 0x56:
+      if (packet_buf_len < 4 || packet_buf_len < p[3] + 6) {
+	goto done;
+      }
+      {
+	unsigned int pktsize = p[3] + 6;
+	cb(p, pktsize, progress, NULL);
+	packet_buf_len -= pktsize;
+	p += pktsize;
+      }
+      break;
     case 0xAA:
       if (packet_buf_len < 2) {
 	printf("LFSR packet error -- too short (%d < 2)\n", packet_buf_len);
@@ -284,6 +296,36 @@ int CStreamCallback (uint8_t *buffer, int length,
       }
       cb(p, p[1]+2, progress, NULL);
       break;
+    case 0xAB:
+      // Sequence numbered loopback test packet, not for us
+      if (packet_buf_len < 3 || packet_buf_len < ((p[1] << 8) | p[2]) + 11) {
+	goto done;
+      }
+      {
+	unsigned int pktsize = ((p[1] << 8) | p[2]) + 11;
+	packet_buf_len -= pktsize;
+	p += pktsize;
+      }
+      break;
+    case 0xC0:
+      // Capture status record, not for us
+      if (packet_buf_len < 2 || packet_buf_len < p[1] + 2) {
+	goto done;
+      }
+      {
+	unsigned int pktsize = p[1] + 2;
+	packet_buf_len -= pktsize;
+	p += pktsize;
+      }
+      break;
+    case 0xC1:
+      // ULPI access completion event, not for us
+      if (packet_buf_len < 3) {
+	goto done;
+      }
+      packet_buf_len -= 3;
+      p += 3;
+      break;
     case 0xA0:
     case 0xA2:
       if (packet_buf_len < 8) {
@@ -2,9 +2,18 @@
 def hd(x):
     return " ".join("%02x" % i for i in x)
 
+_data_crc = None
+
+def data_crc(buf):
+    """USB data packet CRC-16; crcmod is only imported on first use"""
+    global _data_crc
+    if _data_crc is None:
+        import crcmod
+        _data_crc = crcmod.mkCrcFun(0x18005)
+    return _data_crc(buf)
+
 class USBInterpreter(object):
-    import crcmod
-    data_crc = staticmethod(crcmod.mkCrcFun(0x18005))
+    data_crc = staticmethod(data_crc)
 
     def __init__(self, highspeed):
         self.frameno = None
@@ -127,7 +136,8 @@ class USBInterpreter(object):
                 CRC_NONE: ' '
             }
 
-            flag_field = "[  %s%s%s%s%s%s]" % (
+            flag_field = "[ %s%s%s%s%s%s%s]" % (
+                'M' if flags & 0x40 else ' ',
                 'L' if flags & 0x20 else ' ',
                 'F' if flags & 0x10 else ' ',
                 'T' if flags & 0x08 else ' ',